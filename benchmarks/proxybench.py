@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+
+'''Replay benchmarks for the proxy request path
+
+Generates a synthetic fixture tree, replays a request trace through the
+flask app (test client, and a real threaded server) and reports req/s and
+latency percentiles per scenario as json:
+
+    python -m benchmarks.proxybench --issues 200 --requests 5000 --output bench.json
+    python -m benchmarks.proxybench --compare bench.json
+'''
+
+
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import logzero
+import requests
+
+from werkzeug.serving import make_server
+
+from github_test_proxy import webapp
+from github_test_proxy.cacher import ProxyCacher
+from github_test_proxy.standin import StandinServer
+
+
+SCENARIOS = ['load', 'smart', 'deltas']
+TRANSPORTS = ['client', 'server']
+
+# what a bot reads per issue
+READ_PATHS = ['', '/comments', '/events', '/labels']
+LABELS = ['bug', 'feature', 'needs_info', 'needs_revision', 'module', 'docs']
+
+
+########################################################
+#   FIXTURES
+########################################################
+
+
+def issue_resources(org, repo, number, events=10, comments=5):
+    '''(path, data) of every resource of one synthetic issue'''
+    base = 'https://api.github.com/repos/%s/%s/issues/%s' % (org, repo, number)
+    labels = [{'name': x, 'url': 'https://api.github.com/repos/%s/%s/labels/%s' % (org, repo, x)}
+              for x in LABELS[:number % len(LABELS)]]
+    user = {'login': 'user%s' % number, 'url': 'https://api.github.com/users/user%s' % number}
+    issue = {
+        'number': number,
+        'url': base,
+        'html_url': base.replace('api.github.com/repos', 'github.com'),
+        'title': 'synthetic issue %s' % number,
+        'body': 'lorem ipsum ' * 40,
+        'state': 'open' if number % 3 else 'closed',
+        'user': user,
+        'labels': labels,
+        'comments': comments,
+        'created_at': '2019-01-01T00:00:00Z',
+        'updated_at': '2019-01-02T00:00:00Z',
+    }
+    comment_list = [
+        {'id': number * 1000 + x, 'url': '%s/comments/%s' % (base, x), 'user': user,
+         'body': 'comment %s ' % x * 20, 'created_at': '2019-01-01T00:00:00Z'}
+        for x in range(comments)
+    ]
+    event_list = [
+        {'id': number * 1000 + x, 'url': '%s/events/%s' % (base, x), 'actor': user,
+         'event': 'labeled', 'label': {'name': LABELS[x % len(LABELS)]},
+         'created_at': '2019-01-01T00:00:00Z'}
+        for x in range(events)
+    ]
+    path = '/repos/%s/%s/issues/%s' % (org, repo, number)
+    return [
+        (path, issue),
+        (path + '/comments', comment_list),
+        (path + '/events', event_list),
+        (path + '/labels', labels),
+    ]
+
+
+def generate_fixtures(cacher, org, repo, issues, events=10, comments=5):
+    '''Write synthetic fixtures for issues 1..issues, return the routes'''
+    routes = {}
+    for number in range(1, issues + 1):
+        for path, data in issue_resources(org, repo, number, events, comments):
+            routes[path] = ({'ETag': '"%s"' % number}, data)
+            if cacher is not None:
+                fixdir, dtype = cacher.fixture_location('https://api.github.com' + path)
+                cacher.write_fixture(fixdir, dtype, data, {'ETag': '"%s"' % number}, compress=True)
+    return routes
+
+
+########################################################
+#   TRACES
+########################################################
+
+
+def make_trace(org, repo, issues, count, writes=0.0, seed=0):
+    '''A bot-like trace: hot issues are read far more often than cold ones
+
+    writes is the fraction of requests that comment on, label or unlabel
+    an issue.
+    '''
+    rand = random.Random(seed)
+    trace = []
+    for _ in range(count):
+        number = min(int(rand.paretovariate(1.2)), issues)
+        path = '/repos/%s/%s/issues/%s' % (org, repo, number)
+        if rand.random() < writes:
+            kind = rand.choice(['comment', 'label', 'unlabel'])
+            label = rand.choice(LABELS)
+            if kind == 'comment':
+                trace.append(['POST', path + '/comments', json.dumps({'body': 'bench'})])
+            elif kind == 'label':
+                trace.append(['POST', path + '/labels', json.dumps([label])])
+            else:
+                trace.append(['DELETE', path + '/labels/' + label, ''])
+        else:
+            trace.append(['GET', path + rand.choice(READ_PATHS), ''])
+    return trace
+
+
+def load_trace(path):
+    '''[method, path, body] per line, as written by save_trace'''
+    with open(path, 'r') as f:
+        return [json.loads(x) for x in f if x.strip()]
+
+
+def save_trace(path, trace):
+    with open(path, 'w') as f:
+        for entry in trace:
+            f.write(json.dumps(entry) + '\n')
+
+
+########################################################
+#   REPLAY
+########################################################
+
+
+def percentile(ordered, pct):
+    '''Nearest-rank percentile of a sorted list'''
+    if not ordered:
+        return None
+    ix = max(0, int(math.ceil(pct / 100.0 * len(ordered))) - 1)
+    return ordered[min(ix, len(ordered) - 1)]
+
+
+def summarize(latencies, errors, seconds):
+    ordered = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 4),
+        'req_s': round(len(latencies) / max(seconds, 1e-9), 1),
+        'p50_ms': round(percentile(ordered, 50) * 1000, 3) if ordered else None,
+        'p95_ms': round(percentile(ordered, 95) * 1000, 3) if ordered else None,
+        'p99_ms': round(percentile(ordered, 99) * 1000, 3) if ordered else None,
+    }
+
+
+def replay_client(app, trace, baseurl):
+    '''Replay trace sequentially through the flask test client'''
+    client = app.test_client()
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for method, path, body in trace:
+        t0 = time.perf_counter()
+        resp = client.open(path, method=method, data=body, base_url=baseurl)
+        resp.get_data()
+        latencies.append(time.perf_counter() - t0)
+        if resp.status_code >= 400:
+            errors += 1
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def replay_server(app, trace, concurrency=8):
+    '''Replay trace against a real threaded server from concurrent clients'''
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    baseurl = 'http://127.0.0.1:%s' % server.server_port
+    webapp.GM.BASEURL = baseurl
+
+    local = threading.local()
+    lock = threading.Lock()
+    latencies = []
+    counts = {'errors': 0}
+
+    def one(entry):
+        method, path, body = entry
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        t0 = time.perf_counter()
+        try:
+            resp = session.request(method, baseurl + path, data=body)
+            failed = resp.status_code >= 400
+        except requests.RequestException:
+            failed = True
+        elapsed = time.perf_counter() - t0
+        with lock:
+            latencies.append(elapsed)
+            if failed:
+                counts['errors'] += 1
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for _ in executor.map(one, trace):
+                pass
+        seconds = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    return summarize(latencies, counts['errors'], seconds)
+
+
+@contextlib.contextmanager
+def proxy_app(tmpdir, mode, upstream=None):
+    '''Point webapp at a fresh ProxyCacher configured like `mode` would'''
+    previous = webapp.GM
+    GM = ProxyCacher()
+    GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+    GM.deltadir = os.path.join(tmpdir, 'deltas')
+    GM.BASEURL = 'http://localhost:6000'
+    GM.usecache = True
+    GM.proxy = mode == 'smart'
+    if upstream is not None:
+        GM.UPSTREAMS = {'api.github.com': upstream}
+    webapp.GM = GM
+    try:
+        yield GM
+    finally:
+        webapp.GM = previous
+
+
+def run_scenario(scenario, transport, args, trace):
+    '''Run one scenario on a fresh tree, return its summary'''
+    with tempfile.TemporaryDirectory() as tmpdir:
+        standin = None
+        if scenario == 'smart':
+            routes = generate_fixtures(None, args.org, args.repo, args.issues,
+                                       args.events, args.comments)
+            standin = StandinServer(routes).start()
+        try:
+            upstream = standin.url if standin is not None else None
+            with proxy_app(tmpdir, scenario, upstream=upstream) as GM:
+                GM.preserialize = args.preserialize
+                if scenario != 'smart':
+                    generate_fixtures(GM, args.org, args.repo, args.issues,
+                                      args.events, args.comments)
+                if transport == 'client':
+                    result = replay_client(webapp.app, trace, GM.BASEURL)
+                else:
+                    result = replay_server(webapp.app, trace, args.concurrency)
+                if standin is not None:
+                    result['upstream_requests'] = len(standin.requests)
+        finally:
+            if standin is not None:
+                standin.stop()
+    result['scenario'] = scenario
+    result['transport'] = transport
+    return result
+
+
+########################################################
+#   REPORTS
+########################################################
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    '''Lines of req/s and p95 change per scenario between two reports'''
+    before = dict(((x['scenario'], x['transport']), x) for x in old['results'])
+    lines = []
+    for result in new['results']:
+        key = (result['scenario'], result['transport'])
+        if key not in before:
+            continue
+        prev = before[key]
+        lines.append('%-8s %-7s req/s %8.1f -> %8.1f (%+.1f%%)  p95 %8.3f -> %8.3f ms' % (
+            key[0], key[1],
+            prev['req_s'], result['req_s'],
+            (result['req_s'] - prev['req_s']) * 100.0 / max(prev['req_s'], 1e-9),
+            prev['p95_ms'] or 0, result['p95_ms'] or 0,
+        ))
+    return lines
+
+
+def run(args):
+    results = []
+    for scenario in args.scenario:
+        writes = args.writes if scenario == 'deltas' else 0.0
+        if args.trace:
+            trace = load_trace(args.trace)
+            if scenario != 'deltas':
+                trace = [x for x in trace if x[0] == 'GET']
+        else:
+            trace = make_trace(args.org, args.repo, args.issues, args.requests,
+                               writes=writes, seed=args.seed)
+        for transport in args.transport:
+            result = run_scenario(scenario, transport, args, trace)
+            logzero.logger.warning('%(scenario)s/%(transport)s: %(req_s)s req/s '
+                                   'p50 %(p50_ms)sms p95 %(p95_ms)sms p99 %(p99_ms)sms' % result)
+            results.append(result)
+    return {
+        'commit': git_commit(),
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'config': {
+            'issues': args.issues,
+            'events': args.events,
+            'comments': args.comments,
+            'requests': args.requests,
+            'writes': args.writes,
+            'concurrency': args.concurrency,
+            'preserialize': args.preserialize,
+            'trace': args.trace,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='replay benchmarks for github-test-proxy')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+        help="scenario to run, repeatable (default: all)")
+    parser.add_argument('--transport', action='append', choices=TRANSPORTS,
+        help="test client and/or real server, repeatable (default: both)")
+    parser.add_argument('--org', default='ansible')
+    parser.add_argument('--repo', default='ansible')
+    parser.add_argument('--issues', default=100, type=int)
+    parser.add_argument('--events', default=10, type=int, help="events per issue")
+    parser.add_argument('--comments', default=5, type=int, help="comments per issue")
+    parser.add_argument('--requests', default=2000, type=int, help="length of generated traces")
+    parser.add_argument('--writes', default=0.3, type=float,
+        help="fraction of writes in the deltas scenario")
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--trace', default=None,
+        help="replay this trace file instead of a generated one")
+    parser.add_argument('--save-trace', default=None,
+        help="write the generated deltas trace here and exit")
+    parser.add_argument('--concurrency', default=8, type=int,
+        help="client threads against the real server")
+    parser.add_argument('--preserialize', action='store_true')
+    parser.add_argument('--output', default=None, help="write the json report here")
+    parser.add_argument('--compare', default=None,
+        help="previous json report to compare the results against")
+    parser.add_argument('--verbose', action='store_true', help="keep the proxy's logging on")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    args.scenario = args.scenario or SCENARIOS
+    args.transport = args.transport or TRANSPORTS
+    if not args.verbose:
+        # per request logging would dominate the numbers
+        logzero.loglevel(logging.WARNING)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    if args.save_trace:
+        save_trace(args.save_trace, make_trace(args.org, args.repo, args.issues,
+                                               args.requests, writes=args.writes, seed=args.seed))
+        return None
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            for line in compare(json.loads(f.read()), report):
+                print(line)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+
+import gzip
+import json
+import mmap
+import os
+import zlib
+
+from logzero import logger
+
+from github_test_proxy.blobs import BlobStore
+from github_test_proxy.index import FixtureIndex
+
+
+ARCHIVE_VERSION = 1
+
+
+def index_file(path):
+    return path + '.idx'
+
+
+class FixtureArchive:
+
+    '''Read-only packed fixture set
+
+    All fixtures live in one data file of concatenated gzip members, with
+    a separate offset index. The data file is mmap'd so a lookup is a dict
+    access plus a decompress straight out of the page cache.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with gzip.open(index_file(path), 'rb') as f:
+            idx = json.loads(f.read())
+        if idx.get('version') != ARCHIVE_VERSION:
+            raise Exception('%s has unsupported archive version %s' % (path, idx.get('version')))
+        # reldir -> {fixture_type: [hoff, hlen, doff, dlen]}
+        self.dirs = idx['dirs']
+        self._fh = open(path, 'rb')
+        if os.fstat(self._fh.fileno()).st_size:
+            self._mmap = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+        else:
+            self._mmap = None
+            self._view = memoryview(b'')
+
+    def __len__(self):
+        return sum(len(x) for x in self.dirs.values())
+
+    def __contains__(self, key):
+        return key[1] in self.dirs.get(key[0], {})
+
+    def close(self):
+        self._view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+        self._fh.close()
+
+    def list(self, reldir):
+        return sorted(self.dirs.get(reldir, {}).keys())
+
+    def raw(self, reldir, fixture_type):
+        '''Compressed (headers, data) as zero-copy views, or None'''
+        entry = self.dirs.get(reldir, {}).get(fixture_type)
+        if entry is None:
+            return None
+        hoff, hlen, doff, dlen = entry
+        return self._view[hoff:hoff + hlen], self._view[doff:doff + dlen]
+
+    def read(self, reldir, fixture_type):
+        '''Uncompressed (headers, data) bytes, or None'''
+        raw = self.raw(reldir, fixture_type)
+        if raw is None:
+            return None
+        return (
+            zlib.decompress(raw[0], 16 + zlib.MAX_WBITS),
+            zlib.decompress(raw[1], 16 + zlib.MAX_WBITS),
+        )
+
+
+def read_compressed(fn, level=9):
+    with open(fn, 'rb') as f:
+        raw = f.read()
+    if fn.endswith('.gz'):
+        return raw
+    return gzip.compress(raw, compresslevel=level, mtime=0)
+
+
+def pack_fixtures(fixturedir, path, level=9):
+    '''Convert a fixturedir tree into a packed archive at path
+
+    Uncompressed fixtures are gzipped at level, compressed ones are
+    copied as they are. Deduplicated fixtures are copied out of their blob.
+    '''
+    index = FixtureIndex(fixturedir)
+    index.build()
+    blobs = BlobStore(fixturedir)
+
+    dirs = {}
+    offset = 0
+    tmpfile = path + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        for reldir in sorted(index.dirs.keys()):
+            directory = os.path.join(fixturedir, reldir)
+            for fixture_type in index.list(directory):
+                entry = []
+                for fn in index.find(directory, fixture_type):
+                    blob = read_compressed(blobs.resolve(fn), level=level)
+                    f.write(blob)
+                    entry.extend([offset, len(blob)])
+                    offset += len(blob)
+                dirs.setdefault(reldir, {})[fixture_type] = entry
+
+    with gzip.open(index_file(path) + '.tmp', 'wb') as f:
+        f.write(json.dumps({'version': ARCHIVE_VERSION, 'dirs': dirs}).encode('utf-8'))
+    os.rename(tmpfile, path)
+    os.rename(index_file(path) + '.tmp', index_file(path))
+    logger.info('packed %s fixtures (%s bytes) into %s' % (len(index), offset, path))
+    return len(index)
+
+
+def unpack_fixtures(path, fixturedir):
+    '''Expand a packed archive back into a fixturedir tree'''
+    archive = FixtureArchive(path)
+    count = 0
+    try:
+        for reldir in sorted(archive.dirs.keys()):
+            directory = os.path.join(fixturedir, reldir)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            for fixture_type in archive.list(reldir):
+                hraw, draw = archive.raw(reldir, fixture_type)
+                hfn = os.path.join(directory, '%s.headers.json.gz' % fixture_type)
+                with open(hfn, 'wb') as f:
+                    f.write(hraw)
+                dfn = os.path.join(directory, '%s.json.gz' % fixture_type)
+                with open(dfn, 'wb') as f:
+                    f.write(draw)
+                # views pin the mmap until released
+                hraw.release()
+                draw.release()
+                count += 1
+    finally:
+        archive.close()
+    logger.info('unpacked %s fixtures from %s into %s' % (count, path, fixturedir))
+    return count
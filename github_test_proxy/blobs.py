@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+
+import gzip
+import hashlib
+import json
+import os
+import zlib
+
+from logzero import logger
+
+from github_test_proxy.index import split_fixture_name
+from github_test_proxy.locking import atomic_write
+
+
+BLOB_DIR = '.blobs'
+REF_SUFFIX = '.ref'
+
+# headers that change on every fetch of the same content and that no
+# client acts on, the rate limit ones are kept since bots throttle on them
+VOLATILE_HEADERS = [
+    'Age',
+    'Date',
+    'Expires',
+    'X-GitHub-Request-Id',
+    'X-Runtime-rack',
+]
+
+
+def stable_headers(headers):
+    '''headers without the volatile ones, in a stable key order'''
+    volatile = set(x.lower() for x in VOLATILE_HEADERS)
+    return dict(sorted((k, v) for k, v in headers.items() if k.lower() not in volatile))
+
+
+def is_ref(path):
+    return path.endswith(REF_SUFFIX)
+
+
+def decompress_file(path, raw):
+    '''Uncompressed bytes of a fixture file by its suffix'''
+    if path.endswith('.gz'):
+        return zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+    return raw
+
+
+class BlobStore:
+
+    '''Content-addressed fixture payloads shared by every url
+
+    A payload is stored once under fixturedir/.blobs by the sha256 of its
+    uncompressed bytes. Fixtures are small .ref files holding that digest,
+    so identical bodies (empty label lists, the same user over and over)
+    and headers that only differed in their dates take the space of one.
+    The ref files stay per url, their mtimes keep meaning what the fixture
+    file mtimes meant. Blobs are never rewritten, only added.
+    '''
+
+    def __init__(self, fixturedir, codec=None):
+        self.root = os.path.join(fixturedir, BLOB_DIR)
+        # compresses new blobs, gzip when None
+        self.codec = codec
+
+    def blob_path(self, digest, suffix='.gz'):
+        return os.path.join(self.root, digest[:2], '%s.json%s' % (digest, suffix))
+
+    def find(self, digest):
+        '''Path of the stored blob, or None'''
+        for suffix in ['.gz', '']:
+            path = self.blob_path(digest, suffix)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def put(self, raw):
+        '''Store uncompressed bytes, returning their digest'''
+        digest = hashlib.sha256(raw).hexdigest()
+        if self.find(digest) is None:
+            if self.codec is None:
+                suffix, payload = '.gz', gzip.compress(raw, mtime=0)
+            else:
+                suffix, payload = self.codec.suffix, self.codec.compress(raw)
+            atomic_write(self.blob_path(digest, suffix), payload)
+        return digest
+
+    def write_ref(self, path, raw):
+        '''Store raw and point the ref file at path to it'''
+        digest = self.put(raw)
+        atomic_write(path, (digest + '\n').encode('ascii'))
+        return digest
+
+    def read_ref(self, path):
+        with open(path, 'rb') as f:
+            return f.read().decode('ascii').strip()
+
+    def resolve(self, path):
+        '''The file holding a fixture file's payload, the blob for a ref'''
+        if not is_ref(path):
+            return path
+        digest = self.read_ref(path)
+        blob = self.find(digest)
+        if blob is None:
+            raise FileNotFoundError(self.blob_path(digest))
+        return blob
+
+    def read_file(self, path):
+        '''Uncompressed contents of a fixture file, following refs'''
+        path = self.resolve(path)
+        with open(path, 'rb') as f:
+            return decompress_file(path, f.read())
+
+    def digests(self):
+        '''Every stored digest'''
+        if not os.path.exists(self.root):
+            return
+        for prefix in sorted(os.listdir(self.root)):
+            dirpath = os.path.join(self.root, prefix)
+            if not os.path.isdir(dirpath):
+                continue
+            for fn in sorted(os.listdir(dirpath)):
+                if not fn.startswith('.'):
+                    yield fn.split('.')[0]
+
+    def size(self):
+        '''Bytes the blobs take on disk'''
+        total = 0
+        for digest in self.digests():
+            total += os.path.getsize(self.find(digest))
+        return total
+
+
+def fixture_files(fixturedir):
+    '''(path, kind) of every fixture file, dot directories aside'''
+    for dirpath, dirnames, filenames in os.walk(fixturedir):
+        dirnames[:] = sorted(x for x in dirnames if not x.startswith('.'))
+        for fn in sorted(filenames):
+            if fn.startswith('.'):
+                continue
+            parts = split_fixture_name(fn)
+            if parts is not None:
+                yield os.path.join(dirpath, fn), parts[1]
+
+
+def dedup_fixtures(fixturedir, codec=None, dry_run=False):
+    '''Move every fixture file under fixturedir into the blob store
+
+    Data is re-serialized compactly and headers lose their volatile
+    entries first, so equal content hashes equally however it was
+    written. Blobs no longer referenced by any fixture are removed.
+    Returns a report of the space saved; with dry_run nothing changes
+    on disk and the report says what would happen.
+    '''
+    blobs = BlobStore(fixturedir, codec=codec)
+    loads = json.loads if codec is None else codec.loads
+    if codec is None:
+        # the same compact layout the fast json backends write
+        dumps = lambda x: json.dumps(x, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    else:
+        dumps = codec.dumps
+
+    report = {
+        'fixturedir': fixturedir,
+        'files': 0,
+        'migrated': 0,
+        'bytes_before': blobs.size(),
+        'blobs': 0,
+        'bytes_after': 0,
+        'pruned': 0,
+    }
+    referenced = set()
+    sizes = {}
+    written = set()
+    for path, kind in fixture_files(fixturedir):
+        report['files'] += 1
+        report['bytes_before'] += os.path.getsize(path)
+        if is_ref(path):
+            digest = blobs.read_ref(path)
+            referenced.add(digest)
+            report['bytes_after'] += os.path.getsize(path)
+            continue
+
+        # foo.json.gz -> foo.json.ref, an uncompressed copy beside it wins
+        # like it does on reads and comes first in the walk
+        base = path[:-3] if path.endswith('.gz') else path
+        if base + REF_SUFFIX in written:
+            if not dry_run:
+                os.remove(path)
+            continue
+        written.add(base + REF_SUFFIX)
+
+        raw = blobs.read_file(path)
+        obj = loads(raw)
+        if kind == 'headers':
+            obj = stable_headers(obj)
+        raw = dumps(obj)
+        digest = hashlib.sha256(raw).hexdigest()
+        referenced.add(digest)
+        if blobs.find(digest) is None and digest not in sizes:
+            sizes[digest] = len(gzip.compress(raw, mtime=0)) if dry_run else 0
+        report['migrated'] += 1
+        report['bytes_after'] += len(digest) + 1
+        if dry_run:
+            continue
+
+        blobs.write_ref(base + REF_SUFFIX, raw)
+        os.remove(path)
+
+    for digest in list(blobs.digests()):
+        if digest in referenced:
+            report['bytes_after'] += os.path.getsize(blobs.find(digest))
+        elif not dry_run:
+            os.remove(blobs.find(digest))
+            report['pruned'] += 1
+        else:
+            report['pruned'] += 1
+    report['bytes_after'] += sum(sizes.values())
+    report['blobs'] = len(referenced)
+    if report['blobs']:
+        report['dedup_ratio'] = round(report['files'] / report['blobs'], 2)
+    else:
+        report['dedup_ratio'] = 1.0
+    if report['bytes_before']:
+        report['size_ratio'] = round(report['bytes_after'] / report['bytes_before'], 3)
+    else:
+        report['size_ratio'] = 1.0
+    logger.info('%s fixture files share %s blobs in %s' % (report['files'], report['blobs'], fixturedir))
+    return report
@@ -3,15 +3,51 @@
 
 import datetime
 import glob
-import gzip
 import hashlib
 import json
 import os
+import re
+import shutil
 import subprocess
+import threading
+import time
+import uuid
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
+from urllib.parse import urlparse
+from urllib.parse import urlunparse
 
-import requests
 from logzero import logger
 
+from github_test_proxy.archive import FixtureArchive
+from github_test_proxy.blobs import BlobStore
+from github_test_proxy.blobs import REF_SUFFIX
+from github_test_proxy.blobs import decompress_file
+from github_test_proxy.blobs import stable_headers
+from github_test_proxy.codec import Codec
+from github_test_proxy.codec import DEFAULT_CODEC
+from github_test_proxy.deltas import DeltaStore
+from github_test_proxy.graphql import body_key
+from github_test_proxy.graphql import is_mutation
+from github_test_proxy.graphql import legacy_key
+from github_test_proxy.graphql import parse_body
+from github_test_proxy.index import FixtureIndex
+from github_test_proxy.index import relative_dir
+from github_test_proxy.index import split_fixture_name
+from github_test_proxy.locking import KeyedLocks
+from github_test_proxy.locking import atomic_write
+from github_test_proxy.lru import LRUCache
+from github_test_proxy.lru import file_signature
+from github_test_proxy.metrics import Metrics
+from github_test_proxy.query import QueryEngine
+from github_test_proxy.query import parse_list_url
+from github_test_proxy.rewrite import UrlRewriter
+from github_test_proxy.singleflight import SingleFlight
+from github_test_proxy.upstream import UpstreamClient
+
 
 #BASEURL = 'http://localhost:5000'
 ERROR_TIMER = 0
@@ -30,6 +66,26 @@ ANSIBLE_RUNS_URL = u'%s/runs?projectIds=%s&isPullRequest=True' % (
 
 DEFAULT_ETAG = 'a00049ba79152d03380c34652f2cb612'
 
+# reactions
+ACCEPT_HEADER = ','.join([
+    u'application/json',
+    u'application/vnd.github.mockingbird-preview',
+    u'application/vnd.github.sailor-v-preview+json',
+    u'application/vnd.github.starfox-preview+json',
+    u'application/vnd.github.v3+json',
+    u'application/vnd.github.squirrel-girl-preview+json'
+])
+
+# upstream headers that are passed along to the client
+RESPONSE_HEADERS = ['ETag', 'Link']
+
+# default and largest page sizes of github's list endpoints
+PER_PAGE = 30
+MAX_PER_PAGE = 100
+
+# fixture type suffix of a list stored with all of its pages in one fixture
+COLLECTION_SUFFIX = '@all'
+
 # https://elasticread.eng.ansible.com/ansible-issues/_search
 # https://elasticread.eng.ansible.com/ansible-pull-requests/_search
 #	?q=lucene_syntax_here
@@ -43,6 +99,18 @@ class RequestNotCachedException(Exception):
     pass
 
 
+class UpstreamError(Exception):
+
+    '''An upstream response that must not be recorded, a non-2xx one or
+    a page of a list that is not a list'''
+
+    def __init__(self, url, status_code, headers, reason=None):
+        super().__init__('%s %s' % (url, reason or 'returned %s' % status_code))
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+
+
 def get_timestamp():
     # 2018-10-15T21:21:48.150184
     # 2018-10-10T18:25:49Z
@@ -58,18 +126,103 @@ def run_command(cmd):
     return (p.returncode, so, se)
 
 
-def read_gzip_json(cfile):
+def get_page_number(url):
+    '''The page query parameter of a url as an int, or None'''
+    for k, v in parse_qsl(urlparse(url).query):
+        if k == 'page' and v.isdigit():
+            return int(v)
+    return None
+
+
+def set_page_number(url, page):
+    '''url with its page query parameter replaced
+
+    Only the page parameter is touched, the rest of the query keeps its
+    order and encoding so the url still names the recorded fixture.
+    '''
+    parts = urlparse(url)
+    query = [x for x in parts.query.split('&') if x]
+    pages = [ix for ix, x in enumerate(query) if x.split('=')[0] == 'page']
+    if pages:
+        query[pages[0]] = 'page=%s' % page
+        query = [x for ix, x in enumerate(query) if ix not in pages[1:]]
+    else:
+        query.append('page=%s' % page)
+    return urlunparse(parts._replace(query='&'.join(query)))
+
+
+def get_page_params(url):
+    '''(page, per_page) a list url asks for, with github's defaults and limits'''
+    page = get_page_number(url) or 1
+    per_page = PER_PAGE
+    for k, v in parse_qsl(urlparse(url).query):
+        if k == 'per_page' and v.isdigit():
+            per_page = min(max(int(v), 1), MAX_PER_PAGE)
+    return page, per_page
+
+
+def get_collection_url(url):
+    '''url without its paging parameters and the other ones sorted, so
+    every page of the same list maps to the same collection'''
+    parts = urlparse(url)
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query) if k not in ['page', 'per_page']
+    )
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+
+def get_page_links(url, page, per_page, total):
+    '''Link header for a page of a collection of total items, or None
+    when everything fits on the first page'''
+    last = max(1, (total + per_page - 1) // per_page)
+    if page == 1 and last == 1:
+        return None
+    parts = urlparse(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k not in ['page', 'per_page']]
+
+    def page_url(number):
+        q = query + [('per_page', str(per_page)), ('page', str(number))]
+        return urlunparse(parts._replace(query=urlencode(q)))
+
+    # same order github sends them in
+    links = []
+    if page > 1:
+        links.append((min(page - 1, last), 'prev'))
+    if page < last:
+        links.append((page + 1, 'next'))
+        links.append((last, 'last'))
+    if page > 1:
+        links.append((1, 'first'))
+    return ', '.join('<%s>; rel="%s"' % (page_url(x), rel) for x, rel in links)
+
+
+def fixture_signature(paths):
+    '''Change detector for a fixture's (headers, data) paths
+
+    Only the data file counts, the headers file mtime doubles as the time
+    the fixture was last confirmed fresh upstream.
+    '''
+    return file_signature(*paths[1:])
+
+
+def filter_response_headers(headers):
+    '''Keep only the ETag, Link and X-* headers'''
+    return dict(
+        (k, v) for k, v in headers.items()
+        if k.startswith('X-') or k in RESPONSE_HEADERS
+    )
+
+
+def read_gzip_json(cfile, codec=DEFAULT_CODEC):
     try:
-        with gzip.open(cfile, 'r') as f:
-            jdata = json.loads(f.read())
-    except json.decoder.JSONDecodeError as e:
+        jdata = codec.loads(codec.read_file(cfile))
+    except ValueError as e:
         logger.error(e)
         import epdb; epdb.st()
     return jdata
 
-def write_gzip_json(cfile, data):
-    with gzip.open(cfile, 'wb') as f:
-        f.write(json.dumps(data).encode('utf-8'))
+def write_gzip_json(cfile, data, codec=DEFAULT_CODEC):
+    atomic_write(cfile, codec.compress(codec.dumps(data)))
 
 
 class ProxyCacher:
@@ -78,6 +231,17 @@ class ProxyCacher:
     TOKEN = None
     SHIPPABLE_TOKEN = None
 
+    # every origin that gets pointed back at BASEURL
+    ORIGINS = [
+        'https://api.github.com',
+        'https://github.com',
+        'https://api.shippable.com',
+        'https://app.shippable.com',
+    ]
+
+    # context -> base url to fetch from instead of https://<context>
+    UPSTREAMS = {}
+
     # make remote calls to github for uncached data
     proxy = False
 
@@ -90,8 +254,165 @@ class ProxyCacher:
     # where to store the new events created by POST
     deltadir = '/tmp/bot.deltas'
 
+    # bounds for the in-memory cache of parsed+rewritten fixtures
+    fixture_cache_size = 1024
+    fixture_cache_bytes = 64 * 1024 * 1024
+
+    # seconds a fixture is trusted in smart mode before it is revalidated
+    # upstream with If-None-Match, None to trust fixtures forever
+    fixture_ttl = None
+    # [(compiled regex, seconds)] overriding fixture_ttl for matching urls
+    fixture_ttls = []
+
+    # concurrent page fetches when a response has a rel="last" link
+    page_workers = 8
+
+    # send rewritten gzip fixtures untouched to clients accepting gzip
+    gzip_passthrough = False
+
+    # add a Server-Timing header with the per-stage breakdown
+    server_timing = False
+
+    # write new fixtures as refs into the content-addressed blob store
+    dedup = False
+
+    # store list endpoints as one full collection and cut the requested
+    # page out of it locally, whatever page and per_page are asked for
+    synthesize_pages = False
+    paginated_collections = ['issues', 'pulls', 'comments', 'events', 'files']
+
+    # load mode answers issue and pull list filters from every recorded
+    # issue and pull instead of only the exact urls that were recorded
+    local_queries = False
+
+    # serve unchanged fixtures straight from pre-serialized response bytes
+    preserialize = False
+    response_cache_size = 1024
+    response_cache_bytes = 128 * 1024 * 1024
+
+    # bounds for the in-memory map of graphql request bodies to fixtures
+    graphql_cache_size = 256
+    graphql_cache_bytes = 32 * 1024 * 1024
+
     def __init__(self):
-        pass
+        # json backend and compression for fixtures written to fixturedir
+        self.codec = Codec()
+        # gzip level of the rewritten variants sent by gzip passthrough
+        self.served_codec = Codec(compression='gzip', level=6)
+        # url->fixture map built by load_index, None to probe the filesystem
+        self.index = None
+        # packed read-only fixture set opened by open_archive
+        self.archive = None
+        self.deltas = DeltaStore(rewrite=self.replace_data_urls, codec=self.codec)
+        # serializes writers of the same fixture
+        self.fixture_locks = KeyedLocks()
+        # dedupes concurrent upstream fetches of the same resource
+        self.inflight = SingleFlight()
+        # pooled keep-alive connections to github and shippable
+        self.upstream = UpstreamClient()
+        # smart mode revalidations by upstream answer, bumped by any worker
+        self.revalidations = {'not_modified': 0, 'modified': 0}
+        self.revalidations_lock = threading.Lock()
+        # per-route and per-stage timings for /metrics
+        self.metrics = Metrics()
+        self.fixture_cache = LRUCache(
+            max_entries=self.fixture_cache_size,
+            max_bytes=self.fixture_cache_bytes
+        )
+        self.response_cache = LRUCache(
+            max_entries=self.response_cache_size,
+            max_bytes=self.response_cache_bytes
+        )
+        # raw graphql query body -> fixture type, the results themselves
+        # are held once, in fixture_cache
+        self.graphql_cache = LRUCache(
+            max_entries=self.graphql_cache_size,
+            max_bytes=self.graphql_cache_bytes
+        )
+        # content hashes of fixtures, for the etags sent to clients
+        self.hash_cache = LRUCache(
+            max_entries=self.fixture_cache_size * 8,
+            max_bytes=self.fixture_cache_size * 8
+        )
+        # bumped on every fixture write, derived indexes rebuild after it
+        self.fixture_generation = 0
+        self.queries = QueryEngine(self)
+
+    def load_index(self, rebuild=False):
+        '''Build or reload the fixture index for fixturedir'''
+        self.index = FixtureIndex(self.fixturedir)
+        if rebuild or not self.index.load():
+            self.index.build()
+            self.index.save()
+        return self.index
+
+    @property
+    def blobs(self):
+        '''BlobStore for the current fixturedir and codec'''
+        store = getattr(self, '_blobs', None)
+        if store is None or store.root != os.path.join(self.fixturedir, '.blobs') \
+                or store.codec is not self.codec:
+            store = BlobStore(self.fixturedir, codec=self.codec)
+            self._blobs = store
+        return store
+
+    def set_codec(self, codec, served_codec=None):
+        '''Switch the json backend and compression of the fixture stores'''
+        self.codec = codec
+        self.deltas.codec = codec
+        if served_codec is not None:
+            self.served_codec = served_codec
+        self.fixture_cache.clear()
+        self.response_cache.clear()
+
+    def after_fork(self):
+        '''Drop state a forked worker must not share with its parent'''
+        self.upstream.close()
+        self.metrics = Metrics()
+
+    def reload(self, rebuild=False):
+        '''Pick up fixtures changed on disk: reread the index and archive'''
+        if self.index is not None:
+            self.load_index(rebuild=rebuild)
+        if self.archive is not None:
+            self.open_archive(self.archive.path)
+        self.fixture_cache.clear()
+        self.response_cache.clear()
+        self.hash_cache.clear()
+        self.graphql_cache.clear()
+        self.queries.clear()
+
+    def watched_files(self):
+        '''Files whose change should trigger a reload
+
+        Not the index journal, the server appends to it on every fixture
+        it records and would keep reloading itself.
+        '''
+        paths = []
+        if self.index is not None:
+            paths.append(self.index.snapshot_file)
+        if self.archive is not None:
+            paths.extend([self.archive.path, self.archive.path + '.idx'])
+        return paths
+
+    def open_archive(self, path):
+        '''Serve fixtures from a packed archive in addition to fixturedir'''
+        if self.archive is not None:
+            self.archive.close()
+        self.archive = FixtureArchive(path)
+        self.fixture_cache.clear()
+        self.response_cache.clear()
+        return self.archive
+
+    @property
+    def rewriter(self):
+        '''UrlRewriter for the current BASEURL, rebuilt if the config changes'''
+        rw = getattr(self, '_rewriter', None)
+        if rw is None or rw.baseurl != self.BASEURL or rw.origins != tuple(self.ORIGINS) \
+                or rw.codec is not self.codec:
+            rw = UrlRewriter(self.ORIGINS, self.BASEURL, codec=self.codec)
+            self._rewriter = rw
+        return rw
 
     @property
     def is_proxy(self):
@@ -99,6 +420,18 @@ class ProxyCacher:
             return True
         return False
 
+    def request_headers(self, headers=None):
+        '''Headers for an upstream request, with any extra ones merged in'''
+        _headers = {}
+        if self.TOKEN:
+            _headers['Authorization'] = 'token %s' % self.TOKEN
+
+        _headers['Accept'] = ACCEPT_HEADER
+        if headers is not None:
+            for k, v in headers.items():
+                _headers[k] = v
+        return _headers
+
     def tokenized_request(
             self,
             url,
@@ -107,34 +440,37 @@ class ProxyCacher:
             headers=None,
             pages=None,
             paginate=True,
-            pagecount=0
+            pagecount=0,
+            cache_pages=False,
+            strict=False
         ):
 
-        logger.info('(FETCH) [%s] %s' % (method, url))
-        _headers = {}
-        if self.TOKEN:
-            _headers['Authorization'] = 'token %s' % self.TOKEN
+        '''Fetch url upstream, following its pages unless paginate is off
 
-        # reactions
-        accepts = [
-            u'application/json',
-            u'application/vnd.github.mockingbird-preview',
-            u'application/vnd.github.sailor-v-preview+json',
-            u'application/vnd.github.starfox-preview+json',
-            u'application/vnd.github.v3+json',
-            u'application/vnd.github.squirrel-girl-preview+json'
-        ]
-        _headers['Accept'] = ','.join(accepts)
-        if headers is not None:
-            for k, v in headers.items():
-                _headers[k] = v
+        With strict, or cache_pages, any page that fails or is not a list
+        raises UpstreamError instead of ending up in the result.
+        '''
+
+        strict = strict or cache_pages
+        logger.info('(FETCH) [%s] %s' % (method, url))
+        _headers = self.request_headers(headers)
 
+        fetch_url = self.upstream_url(url)
         if method == 'GET':
-            logger.info('GET %s' % url)
-            rr = requests.get(url, headers=_headers)
+            logger.info('GET %s' % fetch_url)
+            rr = self.upstream.get(fetch_url, headers=_headers)
         elif method == 'POST':
-            logger.info('POST %s' % url)
-            rr = requests.post(url, data=data, headers=_headers)
+            logger.info('POST %s' % fetch_url)
+            # graphql queries only read, they are retried like GETs
+            idempotent = None
+            if url.split('/')[-1] == 'graphql':
+                body = parse_body(data)
+                idempotent = body is not None and not is_mutation(body)
+            rr = self.upstream.post(fetch_url, data=data, headers=_headers, idempotent=idempotent)
+
+        if strict and not 200 <= rr.status_code < 300:
+            # error bodies are not fixtures, the url was not recorded
+            raise UpstreamError(url, rr.status_code, dict(rr.headers))
 
         if rr.headers.get('Status') == '204 No Content':
             data = None
@@ -146,24 +482,300 @@ class ProxyCacher:
                 import epdb; epdb.st()
 
         rheaders = dict(rr.headers)
+        if 'Link' in rheaders:
+            rheaders['Link'] = self.canonical_url(rheaders['Link'])
 
         if not paginate:
             return (rheaders, data)
 
+        if cache_pages:
+            self.store_fixture(url, rheaders, data)
+
+        # only lists are paged, search results and the like are returned
+        # as the first page has them
+        if not isinstance(data, list):
+            return (rheaders, data)
+
         # exit early if enough pages were collected
         pagecount += 1
         if pages and pagecount >= pages:
             return (rheaders, data)
 
+        links = {}
         if 'Link' in rheaders:
             links = self.extract_header_links(rheaders)
-            if links.get('next'):
-                logger.debug('NEXT: %s' % links.get('next'))
-                (_headers, _data) = self.tokenized_request(links['next'], pagecount=pagecount)
-                data += _data
+
+        def fetch_page(page_url):
+            logger.debug('PAGE: %s' % page_url)
+            (_headers, _data) = self.tokenized_request(
+                page_url, headers=headers, paginate=False, cache_pages=cache_pages, strict=strict
+            )
+            if strict and not isinstance(_data, list):
+                raise UpstreamError(page_url, None, _headers, reason='is not a list')
+            if cache_pages:
+                self.store_fixture(page_url, _headers, _data)
+            return (_headers, _data)
+
+        page_urls = self.get_page_urls(links)
+        if page_urls:
+            # every remaining page is known up front, fetch them side by side
+            if pages:
+                page_urls = page_urls[:pages - pagecount]
+            with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+                for (_headers, _data) in executor.map(fetch_page, page_urls):
+                    data.extend(_data)
+        else:
+            while links.get('next') and not (pages and pagecount >= pages):
+                (_headers, _data) = fetch_page(links['next'])
+                data.extend(_data)
+                pagecount += 1
+                links = {}
+                if 'Link' in _headers:
+                    links = self.extract_header_links(_headers)
 
         return (rheaders, data)
 
+    def upstream_url(self, url):
+        '''Where to actually fetch a canonical https://<context> url from'''
+        for context, base in self.UPSTREAMS.items():
+            prefix = 'https://%s' % context
+            if url.startswith(prefix):
+                return base.rstrip('/') + url[len(prefix):]
+        return url
+
+    def canonical_url(self, url):
+        '''Reverse of upstream_url, also works on Link header values'''
+        for context, base in self.UPSTREAMS.items():
+            url = url.replace(base.rstrip('/'), 'https://%s' % context)
+        return url
+
+    def get_ttl(self, url):
+        for pattern, ttl in self.fixture_ttls:
+            if pattern.search(url):
+                return ttl
+        return self.fixture_ttl
+
+    def is_stale(self, url, paths):
+        '''True if the fixture at paths is past its ttl'''
+        ttl = self.get_ttl(url)
+        if ttl is None or not paths or not self.is_proxy:
+            return False
+        try:
+            checked = os.stat(paths[0]).st_mtime
+        except OSError:
+            return False
+        return time.time() - checked > ttl
+
+    def revalidate_fixture(self, url, fixdir, dtype):
+        '''Conditional GET for a stale fixture, True if it was rewritten
+
+        A 304 only bumps the headers file mtime, which marks the fixture
+        fresh again without touching the body.
+        '''
+        paths = self.find_fixture(fixdir, dtype)
+        headers = self.read_fixture(fixdir, dtype)[0]
+        extra = {}
+        if headers.get('ETag'):
+            extra['If-None-Match'] = headers['ETag']
+        logger.info('revalidate %s' % url)
+        rr = self.upstream.get(self.upstream_url(url), headers=self.request_headers(extra))
+        if rr.status_code == 304:
+            with self.revalidations_lock:
+                self.revalidations['not_modified'] += 1
+            os.utime(paths[0])
+            return False
+        if rr.status_code != 200:
+            # keep serving the old copy, upstream will be asked again later
+            logger.warning('revalidating %s returned %s' % (url, rr.status_code))
+            return False
+        with self.revalidations_lock:
+            self.revalidations['modified'] += 1
+        rheaders = dict(rr.headers)
+        if 'Link' in rheaders:
+            rheaders['Link'] = self.canonical_url(rheaders['Link'])
+        self.write_fixture(fixdir, dtype, rr.json(), rheaders, compress=True)
+        return True
+
+    def get_page_urls(self, links):
+        '''Every page url after the current one, derived from rel="next" and
+        rel="last", or an empty list if they are missing'''
+        if not links.get('next') or not links.get('last'):
+            return []
+        first = get_page_number(links['next'])
+        last = get_page_number(links['last'])
+        if first is None or last is None:
+            return []
+        return [set_page_number(links['last'], x) for x in range(first, last + 1)]
+
+    def store_fixture(self, url, headers, data):
+        '''Write a fetched upstream response as the fixture for url'''
+        context = urlparse(url).netloc
+        fixdir, dtype = self.fixture_location(url, context=context)
+        self.write_fixture(fixdir, dtype, data, headers, compress=True)
+
+    def fixture_location(self, url, data=None, context='api.github.com'):
+        '''Map an upstream url to its fixture directory and fixture type'''
+        path = url.replace('https://%s/' % context, '')
+        path = path.split('/')
+        if path[-1] != 'graphql':
+            dtype = path[-1]
+            path = '/'.join(path[:-1])
+            fixdir = os.path.join(self.fixturedir, context, path)
+        else:
+            fixdir, dtype = self.graphql_location(data, context=context)
+        return fixdir, dtype
+
+    def graphql_location(self, data, context='api.github.com'):
+        '''fixture_location of a graphql request, parsing its body once
+
+        Query bodies seen before map straight to their fixture type, so a
+        repeated query skips parsing and canonicalizing and is answered
+        from the fixture cache like any other fixture. Mutations are not
+        remembered.
+        '''
+        fixdir = os.path.join(self.fixturedir, context, 'graphql')
+        if data:
+            dtype = self.graphql_cache.get(data)
+            if dtype is not None:
+                return fixdir, dtype
+        body = parse_body(data)
+        if body is None:
+            return fixdir, legacy_key(data)
+        dtype = body_key(body)
+        if not is_mutation(body):
+            self.graphql_cache.put(data, dtype, size=len(data))
+        return fixdir, dtype
+
+    def is_collection(self, url, context='api.github.com'):
+        '''Is url a list whose pages are cut out of a stored collection
+
+        Only lists under repos/<org>/<repo>, a name like issues elsewhere
+        (search/issues) is not a plain list.
+        '''
+        if not self.synthesize_pages or context != 'api.github.com':
+            return False
+        path = urlparse(url).path.strip('/').split('/')
+        if len(path) < 4 or path[0] != 'repos':
+            return False
+        return path[-1] in self.paginated_collections
+
+    def collection_location(self, url, context='api.github.com'):
+        '''Fixture directory and type of the collection a list url pages through'''
+        fixdir, dtype = self.fixture_location(get_collection_url(url), context=context)
+        return fixdir, dtype + COLLECTION_SUFFIX
+
+    def fetch_collection(self, url, headers=None, context='api.github.com'):
+        '''Fetch every page of a list upstream and store it as one fixture
+
+        Nothing is stored unless every page came back as a list.
+        '''
+        curl = get_collection_url(url)
+        sep = '&' if '?' in curl else '?'
+        try:
+            rheaders, rdata = self.tokenized_request(
+                '%s%sper_page=%s' % (curl, sep, MAX_PER_PAGE),
+                headers=headers,
+                strict=True
+            )
+        except UpstreamError as e:
+            # a partial collection would be served until it goes stale
+            logger.warning('not storing a collection, %s' % e)
+            return
+        if not isinstance(rdata, list):
+            # not a list after all, the page is fetched on its own
+            logger.warning('%s is not a list, not storing a collection' % curl)
+            return
+        # the links are generated per page on the way out
+        rheaders.pop('Link', None)
+        fixdir, dtype = self.collection_location(url, context=context)
+        self.write_fixture(fixdir, dtype, rdata, rheaders, compress=True)
+
+    def cached_collection_page(self, url, headers=None, context='api.github.com', session=None):
+        '''(headers, data) of one page of a stored collection
+
+        A missing or stale collection is fetched in full when proxying.
+        Local changes are merged into the whole collection before the
+        page is cut out of it, so appended comments and events land on
+        the right page. None if there is no collection to page through.
+        '''
+        fixdir, dtype = self.collection_location(url, context=context)
+        try:
+            paths = self.find_fixture(fixdir, dtype)
+        except RequestNotCachedException:
+            paths = None
+
+        if self.is_proxy and (paths is None or self.is_stale(url, paths)):
+            with self.metrics.stage('upstream'):
+                self.inflight.do(
+                    ('COLLECTION', fixdir, dtype),
+                    self.fetch_collection, url, headers=headers, context=context
+                )
+        try:
+            rheaders, rdata = self.load_fixture(fixdir, dtype)
+        except RequestNotCachedException:
+            return None
+        if not isinstance(rdata, list):
+            return None
+
+        with self.metrics.stage('deltas'):
+            rdata = self.get_changes(context, get_collection_url(url), rdata, session=session)
+        return self.paginate(url, rheaders, rdata)
+
+    def paginate(self, url, rheaders, items):
+        '''(headers, items) of the page of items url asks for, with Link
+        headers pointing at the other pages'''
+        page, per_page = get_page_params(url)
+        start = (page - 1) * per_page
+        rheaders = dict(rheaders)
+        rheaders.pop('Link', None)
+        links = get_page_links(url, page, per_page, len(items))
+        if links is not None:
+            rheaders['Link'] = self.rewriter.rewrite_text(links)
+        return rheaders, items[start:start + per_page]
+
+    def is_local_query(self, url, context='api.github.com'):
+        '''Is url an issue or pull list the query engine answers'''
+        return self.local_queries and not self.is_proxy and \
+            context == 'api.github.com' and parse_list_url(url) is not None
+
+    def local_query(self, url, session=None):
+        '''(headers, data) of a list evaluated over every recorded issue or
+        pull, or None if the query can not be answered locally'''
+        with self.metrics.stage('query'):
+            items = self.queries.answer(url, session=session)
+        if items is None:
+            return None
+        return self.paginate(url, {}, items)
+
+    def fixture_types(self, directory):
+        '''Every fixture type stored in directory, archived ones included'''
+        types = set()
+        if self.index is not None:
+            types.update(self.index.list(directory))
+        else:
+            try:
+                filenames = os.listdir(directory)
+            except FileNotFoundError:
+                filenames = []
+            for fn in filenames:
+                parts = split_fixture_name(fn)
+                if parts is not None:
+                    types.add(parts[0])
+        if self.archive is not None:
+            types.update(self.archive.list(relative_dir(self.fixturedir, directory)))
+        return sorted(types)
+
+    def load_fixture_data(self, directory, fixture_type):
+        '''Url-rewritten data of a fixture, None if it is missing
+
+        Unlike load_fixture this keeps bulk reads out of the fixture cache.
+        '''
+        try:
+            draw = self.read_fixture_bytes(directory, fixture_type)[2]
+        except RequestNotCachedException:
+            return None
+        return self.rewriter.loads(draw)
+
     # CACHED PROXY
     def cached_tokenized_request(
             self,
@@ -173,41 +785,77 @@ class ProxyCacher:
             headers=None,
             pages=None,
             pagecount=0,
-            context='api.github.com'
+            context='api.github.com',
+            session=None
         ):
 
-        '''fetch a raw github api url, cache the result, munge it and send it back'''
+        '''fetch a raw github api url, cache the result, munge it and send it back
+
+        Local changes are read from and written to the session's own delta
+        namespace when a session is given.
+        '''
 
         rdata = None
         loaded = False
 
-        path = url.replace('https://%s/' % context, '')
-        path = path.split('/')
-        if path[-1] != 'graphql':
-            dtype = path[-1]
-            path = '/'.join(path[:-1])
-            fixdir = os.path.join(self.fixturedir, context, path)
-        else:
-            fixdir = os.path.join(self.fixturedir, context, 'graphql')
-            m = hashlib.md5()
-            m.update(data)
-            dtype = m.hexdigest()
+        fixdir, dtype = self.fixture_location(url, data=data, context=context)
+        is_graphql = url.split('/')[-1] == 'graphql'
+
+        # any page of a list comes out of its stored collection, page
+        # fixtures recorded before are still used when there is none
+        if method == 'GET' and self.usecache and self.is_collection(url, context=context):
+            page = self.cached_collection_page(url, headers=headers, context=context, session=session)
+            if page is not None:
+                return page
 
         if self.usecache:
             try:
-                rheaders, rdata = self.read_fixture(fixdir, dtype)
+                rheaders, rdata = self.load_fixture(fixdir, dtype)
+                loaded = True
+            except RequestNotCachedException:
+                pass
+
+        # fixtures recorded before queries were canonicalized
+        if is_graphql and self.usecache and not loaded and legacy_key(data) != dtype:
+            try:
+                rheaders, rdata = self.load_fixture(fixdir, legacy_key(data))
+                dtype = legacy_key(data)
                 loaded = True
             except RequestNotCachedException:
                 pass
 
+        # list filters that were never recorded are evaluated over
+        # everything that was
+        if not loaded and method == 'GET' and self.usecache and \
+                self.is_local_query(url, context=context):
+            answer = self.local_query(url, session=session)
+            if answer is not None:
+                return answer
+
+        # smart mode re-checks fixtures older than their ttl
+        if loaded and self.is_proxy and method == 'GET' and self.get_ttl(url) is not None:
+            try:
+                paths = self.find_fixture(fixdir, dtype)
+            except RequestNotCachedException:
+                # archived fixtures are read-only
+                paths = ()
+            if self.is_stale(url, paths):
+                with self.metrics.stage('upstream'):
+                    modified = self.inflight.do(
+                        ('REVALIDATE', url), self.revalidate_fixture, url, fixdir, dtype
+                    )
+                if modified:
+                    rheaders, rdata = self.load_fixture(fixdir, dtype)
+
         # add new data locally
-        if method in ['POST', 'UPDATE', 'DELETE'] and  path[-1] != 'graphql':
+        if method in ['POST', 'UPDATE', 'DELETE'] and not is_graphql:
             jdata = data
             try:
-                jdata = json.loads(data)
-            except json.decoder.JSONDecodeError:
+                jdata = self.codec.loads(data)
+            except ValueError:
                 pass
-            self.handle_change(context, url, headers, data, method=method)
+            with self.metrics.stage('deltas'):
+                self.handle_change(context, url, headers, data, method=method, session=session)
             #import epdb; epdb.st()
             return {}, {}
 
@@ -218,7 +866,7 @@ class ProxyCacher:
             if url.endswith('/labels'):
                 iheaders, idata = self.get_cached_issue_data(url=url)
                 if not idata['labels']:
-                    return {}, []
+                    return {}, self.get_changes(context, url, [], session=session)
             else:
                 print('HUH?')
                 import epdb; epdb.st()
@@ -227,22 +875,31 @@ class ProxyCacher:
         #if loaded and not self.is_proxy and method == 'GET':
         #    rdata = self.get_changes(context, url, rdata)
         if self.usecache:
-            rdata = self.get_changes(context, url, rdata)
+            with self.metrics.stage('deltas'):
+                rdata = self.get_changes(context, url, rdata, session=session)
 
         if not loaded and self.is_proxy:
-            rheaders, rdata = self.tokenized_request(
-                url,
-                data=data,
-                method=method,
-                headers=headers,
-                pages=pages,
-                pagecount=pagecount,
-                paginate=False
-            )
 
-            if not os.path.exists(fixdir):
-                os.makedirs(fixdir)
-            self.write_fixture(fixdir, dtype, rdata, rheaders, compress=True)
+            def fetch():
+                with self.metrics.stage('upstream'):
+                    rheaders, rdata = self.tokenized_request(
+                        url,
+                        data=data,
+                        method=method,
+                        headers=headers,
+                        pages=pages,
+                        pagecount=pagecount,
+                        paginate=False
+                    )
+                with self.metrics.stage('write'):
+                    self.write_fixture(fixdir, dtype, rdata, rheaders, compress=True)
+                return rheaders, rdata
+
+            # graphql fixtures are keyed on the body hash so dtype covers it
+            rheaders, rdata = self.inflight.do((method, url, dtype), fetch)
+            with self.metrics.stage('rewrite'):
+                rheaders = self.replace_data_urls(rheaders)
+                rdata = self.replace_data_urls(rdata)
             loaded = True
 
         if not loaded:
@@ -251,12 +908,9 @@ class ProxyCacher:
                 '%s was not cached and the server is not in proxy mode' % url
             )
 
-        new_headers = self.replace_data_urls(rheaders)
-        new_data = self.replace_data_urls(rdata)
-
         logger.debug('returning from cached_tokenized_request')
 
-        return new_headers, new_data
+        return rheaders, rdata
 
 
     def get_cached_issue_data(self, namespace=None, repo=None, number=None, url=None):
@@ -269,16 +923,50 @@ class ProxyCacher:
                 break
         diskpath = urlparts[2:numix]
         fixdir = os.path.join(self.fixturedir, '/'.join(diskpath))
-        (headers, data) = self.read_fixture(fixdir, urlparts[numix])
+        (headers, data) = self.load_fixture(fixdir, urlparts[numix])
         return (headers, data)
 
-    def get_changes(self, context, url, data):
+    def session_deltadir(self, session=None):
+        '''Root of a session's delta namespace, the shared deltadir for None
+
+        A session only ever sees its own changes layered over the shared
+        read-only fixtures, so creating one costs nothing and discarding
+        it is removing its directory.
+        '''
+        if session is None:
+            return self.deltadir
+        return os.path.join(self.deltadir, 'sessions', session)
+
+    def list_sessions(self):
+        try:
+            sessions = os.listdir(os.path.join(self.deltadir, 'sessions'))
+        except FileNotFoundError:
+            return []
+        return sorted(x for x in sessions if not x.startswith('.'))
+
+    def discard_session(self, session):
+        '''Drop every change made in a session, False if it had none'''
+        root = self.session_deltadir(session)
+        # renamed aside first so no request ever sees a half deleted
+        # session, only all of its changes or none
+        trash = os.path.join(
+            os.path.dirname(root), '.discarded.%s.%s' % (session, uuid.uuid4().hex)
+        )
+        try:
+            os.rename(root, trash)
+        except FileNotFoundError:
+            return False
+        shutil.rmtree(trash, ignore_errors=True)
+        self.deltas.forget(root)
+        return True
+
+    def get_delta_dir(self, context, url, session=None):
+        '''The delta directory holding local changes for url, or None'''
         path = url.replace('https://%s/' % context, '')
         path = path.split('/')
 
-
         if not 'issues' in path and not 'issue' in path and not 'pull' in path and not 'pulls' in path:
-            return data
+            return None
 
         numix = None
         for idx, _path in enumerate(path):
@@ -287,71 +975,46 @@ class ProxyCacher:
                 break
 
         if numix is None:
-            import epdb; epdb.st()
+            return None
 
-        inumber = path[numix]
-
-        dtype = path[-1]
         _path = '/'.join(path[:numix+1])
-        fixdir = os.path.join(self.deltadir, context, _path)
-        if not os.path.exists(fixdir):
-            return data
+        return os.path.join(self.session_deltadir(session), context, _path)
 
-        efile = os.path.join(fixdir, 'events.json')
-        if not os.path.exists(efile):
+    def has_changes(self, context, url, session=None):
+        ddir = self.get_delta_dir(context, url, session=session)
+        return ddir is not None and self.deltas.exists(ddir)
+
+    def get_changes(self, context, url, data, session=None):
+        ddir = self.get_delta_dir(context, url, session=session)
+        if ddir is None:
             return data
 
-        with open(efile, 'r') as f:
-            events = json.loads(f.read())
+        path = url.replace('https://%s/' % context, '')
+        path = path.split('/')
+        inumber = [x for x in path if x.isdigit()][0]
+
+        state = self.deltas.issue_state(ddir)
+        if not state.events:
+            return data
 
-        dtype = None
+        # fixtures may be shared through the fixture cache, so never mutate them
         if url.endswith(inumber):
-            dtype = 'issue'
+            data = data.copy()
+            data['updated_at'] = state.updated_at
+            if state.labels:
+                data['labels'] = state.merge_labels(data.get('labels', []))
+            if state.comments and 'comments' in data:
+                data['comments'] += state.comments
         elif url.endswith('events'):
-            dtype = 'events'
+            data = data + state.events
         elif url.endswith('comments'):
-            dtype = 'comments'
-
-        for event in events:
-            if dtype == 'events':
-                data.append(event)
-                continue
-            if dtype == 'comments' and event['event'] == 'commented':
-                data.append(event)
-                continue
-            if dtype == 'comments' and event['event'] != 'commented':
-                continue
-            if dtype == 'issue':
-                data['updated_at'] = event['created_at']
-                if event['event'] == 'labeled':
-                    found = False
-                    for label in data['labels']:
-                        if label['name'] == event['label']['name']:
-                            found = True
-                            break
-                    if not found:
-                        data['labels'].append({'name': event['label']['name']})
-                elif event['event'] == 'unlabeled':
-                    found = False
-                    for label in data['labels']:
-                        if label['name'] == event['label']['name']:
-                            found = label
-                            break
-                    if found:
-                        data['labels'].remove(found)
-                elif event['event'] == 'commented':
-                    data['comments'] += 1
-                #else:
-                #    import epdb; epdb.st()
-
-                continue
-
-            #import epdb; epdb.st()
+            data = data + state.comment_events
+        elif url.endswith('labels'):
+            data = state.merge_labels(data)
 
-        #import epdb; epdb.st()
         return data
 
-    def handle_change(self, context, url, headers, data, method=None):
+    def handle_change(self, context, url, headers, data, method=None, session=None):
 
         # GET POST UPDATE DELETE
 
@@ -360,7 +1023,7 @@ class ProxyCacher:
 
         jdata = None
         try:
-            jdata = json.loads(data)
+            jdata = self.codec.loads(data)
         except Exception:
             pass
 
@@ -373,22 +1036,10 @@ class ProxyCacher:
 
         dtype = path[-1]
         _path = '/'.join(path[:-1])
-        fixdir = os.path.join(self.deltadir, context, _path)
-        if not os.path.exists(fixdir):
-            os.makedirs(fixdir)
-
-        #fixfile = os.path.join(fixdir, '%s.json' % path[-1])
-        efile = os.path.join(fixdir, 'events.json')
-
-        #ldata = []
-        #if os.path.exists(fixfile):
-        #    with open(fixfile, 'r') as f:
-        #        ldata = json.loads(f.read())
+        fixdir = os.path.join(self.session_deltadir(session), context, _path)
 
+        # only the new events, they get appended to the resource's log
         edata = []
-        if os.path.exists(efile):
-            with open(efile, 'r') as f:
-                edata = json.loads(f.read())
 
         if path[-1] == 'labels':
             #jdata = json.loads(data)
@@ -424,8 +1075,7 @@ class ProxyCacher:
         else:
             import epdb; epdb.st()
 
-        with open(efile, 'w') as f:
-            f.write(json.dumps(edata, indent=2))
+        self.deltas.append(fixdir, edata)
 
 
     def get_new_event(self):
@@ -471,24 +1121,26 @@ class ProxyCacher:
         logger.info('load %s %s %s' % (org, repo, number))
         number = int(number)
         bd = os.path.join(self.fixturedir, 'repos', org, repo, str(number))
-        fns = sorted(glob.glob('%s/*' % bd))
+        if self.index is not None:
+            fns = []
+            for fixture_type in self.index.list(bd):
+                fns.extend(self.index.find(bd, fixture_type))
+            fns = sorted(fns)
+        else:
+            fns = sorted(glob.glob('%s/*' % bd))
         fns = [x for x in fns if ftype in os.path.basename(x)]
 
         result = None
         headers = None
 
         for fn in fns:
-            if fn.endswith('.gz'):
-                data = read_gzip_json(fn)
-            else:
-                with open(fn, 'r') as f:
-                    try:
-                        data = json.loads(f.read())
-                    except ValueError as e:
-                        logger.error('unable to parse %s' % fn)
-                        raise Exception(e)
-
-            data = self.replace_data_urls(data)
+            raw = self.blobs.read_file(fn)
+            try:
+                data = self.rewriter.loads(raw)
+            except ValueError as e:
+                logger.error('unable to parse %s' % fn)
+                raise Exception(e)
+
             if '.headers' in fn:
                 headers = data.copy()
             else:
@@ -499,54 +1151,391 @@ class ProxyCacher:
 
     def replace_data_urls(self, data):
         '''Point ALL urls back to this instance instead of the origin'''
-        data = json.dumps(data)
-        data = data.replace('https://api.github.com', self.BASEURL)
-        data = data.replace('https://github.com', self.BASEURL)
-        data = data.replace('https://api.shippable.com', self.BASEURL)
-        data = data.replace('https://app.shippable.com', self.BASEURL)
-        data = json.loads(data)
-        return data
+        return self.rewriter.rewrite_object(data)
+
+    def find_fixture(self, directory, fixture_type):
+        '''Locate the headers and data files for a fixture'''
+        if self.index is not None:
+            paths = self.index.find(directory, fixture_type)
+            if paths is not None:
+                return paths
+            # only a proxy can have fixtures written behind the index's back
+            if not self.is_proxy:
+                raise RequestNotCachedException
+        paths = []
+        for suffix in ['.headers.json', '.json']:
+            fn = os.path.join(directory, '%s%s' % (fixture_type, suffix))
+            for variant in ['', '.gz', REF_SUFFIX]:
+                if os.path.exists(fn + variant):
+                    paths.append(fn + variant)
+                    break
+            else:
+                raise RequestNotCachedException
+        return tuple(paths)
+
+    def in_archive(self, directory, fixture_type):
+        '''Is the fixture read from the archive
+
+        A copy in fixturedir, written by smart or proxy mode after the
+        archive was packed, always wins over the archived one.
+        '''
+        if self.archive is None:
+            return False
+        if self.index is not None:
+            return self.index.find(directory, fixture_type) is None
+        try:
+            self.find_fixture(directory, fixture_type)
+        except RequestNotCachedException:
+            return True
+        return False
+
+    def read_fixture_bytes(self, directory, fixture_type):
+        '''Return the fixture paths and the uncompressed headers+data bytes
+
+        Fixtures served from the archive have no paths. The archive is
+        consulted unless fixturedir has a newer copy, see in_archive.
+        '''
+        paths, signature, hraw, draw = self.read_fixture_signed(directory, fixture_type)
+        return paths, hraw, draw
+
+    def read_fixture_signed(self, directory, fixture_type):
+        '''read_fixture_bytes plus the fixture's signature
+
+        The signature is taken before the files are read, so a concurrent
+        write can only make a cache entry built from the bytes look older
+        than it is, never let old bytes pass for the new file.
+        '''
+        if self.in_archive(directory, fixture_type):
+            with self.metrics.stage('gunzip'):
+                raw = self.archive.read(relative_dir(self.fixturedir, directory), fixture_type)
+            if raw is not None:
+                return (), fixture_signature(()), raw[0], raw[1]
+
+        with self.metrics.stage('lookup'):
+            paths = self.find_fixture(directory, fixture_type)
+        signature = fixture_signature(paths)
+        raw = []
+        for fn in paths:
+            logger.debug('read %s' % fn)
+            try:
+                with self.metrics.stage('read'):
+                    fn = self.blobs.resolve(fn)
+                    with open(fn, 'rb') as f:
+                        blob = f.read()
+            except FileNotFoundError:
+                raise RequestNotCachedException
+            with self.metrics.stage('gunzip'):
+                raw.append(decompress_file(fn, blob))
+        return paths, signature, raw[0], raw[1]
 
     def read_fixture(self, directory, fixture_type):
+        paths, hraw, draw = self.read_fixture_bytes(directory, fixture_type)
+        return self.codec.loads(hraw), self.codec.loads(draw)
+
+    def load_fixture(self, directory, fixture_type):
+        '''read_fixture through the in-memory cache, with urls already rewritten
+
+        The returned objects are shared with the cache and must not be mutated.
+        '''
+        key = (directory, fixture_type)
+        cached = self.fixture_cache.get(
+            key,
+            validator=lambda x: fixture_signature(x[0]) == x[1]
+        )
+        if cached is not None:
+            return cached[2], cached[3]
+
+        paths, signature, hraw, draw = self.read_fixture_signed(directory, fixture_type)
+        rewriter = self.rewriter
+        with self.metrics.stage('rewrite'):
+            hrewritten = rewriter.rewrite_bytes(hraw)
+            drewritten = rewriter.rewrite_bytes(draw)
+        with self.metrics.stage('parse'):
+            headers = self.codec.loads(hrewritten)
+            data = self.codec.loads(drewritten)
+        self.fixture_cache.put(
+            key,
+            (paths, signature, headers, data),
+            size=len(hraw) + len(draw)
+        )
+        return headers, data
 
-        hfn = os.path.join(directory, '%s.headers.json' % fixture_type)
-        if not os.path.exists(hfn):
-            hfn += '.gz'
-            if not os.path.exists(hfn):
-                raise RequestNotCachedException
-            logger.debug('read %s' % hfn)
-            headers = read_gzip_json(hfn)
+    def load_fixture_raw(self, directory, fixture_type):
+        '''Paths, signature, parsed headers plus the rewritten data bytes,
+        for callers that only re-serialize the body and never need the
+        parsed object'''
+        paths, signature, hraw, draw = self.read_fixture_signed(directory, fixture_type)
+        with self.metrics.stage('rewrite'):
+            return paths, signature, self.rewriter.loads(hraw), self.rewriter.rewrite_bytes(draw)
+
+    def cached_response(self, url, context='api.github.com', session=None):
+        '''Pre-serialized (headers, body) for a fixture without deltas
+
+        Returns None whenever the object path has to be used instead: the
+        cache is off, the url is graphql or a synthesized page, the fixture
+        is missing (a list query may still be answered locally) or there are
+        local changes to merge in.
+        '''
+        if not self.usecache or url.split('/')[-1] == 'graphql':
+            return None
+        if self.is_collection(url, context=context):
+            return None
+        if self.has_changes(context, url, session=session):
+            return None
+
+        key = self.fixture_location(url, context=context)
+        cached = self.response_cache.get(
+            key,
+            validator=lambda x: fixture_signature(x[0]) == x[1]
+        )
+        if cached is not None:
+            if self.is_stale(url, cached[0]):
+                return None
+            return cached[2], cached[3]
+
+        try:
+            paths, signature, headers, body = self.load_fixture_raw(*key)
+        except RequestNotCachedException:
+            return None
+        if self.is_stale(url, paths):
+            return None
+        headers = filter_response_headers(headers)
+        self.response_cache.put(
+            key,
+            (paths, signature, headers, body),
+            size=len(body)
+        )
+        return headers, body
+
+    def served_path(self, directory, fixture_type):
+        '''Where the url-rewritten gzip body for the current BASEURL lives'''
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', self.BASEURL)
+        return os.path.join(
+            self.fixturedir,
+            '.served',
+            slug,
+            relative_dir(self.fixturedir, directory),
+            '%s.json.gz' % fixture_type
+        )
+
+    def served_body(self, raw):
+        '''The url-rewritten, compressed body gzip passthrough sends'''
+        return self.served_codec.compress(self.rewriter.rewrite_bytes(raw))
+
+    def write_served(self, directory, fixture_type, raw):
+        body = self.served_body(raw)
+        atomic_write(self.served_path(directory, fixture_type), body)
+        return body
+
+    def read_fixture_headers(self, directory, fixture_type):
+        '''(paths, signature, headers) of a fixture without reading its data'''
+        if self.in_archive(directory, fixture_type):
+            raw = self.archive.raw(relative_dir(self.fixturedir, directory), fixture_type)
+            if raw is not None:
+                hraw = zlib.decompress(raw[0], 16 + zlib.MAX_WBITS)
+                raw[0].release()
+                raw[1].release()
+                return (), fixture_signature(()), self.codec.loads(hraw)
+        paths = self.find_fixture(directory, fixture_type)
+        signature = fixture_signature(paths)
+        try:
+            hraw = self.blobs.read_file(paths[0])
+        except FileNotFoundError:
+            raise RequestNotCachedException
+        return paths, signature, self.codec.loads(hraw)
+
+    def cached_gzip_response(self, url, context='api.github.com', session=None):
+        '''(headers, gzip body) for a fixture without deltas, or None
+
+        The body is the url-rewritten fixture compressed at record time, or
+        on first use for fixtures recorded before, and is sent to clients
+        as-is.
+        '''
+        if not self.usecache or url.split('/')[-1] == 'graphql':
+            return None
+        if self.is_collection(url, context=context):
+            return None
+        if self.has_changes(context, url, session=session):
+            return None
+
+        fixdir, dtype = self.fixture_location(url, context=context)
+        key = (fixdir, dtype, 'gzip')
+        cached = self.response_cache.get(
+            key,
+            validator=lambda x: fixture_signature(x[0]) == x[1]
+        )
+        if cached is not None:
+            if self.is_stale(url, cached[0]):
+                return None
+            return cached[2], cached[3]
+
+        try:
+            paths, signature, headers = self.read_fixture_headers(fixdir, dtype)
+        except RequestNotCachedException:
+            return None
+        if self.is_stale(url, paths):
+            return None
+        if paths:
+            source_mtime = os.stat(paths[1]).st_mtime
+        else:
+            source_mtime = os.stat(self.archive.path).st_mtime
+
+        spath = self.served_path(fixdir, dtype)
+        try:
+            fresh = os.stat(spath).st_mtime >= source_mtime
+        except OSError:
+            fresh = False
+        if fresh:
+            with open(spath, 'rb') as f:
+                body = f.read()
+        else:
+            body = self.served_body(self.read_fixture_bytes(fixdir, dtype)[2])
+            try:
+                atomic_write(spath, body)
+            except OSError as e:
+                # a read-only fixturedir, the response cache keeps the body
+                logger.debug('not storing %s: %s' % (spath, e))
+
+        headers = filter_response_headers(headers)
+        self.response_cache.put(
+            key,
+            (paths, signature, headers, body),
+            size=len(body)
+        )
+        return headers, body
+
+    def fixture_hash(self, directory, fixture_type):
+        '''(paths, md5 of the stored data) without decompressing it'''
+        key = (directory, fixture_type)
+        cached = self.hash_cache.get(
+            key,
+            validator=lambda x: fixture_signature(x[0]) == x[1]
+        )
+        if cached is not None:
+            return cached[0], cached[2]
+
+        m = hashlib.md5()
+        paths = ()
+        signature = fixture_signature(paths)
+        raw = None
+        if self.in_archive(directory, fixture_type):
+            raw = self.archive.raw(relative_dir(self.fixturedir, directory), fixture_type)
+        if raw is not None:
+            m.update(raw[1])
+            raw[0].release()
+            raw[1].release()
         else:
-            logger.debug('read %s' % hfn)
-            with open(hfn, 'r') as f:
-                headers = json.load(f.read())
-
-        dfn = os.path.join(directory, '%s.json' % fixture_type)
-        if not os.path.exists(dfn):
-            dfn += '.gz'
-            if not os.path.exists(dfn):
+            paths = self.find_fixture(directory, fixture_type)
+            signature = fixture_signature(paths)
+            try:
+                with open(paths[1], 'rb') as f:
+                    m.update(f.read())
+            except FileNotFoundError:
                 raise RequestNotCachedException
-            logger.debug('read %s' % dfn)
-            data = read_gzip_json(dfn)
+        digest = m.hexdigest()
+        self.hash_cache.put(key, (paths, signature, digest), size=1)
+        return paths, digest
+
+    def get_validators(self, url, context='api.github.com', session=None):
+        '''(etag, last modified timestamp) of what a GET on url returns
+
+        The etag covers the stored fixture, the session and a hash of the
+        local events merged into it and the baseurl its urls get rewritten
+        to, so any change to one of them changes it. None if url is not
+        served from a fixture.
+        '''
+        if not self.usecache or url.split('/')[-1] == 'graphql':
+            return None
+        paths = None
+        page = ''
+        if self.is_collection(url, context=context):
+            # a synthesized page is the collection plus where it is cut
+            try:
+                paths, digest = self.fixture_hash(*self.collection_location(url, context=context))
+                page = '%s/%s' % get_page_params(url)
+            except RequestNotCachedException:
+                pass
+        if paths is None:
+            try:
+                paths, digest = self.fixture_hash(*self.fixture_location(url, context=context))
+            except RequestNotCachedException:
+                return None
+        if self.is_stale(url, paths):
+            return None
+
+        if paths:
+            last_modified = os.stat(paths[1]).st_mtime
         else:
-            logger.debug('read %s' % dfn)
-            with open(dfn, 'r') as f:
-                data = json.load(f.read())
+            last_modified = os.stat(self.archive.path).st_mtime
+
+        version = 0
+        ddir = self.get_delta_dir(context, url, session=session)
+        if ddir is not None and self.deltas.exists(ddir):
+            version = self.deltas.digest(ddir)
+            for fn in os.listdir(ddir):
+                if fn.startswith('events.json'):
+                    last_modified = max(last_modified, os.stat(os.path.join(ddir, fn)).st_mtime)
+
+        m = hashlib.md5()
+        m.update(('%s:%s:%s:%s:%s' % (digest, page, session or '', version, self.BASEURL)).encode('utf-8'))
+        return m.hexdigest(), last_modified
+
+    def cache_stats(self):
+        return {
+            'fixtures': self.fixture_cache.stats(),
+            'responses': self.response_cache.stats(),
+            'graphql': self.graphql_cache.stats(),
+            'upstream': self.inflight.stats(),
+            'revalidations': self.revalidation_stats(),
+        }
 
-        return headers, data
+    def revalidation_stats(self):
+        with self.revalidations_lock:
+            return dict(self.revalidations)
 
     def write_fixture(self, directory, fixture_type, data, headers, compress=False):
-
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-
-        if compress:
-            hfn = os.path.join(directory, '%s.headers.json.gz' % fixture_type)
-            write_gzip_json(hfn, headers)
-            dfn = os.path.join(directory, '%s.json.gz' % fixture_type)
-            write_gzip_json(dfn, data)
-        else:
-            with open(os.path.join(directory, '%s.json' % fixture_type), 'w') as f:
-                f.write(json.dumps(data, indent=2, sort_keys=True))
-            with open(os.path.join(directory, '%s.headers.json' % fixture_type), 'w') as f:
-                f.write(json.dumps(headers, indent=2, sort_keys=True))
+        '''Atomically (re)write a fixture, safe against concurrent writers'''
+
+        os.makedirs(directory, exist_ok=True)
+
+        with self.fixture_locks((directory, fixture_type)):
+            codec = self.codec
+            if self.dedup:
+                hfn = os.path.join(directory, '%s.headers.json%s' % (fixture_type, REF_SUFFIX))
+                dfn = os.path.join(directory, '%s.json%s' % (fixture_type, REF_SUFFIX))
+                raw = codec.dumps(data)
+                self.blobs.write_ref(dfn, raw)
+                self.blobs.write_ref(hfn, codec.dumps(stable_headers(headers)))
+            elif compress:
+                suffix = codec.suffix
+                hfn = os.path.join(directory, '%s.headers.json%s' % (fixture_type, suffix))
+                write_gzip_json(hfn, headers, codec=codec)
+                dfn = os.path.join(directory, '%s.json%s' % (fixture_type, suffix))
+                raw = codec.dumps(data)
+                atomic_write(dfn, codec.compress(raw))
+            else:
+                hfn = os.path.join(directory, '%s.headers.json' % fixture_type)
+                dfn = os.path.join(directory, '%s.json' % fixture_type)
+                raw = codec.dumps_pretty(data)
+                atomic_write(dfn, raw)
+                atomic_write(hfn, codec.dumps_pretty(headers))
+
+            # refs and plain files must not shadow whichever was written last
+            for fn, name in [(hfn, '.headers.json'), (dfn, '.json')]:
+                base = os.path.join(directory, fixture_type + name)
+                stale = [base, base + '.gz'] if self.dedup else [base + REF_SUFFIX]
+                for variant in stale:
+                    if variant != fn and os.path.exists(variant):
+                        os.remove(variant)
+
+            # rewrite and compress once at record time instead of per request
+            if self.gzip_passthrough:
+                self.write_served(directory, fixture_type, raw)
+
+            self.fixture_cache.invalidate((directory, fixture_type))
+            self.response_cache.invalidate((directory, fixture_type))
+            self.response_cache.invalidate((directory, fixture_type, 'gzip'))
+            self.fixture_generation += 1
+
+        if self.index is not None:
+            self.index.add(directory, fixture_type, (hfn, dfn))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+
+import gzip
+import hashlib
+import threading
+
+from logzero import logger
+
+from github_test_proxy.codec import DEFAULT_CODEC
+from github_test_proxy.locking import atomic_write
+from github_test_proxy.rewrite import UrlRewriter
+
+
+CASSETTE_VERSION = 1
+
+# response headers worth replaying, the server adds the rest
+KEEP_HEADERS = ['Content-Type', 'Content-Encoding', 'ETag', 'Last-Modified', 'Link', 'Vary']
+
+
+def body_hash(data):
+    if not data:
+        return ''
+    return hashlib.md5(data).hexdigest()
+
+
+def interaction_key(method, path, data):
+    return (method.upper(), path, body_hash(data))
+
+
+class CassetteRecorder:
+
+    '''Collects the ordered request/response stream of a session
+
+    Writes change the responses that follow them, so every interaction is
+    kept in order, including the responses to POST/DELETE requests.
+    '''
+
+    def __init__(self, path, baseurl, codec=DEFAULT_CODEC):
+        self.path = path
+        self.baseurl = baseurl
+        self.codec = codec
+        self.interactions = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.interactions)
+
+    def record(self, method, path, data, status, headers, body):
+        headers = [(k, v) for k, v in headers if k in KEEP_HEADERS or k.startswith('X-')]
+        interaction = {
+            'method': method.upper(),
+            'path': path,
+            'body_hash': body_hash(data),
+            'status': status,
+            'headers': headers,
+            'body': body.decode('utf-8'),
+        }
+        with self._lock:
+            self.interactions.append(interaction)
+
+    def save(self):
+        with self._lock:
+            cassette = {
+                'version': CASSETTE_VERSION,
+                'baseurl': self.baseurl,
+                'interactions': list(self.interactions),
+            }
+        atomic_write(self.path, gzip.compress(self.codec.dumps(cassette), mtime=0))
+        logger.info('recorded %s interactions into %s' % (len(cassette['interactions']), self.path))
+
+
+class Track:
+
+    '''The recorded responses to one request, replayed in order'''
+
+    def __init__(self):
+        self.responses = []
+        self.cursor = 0
+
+    def next(self):
+        response = self.responses[min(self.cursor, len(self.responses) - 1)]
+        self.cursor += 1
+        return response
+
+
+class CassettePlayer:
+
+    '''Serves a recorded session from memory
+
+    The cassette is read, parsed and url-rewritten once at startup. A
+    lookup is a dict access on (method, path, body hash), and the nth
+    identical request gets the nth recorded response, so state changes
+    replay in order. Once a track runs out its last response is repeated.
+    '''
+
+    def __init__(self, path, baseurl, codec=DEFAULT_CODEC):
+        self.path = path
+        self.baseurl = baseurl
+        self.tracks = {}
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        with open(path, 'rb') as f:
+            raw = f.read()
+        if raw[:2] == b'\x1f\x8b':
+            raw = gzip.decompress(raw)
+        cassette = codec.loads(raw)
+        if cassette.get('version') != CASSETTE_VERSION:
+            raise Exception('%s has unsupported cassette version %s' % (path, cassette.get('version')))
+
+        rewriter = None
+        if cassette['baseurl'] != baseurl:
+            rewriter = UrlRewriter([cassette['baseurl']], baseurl)
+        for interaction in cassette['interactions']:
+            body = interaction['body'].encode('utf-8')
+            if rewriter is not None:
+                body = rewriter.rewrite_bytes(body)
+            headers = [tuple(x) for x in interaction['headers']]
+            if rewriter is not None:
+                headers = [(k, rewriter.rewrite_text(v)) for k, v in headers]
+            key = (interaction['method'], interaction['path'], interaction['body_hash'])
+            track = self.tracks.get(key)
+            if track is None:
+                track = self.tracks[key] = Track()
+            track.responses.append((interaction['status'], headers, body))
+        logger.info('loaded %s interactions for %s requests from %s' % (
+            len(cassette['interactions']), len(self.tracks), path))
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def play(self, method, path, data):
+        '''(status, headers, body) for a request, or None if never recorded'''
+        track = self.tracks.get(interaction_key(method, path, data))
+        if track is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            return track.next()
+
+    def rewind(self):
+        with self._lock:
+            for track in self.tracks.values():
+                track.cursor = 0
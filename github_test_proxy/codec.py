@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+
+import gzip
+import json
+import os
+import time
+import zlib
+
+from github_test_proxy.blobs import BlobStore
+from github_test_proxy.blobs import decompress_file
+from github_test_proxy.index import split_fixture_name
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# fastest first, 'auto' picks the first one installed
+JSON_BACKENDS = ['orjson', 'ujson', 'json']
+COMPRESSIONS = ['gzip', 'none']
+
+
+class JsonBackend:
+
+    '''loads/dumps for one json library, always producing utf-8 bytes
+
+    dumps() is compact and dumps_pretty() matches the indented, sorted
+    layout of uncompressed fixtures. Anything the fast libraries refuse
+    to encode (ints wider than 64 bits, odd key types) goes through the
+    stdlib instead.
+    '''
+
+    def __init__(self, name='auto'):
+        if name == 'auto':
+            name = [x for x in JSON_BACKENDS if available(x)][0]
+        if name not in JSON_BACKENDS:
+            raise ValueError('unknown json backend %s' % name)
+        if not available(name):
+            raise ValueError('json backend %s is not installed' % name)
+        self.name = name
+
+        if name == 'orjson':
+            self.loads = orjson.loads
+            self._dumps = orjson.dumps
+            self._dumps_pretty = lambda x: orjson.dumps(
+                x, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+            )
+        elif name == 'ujson':
+            # ujson escapes slashes by default which hides urls from the rewriter
+            self.loads = ujson.loads
+            self._dumps = lambda x: ujson.dumps(
+                x, escape_forward_slashes=False, ensure_ascii=False
+            ).encode('utf-8')
+            self._dumps_pretty = lambda x: ujson.dumps(
+                x, escape_forward_slashes=False, ensure_ascii=False,
+                indent=2, sort_keys=True
+            ).encode('utf-8')
+        else:
+            self.loads = json.loads
+            self._dumps = stdlib_dumps
+            self._dumps_pretty = stdlib_dumps_pretty
+
+    def dumps(self, data):
+        try:
+            return self._dumps(data)
+        except (TypeError, OverflowError):
+            return stdlib_dumps(data)
+
+    def dumps_pretty(self, data):
+        try:
+            return self._dumps_pretty(data)
+        except (TypeError, OverflowError):
+            return stdlib_dumps_pretty(data)
+
+
+def stdlib_dumps(data):
+    return json.dumps(data).encode('utf-8')
+
+
+def stdlib_dumps_pretty(data):
+    return json.dumps(data, indent=2, sort_keys=True).encode('utf-8')
+
+
+def available(name):
+    if name == 'orjson':
+        return orjson is not None
+    if name == 'ujson':
+        return ujson is not None
+    return name == 'json'
+
+
+class Codec:
+
+    '''JSON backend plus compression settings for one fixture store
+
+    compression is 'gzip' at the given level, or 'none' to store plain
+    json even where the caller asked for a compressed fixture.
+    '''
+
+    def __init__(self, json_backend='auto', compression='gzip', level=6):
+        if compression not in COMPRESSIONS:
+            raise ValueError('unknown compression %s' % compression)
+        self.json = JsonBackend(json_backend)
+        self.compression = compression
+        self.level = level
+
+    def __repr__(self):
+        return 'Codec(%s, %s, %s)' % (self.json.name, self.compression, self.level)
+
+    @property
+    def suffix(self):
+        return '.gz' if self.compression == 'gzip' else ''
+
+    def loads(self, raw):
+        return self.json.loads(raw)
+
+    def dumps(self, data):
+        return self.json.dumps(data)
+
+    def dumps_pretty(self, data):
+        return self.json.dumps_pretty(data)
+
+    def compress(self, raw):
+        if self.compression == 'gzip':
+            # a fixed mtime keeps identical fixtures byte-identical
+            return gzip.compress(raw, compresslevel=self.level, mtime=0)
+        return raw
+
+    def decompress(self, raw):
+        if self.compression == 'gzip':
+            return zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+        return raw
+
+    def read_file(self, path):
+        '''Uncompressed contents of a fixture file, whatever it was stored with'''
+        with open(path, 'rb') as f:
+            return decompress_file(path, f.read())
+
+
+DEFAULT_CODEC = Codec()
+
+
+def sample_fixtures(fixturedir, limit=200):
+    '''Uncompressed data bytes of up to limit fixtures under fixturedir'''
+    samples = []
+    blobs = BlobStore(fixturedir)
+    for dirpath, dirnames, filenames in os.walk(fixturedir):
+        dirnames[:] = sorted(x for x in dirnames if not x.startswith('.'))
+        for fn in sorted(filenames):
+            parts = split_fixture_name(fn)
+            if parts is None or parts[1] != 'data':
+                continue
+            samples.append(blobs.read_file(os.path.join(dirpath, fn)))
+            if len(samples) >= limit:
+                return samples
+    return samples
+
+
+def throughput(nbytes, seconds):
+    '''MB/s'''
+    return round(nbytes / (1024 * 1024) / max(seconds, 1e-9), 2)
+
+
+def benchmark_codecs(fixturedir, limit=200, levels=(1, 6, 9), rounds=3):
+    '''Encode/decode throughput and on-disk size for a real fixture set'''
+    samples = sample_fixtures(fixturedir, limit=limit)
+    objects = [json.loads(x) for x in samples]
+    nbytes = sum(len(x) for x in samples)
+    report = {
+        'fixturedir': fixturedir,
+        'fixtures': len(samples),
+        'bytes': nbytes,
+        'json': [],
+        'compression': [],
+    }
+    if not samples:
+        return report
+
+    for name in JSON_BACKENDS:
+        if not available(name):
+            continue
+        backend = JsonBackend(name)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for raw in samples:
+                backend.loads(raw)
+        decode = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(rounds):
+            encoded = [backend.dumps(x) for x in objects]
+        encode = time.perf_counter() - start
+        report['json'].append({
+            'backend': name,
+            'decode_mb_s': throughput(nbytes * rounds, decode),
+            'encode_mb_s': throughput(nbytes * rounds, encode),
+            'encoded_bytes': sum(len(x) for x in encoded),
+        })
+
+    settings = [('none', 0)] + [('gzip', x) for x in levels]
+    for compression, level in settings:
+        codec = Codec(json_backend='json', compression=compression, level=level)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            compressed = [codec.compress(x) for x in samples]
+        compress = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for raw in compressed:
+                codec.decompress(raw)
+        decompress = time.perf_counter() - start
+        size = sum(len(x) for x in compressed)
+        report['compression'].append({
+            'compression': compression,
+            'level': level,
+            'bytes': size,
+            'ratio': round(size / nbytes, 3),
+            'compress_mb_s': throughput(nbytes * rounds, compress),
+            'decompress_mb_s': throughput(nbytes * rounds, decompress),
+        })
+
+    return report
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+
+import hashlib
+import os
+
+from logzero import logger
+
+from github_test_proxy.codec import DEFAULT_CODEC
+from github_test_proxy.locking import KeyedLocks
+from github_test_proxy.locking import atomic_write
+from github_test_proxy.locking import file_lock
+
+
+# compacted events, also the format older versions wrote on every change
+SNAPSHOT_NAME = 'events.json'
+# new events are appended here one json document per line
+LOG_NAME = 'events.jsonl'
+
+
+class IssueState:
+
+    '''Net effect of an issue's events, maintained one event at a time'''
+
+    def __init__(self, rewrite=None):
+        self.rewrite = rewrite
+        # label name -> present, in order of the last operation on it
+        self.labels = {}
+        self.comments = 0
+        self.updated_at = None
+        self.events = []
+        self.comment_events = []
+
+    def apply(self, events):
+        if self.rewrite is not None and events:
+            events = self.rewrite(events)
+        for event in events:
+            self.events.append(event)
+            self.updated_at = event.get('created_at', self.updated_at)
+            if event.get('event') in ['labeled', 'unlabeled']:
+                name = event['label']['name']
+                self.labels.pop(name, None)
+                self.labels[name] = event['event'] == 'labeled'
+            elif event.get('event') == 'commented':
+                self.comments += 1
+                self.comment_events.append(event)
+
+    def merge_labels(self, labels):
+        '''Apply the net label changes to a list of label dicts'''
+        if not self.labels:
+            return labels
+        result = [x for x in labels if self.labels.get(x['name'], True)]
+        names = set(x['name'] for x in result)
+        for name, present in self.labels.items():
+            if present and name not in names:
+                result.append({'name': name})
+        return result
+
+
+class DeltaLog:
+
+    '''Parsed state of one resource's snapshot and log'''
+
+    def __init__(self):
+        self.snapshot_signature = None
+        self.snapshot = []
+        self.log_inode = None
+        self.log_offset = 0
+        self.log = []
+        self.issue = None
+        self.applied = 0
+        # md5 of the snapshot and running md5 of the parsed log lines
+        self.snapshot_digest = ''
+        self.log_digest = hashlib.md5()
+
+
+class DeltaStore:
+
+    '''Append-only per-resource event logs with incremental reads
+
+    Each resource directory holds a snapshot (events.json) and a json-lines
+    log (events.jsonl). Writers only ever append to the log. Readers keep
+    the byte offset they have parsed up to and only read what was appended
+    since, so a resource with n events costs O(new events) per read instead
+    of O(n).
+
+    Each resource is guarded by its own thread lock plus an flock on the
+    resource directory, so appends from several threads or worker
+    processes never interleave and compaction never runs under a reader.
+    '''
+
+    def __init__(self, rewrite=None, codec=None):
+        # applied to events before they are materialized into IssueState
+        self.rewrite = rewrite
+        self.codec = codec or DEFAULT_CODEC
+        self._logs = {}
+        self._locks = KeyedLocks()
+
+    def exists(self, directory):
+        return os.path.exists(os.path.join(directory, LOG_NAME)) or \
+            os.path.exists(os.path.join(directory, SNAPSHOT_NAME))
+
+    def append(self, directory, events):
+        '''Append events to the resource's log'''
+        if not events:
+            return
+        os.makedirs(directory, exist_ok=True)
+        lines = b''.join(self.codec.dumps(x) + b'\n' for x in events)
+        with self._locks(directory), file_lock(directory):
+            with open(os.path.join(directory, LOG_NAME), 'ab') as f:
+                f.write(lines)
+
+    def _refresh(self, directory):
+        state = self._logs.get(directory)
+        if state is None:
+            state = DeltaLog()
+            self._logs[directory] = state
+        changed = self._refresh_snapshot(directory, state)
+        changed = self._refresh_log(directory, state) or changed
+        if state.snapshot_signature is None and state.log_inode is None:
+            # removed, possibly by a session discard in another worker,
+            # do not keep state around for it
+            self._logs.pop(directory, None)
+        if state.issue is None or changed:
+            state.issue = IssueState(rewrite=self.rewrite)
+            state.issue.apply(state.snapshot)
+            state.applied = 0
+        if state.applied < len(state.log):
+            state.issue.apply(state.log[state.applied:])
+            state.applied = len(state.log)
+        return state
+
+    def read(self, directory):
+        '''All events for a resource, oldest first'''
+        with self._locks(directory), file_lock(directory, shared=True):
+            state = self._refresh(directory)
+            return state.snapshot + state.log
+
+    def issue_state(self, directory):
+        '''Materialized IssueState for a resource, shared and read-only'''
+        with self._locks(directory), file_lock(directory, shared=True):
+            return self._refresh(directory).issue
+
+    def version(self, directory):
+        '''Number of events recorded for a resource'''
+        with self._locks(directory), file_lock(directory, shared=True):
+            state = self._refresh(directory)
+            return len(state.snapshot) + len(state.log)
+
+    def digest(self, directory):
+        '''Hash of every event recorded for a resource
+
+        Unlike version it tells apart different events of the same count,
+        as when a discarded session or wiped deltadir is written again.
+        '''
+        with self._locks(directory), file_lock(directory, shared=True):
+            state = self._refresh(directory)
+            return '%s:%s' % (state.snapshot_digest, state.log_digest.hexdigest())
+
+    def _refresh_snapshot(self, directory, state):
+        sfile = os.path.join(directory, SNAPSHOT_NAME)
+        try:
+            st = os.stat(sfile)
+            signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            signature = None
+        if signature == state.snapshot_signature:
+            return False
+        state.snapshot_signature = signature
+        state.snapshot = []
+        state.snapshot_digest = ''
+        if signature is not None:
+            with open(sfile, 'rb') as f:
+                raw = f.read()
+            state.snapshot = self.codec.loads(raw)
+            state.snapshot_digest = hashlib.md5(raw).hexdigest()
+        return True
+
+    def _refresh_log(self, directory, state):
+        lfile = os.path.join(directory, LOG_NAME)
+        try:
+            st = os.stat(lfile)
+        except OSError:
+            reset = bool(state.log)
+            state.log_inode = None
+            state.log_offset = 0
+            state.log = []
+            state.log_digest = hashlib.md5()
+            return reset
+
+        # replaced or truncated by a compaction, start over
+        reset = False
+        if st.st_ino != state.log_inode or st.st_size < state.log_offset:
+            reset = bool(state.log)
+            state.log_inode = st.st_ino
+            state.log_offset = 0
+            state.log = []
+            state.log_digest = hashlib.md5()
+        if st.st_size == state.log_offset:
+            return reset
+
+        with open(lfile, 'rb') as f:
+            f.seek(state.log_offset)
+            chunk = f.read(st.st_size - state.log_offset)
+        # a partially written trailing line is picked up on the next read
+        end = chunk.rfind(b'\n') + 1
+        state.log_digest.update(chunk[:end])
+        for line in chunk[:end].splitlines():
+            if line.strip():
+                state.log.append(self.codec.loads(line))
+        state.log_offset += end
+        return reset
+
+    def forget(self, root):
+        '''Drop the parsed state of every resource under root
+
+        Only this process's state; other workers drop theirs the next
+        time they read one of the removed resources.
+        '''
+        root = root.rstrip('/') + '/'
+        for directory in list(self._logs.keys()):
+            if (directory + '/').startswith(root):
+                self._logs.pop(directory, None)
+
+    def compact(self, directory):
+        '''Fold the log into the snapshot and start a fresh log'''
+        with self._locks(directory), file_lock(directory):
+            state = self._refresh(directory)
+            events = state.snapshot + state.log
+            lfile = os.path.join(directory, LOG_NAME)
+            if not os.path.exists(lfile):
+                return len(events)
+            sfile = os.path.join(directory, SNAPSHOT_NAME)
+            atomic_write(sfile, self.codec.dumps_pretty(events))
+            os.remove(lfile)
+            self._logs.pop(directory, None)
+            return len(events)
+
+    def compact_all(self, deltadir):
+        '''Compact every resource log under deltadir'''
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(deltadir):
+            if LOG_NAME in filenames:
+                nevents = self.compact(dirpath)
+                logger.info('compacted %s events in %s' % (nevents, dirpath))
+                count += 1
+        return count
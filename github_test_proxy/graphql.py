@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+
+import hashlib
+import json
+import re
+
+
+# strings (block strings first), comments, ignored runs, punctuators, the rest
+TOKEN_RE = re.compile(
+    r'"""(?:\\"""|[^"]|"(?!""))*"""'
+    r'|"(?:\\.|[^"\\\n])*"'
+    r'|#[^\n]*'
+    r'|[\s,]+'
+    r'|\.\.\.|[!$&()\[\]{}:=@|]'
+    r'|[^\s,"#!$&()\[\]{}:=@|]+'
+)
+PUNCTUATORS = set(['!', '$', '&', '(', ')', '[', ']', '{', '}', ':', '=', '@', '|', '...'])
+OPERATIONS = ['query', 'mutation', 'subscription']
+
+
+def tokens(query):
+    '''Significant tokens of a graphql document'''
+    for token in TOKEN_RE.findall(query):
+        if token[0] == '#' or not token.strip(' \t\r\n,'):
+            continue
+        yield token
+
+
+def canonical_query(query):
+    '''The query with comments dropped and insignificant whitespace and
+    commas collapsed, leaving string literals untouched'''
+    out = []
+    previous = None
+    for token in tokens(query):
+        if previous is not None and previous not in PUNCTUATORS and token not in PUNCTUATORS:
+            out.append(' ')
+        out.append(token)
+        previous = token
+    return ''.join(out)
+
+
+def operations(query):
+    '''(type, name) of each operation defined in a query, fragments aside'''
+    found = []
+    depth = 0
+    parens = 0
+    # inside an operation or fragment header, before its selection set
+    header = None
+    for token in tokens(query):
+        if token == '(':
+            parens += 1
+        elif token == ')':
+            parens -= 1
+        elif parens:
+            continue
+        elif token == '{':
+            if depth == 0:
+                if header is None:
+                    found.append(('query', None))
+                header = None
+            depth += 1
+        elif token == '}':
+            depth -= 1
+        elif depth == 0:
+            if header is None and token in OPERATIONS + ['fragment']:
+                header = [token, None]
+                found.append(header)
+            elif header is not None and header[1] is None and token not in PUNCTUATORS:
+                header[1] = token
+    return [tuple(x) for x in found if x[0] != 'fragment']
+
+
+def parse_body(data):
+    '''The json body of a graphql request, or None'''
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+    try:
+        body = json.loads(data)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(body, dict) or not isinstance(body.get('query'), str):
+        return None
+    return body
+
+
+def canonical_body(body):
+    '''Canonical json of a parsed graphql request
+
+    Whitespace and comments in the query do not matter, variables are
+    sorted, and operationName is dropped when the document only has one
+    operation to choose from.
+    '''
+    query = canonical_query(body['query'])
+    variables = body.get('variables') or {}
+    if isinstance(variables, str):
+        try:
+            variables = json.loads(variables)
+        except ValueError:
+            pass
+    canonical = {'query': query, 'variables': variables}
+    if body.get('operationName') and len(operations(query)) > 1:
+        canonical['operationName'] = body['operationName']
+    return json.dumps(canonical, sort_keys=True, separators=(',', ':'))
+
+
+def is_mutation(body):
+    '''Does the operation the request runs change anything upstream'''
+    ops = operations(canonical_query(body['query']))
+    name = body.get('operationName')
+    if name:
+        ops = [x for x in ops if x[1] == name] or ops
+    return any(x[0] != 'query' for x in ops)
+
+
+def legacy_key(data):
+    '''md5 of the raw body, what fixtures were keyed on before'''
+    m = hashlib.md5()
+    m.update(data or b'')
+    return m.hexdigest()
+
+
+def query_key(data):
+    '''Fixture key for a graphql request body
+
+    md5 of the canonical body, or of the raw body if it is not a graphql
+    json document.
+    '''
+    body = parse_body(data)
+    if body is None:
+        return legacy_key(data)
+    return body_key(body)
+
+
+def body_key(body):
+    '''Fixture key for an already parsed graphql request'''
+    m = hashlib.md5()
+    m.update(canonical_body(body).encode('utf-8'))
+    return m.hexdigest()
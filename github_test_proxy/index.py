@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+
+import gzip
+import json
+import os
+import threading
+
+from logzero import logger
+
+from github_test_proxy.locking import file_lock
+
+
+INDEX_VERSION = 1
+
+# suffixes a fixture file can have, in the order read_fixture prefers them,
+# .ref files point into the blob store
+HEADER_SUFFIXES = ['.headers.json', '.headers.json.gz', '.headers.json.ref']
+DATA_SUFFIXES = ['.json', '.json.gz', '.json.ref']
+
+
+def relative_dir(root, directory):
+    '''directory relative to root without touching the filesystem'''
+    root = root.rstrip('/')
+    directory = directory.rstrip('/')
+    if directory == root:
+        return ''
+    if directory.startswith(root + '/'):
+        return directory[len(root) + 1:]
+    return os.path.relpath(directory, root)
+
+
+def split_fixture_name(filename):
+    '''Return (fixture_type, kind, suffix) for a fixture filename or None'''
+    for suffix in HEADER_SUFFIXES:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)], 'headers', suffix
+    for suffix in DATA_SUFFIXES:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)], 'data', suffix
+    return None
+
+
+class FixtureIndex:
+
+    '''In-memory map of every fixture under a fixturedir
+
+    The index is built once by walking the tree and persisted as a gzipped
+    snapshot plus an append-only journal of entries added since, so a
+    restart only has to read two files instead of stat'ing the tree.
+    '''
+
+    snapshot_name = '.fixture-index.json.gz'
+    journal_name = '.fixture-index.log'
+
+    def __init__(self, fixturedir):
+        self.fixturedir = fixturedir.rstrip('/')
+        # reldir -> {fixture_type: (header_suffix, data_suffix)}
+        self.dirs = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return sum(len(x) for x in self.dirs.values())
+
+    @property
+    def snapshot_file(self):
+        return os.path.join(self.fixturedir, self.snapshot_name)
+
+    @property
+    def journal_file(self):
+        return os.path.join(self.fixturedir, self.journal_name)
+
+    def relative(self, directory):
+        return relative_dir(self.fixturedir, directory)
+
+    def build(self):
+        '''Walk the fixturedir and index every complete fixture'''
+        dirs = {}
+        for dirpath, dirnames, filenames in os.walk(self.fixturedir):
+            dirnames[:] = [x for x in dirnames if not x.startswith('.')]
+            found = {}
+            for fn in filenames:
+                if fn.startswith('.'):
+                    continue
+                parts = split_fixture_name(fn)
+                if parts is None:
+                    continue
+                fixture_type, kind, suffix = parts
+                found.setdefault(fixture_type, {})
+                # prefer the uncompressed file like read_fixture does
+                if kind not in found[fixture_type] or not suffix.endswith('.gz'):
+                    found[fixture_type][kind] = suffix
+            entries = {}
+            for fixture_type, kinds in found.items():
+                if 'headers' in kinds and 'data' in kinds:
+                    entries[fixture_type] = (kinds['headers'], kinds['data'])
+            if entries:
+                dirs[self.relative(dirpath)] = entries
+        with self._lock:
+            self.dirs = dirs
+        logger.info('indexed %s fixtures in %s' % (len(self), self.fixturedir))
+
+    def load(self):
+        '''Load the persisted snapshot and journal, False if there is none'''
+        if not os.path.exists(self.snapshot_file):
+            return False
+        with gzip.open(self.snapshot_file, 'rb') as f:
+            snapshot = json.loads(f.read())
+        if snapshot.get('version') != INDEX_VERSION:
+            return False
+        dirs = {}
+        for reldir, entries in snapshot['dirs'].items():
+            dirs[reldir] = dict((k, tuple(v)) for k, v in entries.items())
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    reldir, fixture_type, hsuffix, dsuffix = json.loads(line)
+                    dirs.setdefault(reldir, {})[fixture_type] = (hsuffix, dsuffix)
+        with self._lock:
+            self.dirs = dirs
+        logger.info('loaded index of %s fixtures from %s' % (len(self), self.snapshot_file))
+        return True
+
+    def save(self):
+        '''Write a fresh snapshot and truncate the journal'''
+        if not os.path.exists(self.fixturedir):
+            os.makedirs(self.fixturedir)
+        with self._lock:
+            snapshot = {'version': INDEX_VERSION, 'dirs': self.dirs}
+            tmpfile = self.snapshot_file + '.tmp'
+            with gzip.open(tmpfile, 'wb') as f:
+                f.write(json.dumps(snapshot).encode('utf-8'))
+            os.rename(tmpfile, self.snapshot_file)
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+
+    def find(self, directory, fixture_type):
+        '''Full (headers, data) paths for a fixture, or None'''
+        entry = self.dirs.get(self.relative(directory), {}).get(fixture_type)
+        if entry is None:
+            return None
+        directory = directory.rstrip('/')
+        return (
+            '%s/%s%s' % (directory, fixture_type, entry[0]),
+            '%s/%s%s' % (directory, fixture_type, entry[1]),
+        )
+
+    def list(self, directory):
+        '''Fixture types stored in directory'''
+        return sorted(self.dirs.get(self.relative(directory), {}).keys())
+
+    def add(self, directory, fixture_type, paths):
+        '''Record a newly written fixture and journal it'''
+        hsuffix = paths[0][len(os.path.join(directory, fixture_type)):]
+        dsuffix = paths[1][len(os.path.join(directory, fixture_type)):]
+        reldir = self.relative(directory)
+        with self._lock:
+            current = self.dirs.get(reldir, {}).get(fixture_type)
+            if current == (hsuffix, dsuffix):
+                return
+            self.dirs.setdefault(reldir, {})[fixture_type] = (hsuffix, dsuffix)
+            if not os.path.exists(self.snapshot_file):
+                return
+            with file_lock(self.fixturedir):
+                with open(self.journal_file, 'a') as f:
+                    f.write(json.dumps([reldir, fixture_type, hsuffix, dsuffix]) + '\n')
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+
+import contextlib
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+LOCK_NAME = '.lock'
+
+
+def get_umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+# read once, setting the umask to read it is not thread safe
+UMASK = get_umask()
+
+
+class KeyedLocks:
+
+    '''One reentrant lock per resource key
+
+    Used as a context manager, ``with locks(key):``. A key's lock is
+    dropped once no thread holds or waits on it, so the table only ever
+    has the keys in use.
+    '''
+
+    def __init__(self):
+        # key -> [RLock, holders and waiters]
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._locks)
+
+    @contextlib.contextmanager
+    def __call__(self, key):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = [threading.RLock(), 0]
+                self._locks[key] = entry
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+def atomic_write(path, payload):
+    '''Write bytes to path via a temp file and rename so readers never
+    see a partially written file'''
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmpfile = tempfile.mkstemp(dir=directory, prefix='.tmp.')
+    try:
+        # mkstemp files are 0600, give them what open() would have
+        if hasattr(os, 'fchmod'):
+            os.fchmod(fd, 0o666 & ~UMASK)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+        os.replace(tmpfile, path)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+
+@contextlib.contextmanager
+def file_lock(directory, shared=False):
+    '''Cross-process flock on the directory's lock file
+
+    A no-op where fcntl is unavailable. Shared locks on a directory that
+    does not exist, or was removed while the lock was being taken, are
+    skipped since there is nothing to read; exclusive ones create it.
+    '''
+    if fcntl is None:
+        yield
+        return
+    fd = None
+    while fd is None:
+        try:
+            fd = os.open(os.path.join(directory, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            if shared:
+                break
+            os.makedirs(directory, exist_ok=True)
+    if fd is None:
+        yield
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+
+import os
+import threading
+
+from collections import OrderedDict
+
+
+def file_signature(*paths):
+    '''(mtime, size) for each path, or None if any of them is missing'''
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        signature.append((st.st_mtime_ns, st.st_size))
+    return tuple(signature)
+
+
+class LRUCache:
+
+    '''Bounded least-recently-used cache with entry and byte limits'''
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, key, validator=None):
+        '''Return the cached value or None, dropping it if validator rejects it'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            size, value = entry
+            if validator is not None and not validator(value):
+                del self._entries[key]
+                self._bytes -= size
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=0):
+        if not self.enabled or size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[0]
+            self._entries[key] = (size, value)
+            self._bytes += size
+            while self._entries and \
+                    (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (osize, _) = self._entries.popitem(last=False)
+                self._bytes -= osize
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[0]
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
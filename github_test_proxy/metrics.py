@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+
+import contextlib
+import threading
+import time
+
+
+# upper bounds in seconds, +Inf is implied
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def route_pattern(url, context='api.github.com'):
+    '''Coarse route a url is aggregated under'''
+    if context == 'api.shippable.com':
+        return 'shippable'
+    path = url.split('?', 1)[0].rstrip('/').split('/')
+    if path[-1] == 'graphql':
+        return 'graphql'
+    if 'labels' in path:
+        return 'labels'
+    if path[-1] in ['events', 'comments']:
+        return path[-1]
+    if path[-1].isdigit() and len(path) > 1:
+        if path[-2] == 'issues':
+            return 'issue'
+        if path[-2] == 'pulls':
+            return 'pull'
+    return 'other'
+
+
+class Histogram:
+
+    '''Cumulative-bucket histogram in the prometheus sense'''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        ix = 0
+        while ix < len(self.buckets) and seconds > self.buckets[ix]:
+            ix += 1
+        self.counts[ix] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            yield bound, total
+
+
+class RequestTimings:
+
+    '''Stage durations of the request being served by this thread'''
+
+    def __init__(self, route):
+        self.route = route
+        self.start = time.perf_counter()
+        self.elapsed = None
+        # stage -> seconds, in the order stages first ran
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self):
+        '''Server-Timing header value, durations in milliseconds'''
+        parts = ['%s;dur=%.3f' % (k, v * 1000) for k, v in self.stages.items()]
+        if self.elapsed is not None:
+            parts.append('total;dur=%.3f' % (self.elapsed * 1000))
+        return ', '.join(parts)
+
+
+class Metrics:
+
+    '''Per-route request and per-stage timing histograms
+
+    A request is started with begin() on the thread serving it. Code
+    anywhere below it times its stages with `with metrics.stage(name):`,
+    which is a no-op outside a request. finish() folds the stages into
+    the histograms that render() exposes in prometheus text format.
+    '''
+
+    prefix = 'github_test_proxy'
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.requests = {}
+        self.stages = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        return getattr(self._local, 'timings', None)
+
+    def begin(self, route):
+        timings = RequestTimings(route)
+        self._local.timings = timings
+        return timings
+
+    def discard(self):
+        self._local.timings = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        timings = getattr(self._local, 'timings', None)
+        if timings is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings.add(name, time.perf_counter() - start)
+
+    def finish(self):
+        '''Record the current request, returning its timings'''
+        timings = self.current
+        if timings is None:
+            return None
+        self._local.timings = None
+        timings.elapsed = time.perf_counter() - timings.start
+        with self._lock:
+            self._histogram(self.requests, (timings.route,)).observe(timings.elapsed)
+            for stage, seconds in timings.stages.items():
+                self._histogram(self.stages, (timings.route, stage)).observe(seconds)
+        return timings
+
+    def _histogram(self, family, key):
+        histogram = family.get(key)
+        if histogram is None:
+            histogram = Histogram(self.buckets)
+            family[key] = histogram
+        return histogram
+
+    def render(self):
+        lines = []
+        with self._lock:
+            self._render(
+                lines,
+                'request_seconds',
+                'Time spent serving proxied requests',
+                ('route',),
+                self.requests
+            )
+            self._render(
+                lines,
+                'stage_seconds',
+                'Time spent per request stage',
+                ('route', 'stage'),
+                self.stages
+            )
+        return '\n'.join(lines) + '\n'
+
+    def _render(self, lines, name, help, labelnames, family):
+        name = '%s_%s' % (self.prefix, name)
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s histogram' % name)
+        for key in sorted(family.keys()):
+            histogram = family[key]
+            labels = ','.join('%s="%s"' % x for x in zip(labelnames, key))
+            for bound, count in histogram.cumulative():
+                lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, bound, count))
+            lines.append('%s_sum{%s} %s' % (name, labels, histogram.sum))
+            lines.append('%s_count{%s} %s' % (name, labels, histogram.count))
+
+
+def render_counters(name, help, samples, prefix=Metrics.prefix):
+    '''Prometheus text for a counter family from {labels tuple: value}'''
+    name = '%s_%s' % (prefix, name)
+    lines = ['# HELP %s %s' % (name, help), '# TYPE %s counter' % name]
+    for labels, value in sorted(samples.items()):
+        labels = ','.join('%s="%s"' % x for x in labels)
+        lines.append('%s{%s} %s' % (name, labels, value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+
+import bisect
+import os
+import threading
+
+from urllib.parse import parse_qsl
+from urllib.parse import urlparse
+
+from logzero import logger
+
+from github_test_proxy.singleflight import SingleFlight
+
+
+LIST_KINDS = ['issues', 'pulls']
+
+# sort parameter -> item field, per list kind
+SORTS = {
+    'issues': {'created': 'created_at', 'updated': 'updated_at', 'comments': 'comments'},
+    'pulls': {'created': 'created_at', 'updated': 'updated_at'},
+}
+
+STATES = ['open', 'closed', 'all']
+
+
+def timestamp(value):
+    '''Comparable prefix of an iso8601 timestamp, github's or a delta's'''
+    return (value or '')[:19]
+
+
+def parse_list_url(url):
+    '''(org, repo, kind, params) of a repo issue or pull list url, or None'''
+    parts = urlparse(url)
+    path = parts.path.strip('/').split('/')
+    if len(path) != 4 or path[0] != 'repos' or path[3] not in LIST_KINDS:
+        return None
+    return path[1], path[2], path[3], parse_qsl(parts.query)
+
+
+class ListQuery:
+
+    '''The filters and order of one list request'''
+
+    def __init__(self, kind, state='open', labels=None, since=None, sort='created', direction=None):
+        self.kind = kind
+        self.state = state
+        self.labels = labels or []
+        self.since = since
+        self.sort = sort
+        if direction is None:
+            # pulls sort oldest first unless sorted by creation
+            direction = 'desc' if kind == 'issues' or sort == 'created' else 'asc'
+        self.direction = direction
+
+    @classmethod
+    def parse(cls, kind, params):
+        '''ListQuery for the query parameters, None if one of them can
+        not be evaluated locally'''
+        kwargs = {}
+        for k, v in params:
+            if k in ['page', 'per_page']:
+                continue
+            if k == 'state' and v in STATES:
+                kwargs['state'] = v
+            elif k == 'labels' and kind == 'issues':
+                kwargs['labels'] = [x.strip().lower() for x in v.split(',') if x.strip()]
+            elif k == 'since' and kind == 'issues':
+                kwargs['since'] = timestamp(v)
+            elif k == 'sort' and v in SORTS[kind]:
+                kwargs['sort'] = v
+            elif k == 'direction' and v in ['asc', 'desc']:
+                kwargs['direction'] = v
+            else:
+                return None
+        return cls(kind, **kwargs)
+
+    def matches(self, item):
+        if self.state != 'all' and item.get('state') != self.state:
+            return False
+        if self.labels:
+            names = set(x['name'].lower() for x in item.get('labels') or [])
+            if not all(x in names for x in self.labels):
+                return False
+        if self.since and timestamp(item.get('updated_at')) < self.since:
+            return False
+        return True
+
+    def order(self, items):
+        field = SORTS[self.kind][self.sort]
+
+        def key(item):
+            if field == 'comments':
+                return (item.get(field) or 0, item['number'])
+            return (timestamp(item.get(field)), item['number'])
+
+        return sorted(items, key=key, reverse=self.direction == 'desc')
+
+
+class ListIndex:
+
+    '''The issues or pulls of one repo indexed by number, state, label
+    and update time'''
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.items = {}
+        self.states = {}
+        self.labels = {}
+        # (updated_at, number) in ascending order
+        self.updated = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        '''Keep the most recently updated copy of every item'''
+        if not isinstance(item, dict) or not isinstance(item.get('number'), int):
+            return
+        current = self.items.get(item['number'])
+        if current is None or timestamp(item.get('updated_at')) >= timestamp(current.get('updated_at')):
+            self.items[item['number']] = item
+
+    def finish(self):
+        '''Build the secondary indexes once every item is in'''
+        for number, item in self.items.items():
+            self.states.setdefault(item.get('state'), set()).add(number)
+            for label in item.get('labels') or []:
+                self.labels.setdefault(label['name'].lower(), set()).add(number)
+            self.updated.append((timestamp(item.get('updated_at')), number))
+        self.updated.sort()
+
+    def candidates(self, query):
+        '''Numbers of the stored items matching query'''
+        sets = []
+        if query.state != 'all':
+            sets.append(self.states.get(query.state, set()))
+        for label in query.labels:
+            sets.append(self.labels.get(label, set()))
+        if query.since:
+            ix = bisect.bisect_left(self.updated, (query.since,))
+            sets.append(set(x[1] for x in self.updated[ix:]))
+        if not sets:
+            return set(self.items.keys())
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def evaluate(self, query, overlay=None):
+        '''Ordered items matching query, with overlay items (those with
+        local changes merged in) replacing the stored ones'''
+        overlay = overlay or {}
+        items = [self.items[x] for x in self.candidates(query) if x not in overlay]
+        items.extend(x for x in overlay.values() if query.matches(x))
+        return query.order(items)
+
+
+class QueryEngine:
+
+    '''Answers issue and pull list queries from what was recorded
+
+    Every issue and pull of a repo, from their own fixtures and from any
+    recorded list, goes into a ListIndex built on first use and kept
+    until a fixture is written. The delta log is applied per query for
+    the few items that have local changes, so filters on labels and
+    update time see them without rebuilding anything.
+    '''
+
+    def __init__(self, cacher):
+        self.cacher = cacher
+        # (org, repo, kind, baseurl) -> (fixture generation, ListIndex)
+        self.indexes = {}
+        self._lock = threading.Lock()
+        # concurrent builds of the same index, kept apart from the
+        # cacher's upstream call counters
+        self.builds = SingleFlight()
+
+    def repo_dir(self, org, repo):
+        return os.path.join(self.cacher.fixturedir, 'api.github.com', 'repos', org, repo)
+
+    def build(self, org, repo, kind):
+        index = ListIndex(kind)
+        rdir = self.repo_dir(org, repo)
+        # recorded lists first so the items' own fixtures win ties
+        for fixture_type in self.cacher.fixture_types(rdir):
+            if fixture_type.split('?')[0].split('@')[0] != kind:
+                continue
+            data = self.cacher.load_fixture_data(rdir, fixture_type)
+            if isinstance(data, list):
+                for item in data:
+                    index.add(item)
+        kdir = os.path.join(rdir, kind)
+        for fixture_type in self.cacher.fixture_types(kdir):
+            if fixture_type.isdigit():
+                index.add(self.cacher.load_fixture_data(kdir, fixture_type))
+        index.finish()
+        logger.info('indexed %s %s of %s/%s' % (len(index), kind, org, repo))
+        return index
+
+    def get_index(self, org, repo, kind):
+        key = (org, repo, kind, self.cacher.BASEURL)
+        generation = self.cacher.fixture_generation
+        with self._lock:
+            cached = self.indexes.get(key)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        index = self.builds.do(key, self.build, org, repo, kind)
+        with self._lock:
+            self.indexes[key] = (generation, index)
+        return index
+
+    def overlay(self, index, org, repo, session=None):
+        '''Items of index with local changes, changes merged in'''
+        ddir = os.path.join(
+            self.cacher.session_deltadir(session), 'api.github.com', 'repos', org, repo, 'issues'
+        )
+        try:
+            numbers = [x for x in os.listdir(ddir) if x.isdigit()]
+        except FileNotFoundError:
+            return {}
+        overlay = {}
+        for number in numbers:
+            item = index.items.get(int(number))
+            if item is None or not self.cacher.deltas.exists(os.path.join(ddir, number)):
+                continue
+            url = 'https://api.github.com/repos/%s/%s/issues/%s' % (org, repo, number)
+            overlay[item['number']] = self.cacher.get_changes('api.github.com', url, item, session=session)
+        return overlay
+
+    def answer(self, url, session=None):
+        '''Every item a list url selects, in order, or None if the query
+        can not be answered locally'''
+        parsed = parse_list_url(url)
+        if parsed is None:
+            return None
+        org, repo, kind, params = parsed
+        query = ListQuery.parse(kind, params)
+        if query is None:
+            return None
+        index = self.get_index(org, repo, kind)
+        if not len(index):
+            return None
+        return index.evaluate(query, self.overlay(index, org, repo, session=session))
+
+    def clear(self):
+        with self._lock:
+            self.indexes = {}
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+
+import re
+
+from github_test_proxy.codec import DEFAULT_CODEC
+
+
+class UrlRewriter:
+
+    '''Point origin urls back at the proxy in a single regex pass
+
+    The matcher is compiled once for every configured origin and works
+    directly on the raw fixture bytes, so a payload never has to be
+    parsed just to have its urls rewritten.
+    '''
+
+    def __init__(self, origins, baseurl, codec=None):
+        self.origins = tuple(origins)
+        self.baseurl = baseurl
+        self.codec = codec or DEFAULT_CODEC
+        # longest first so api.github.com wins over github.com
+        ordered = sorted(self.origins, key=len, reverse=True)
+        pattern = '|'.join(re.escape(x) for x in ordered)
+        self._text_re = re.compile(pattern)
+        self._bytes_re = re.compile(pattern.encode('utf-8'))
+        self._text_base = baseurl.replace('\\', '\\\\')
+        self._bytes_base = self._text_base.encode('utf-8')
+
+    def rewrite_bytes(self, raw):
+        return self._bytes_re.sub(self._bytes_base, raw)
+
+    def rewrite_text(self, text):
+        return self._text_re.sub(self._text_base, text)
+
+    def rewrite_object(self, data):
+        if data is None:
+            return None
+        return self.codec.loads(self.rewrite_bytes(self.codec.dumps(data)))
+
+    def loads(self, raw):
+        '''Rewrite raw json bytes and parse them'''
+        return self.codec.loads(self.rewrite_bytes(raw))
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+
+import gc
+import os
+import signal
+import socket
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from logzero import logger
+from werkzeug.serving import BaseWSGIServer
+from werkzeug.serving import WSGIRequestHandler
+
+from github_test_proxy.lru import file_signature
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # idle keep-alive connections give their pool thread back after this
+    timeout = 5
+
+
+class PooledWSGIServer(BaseWSGIServer):
+
+    '''werkzeug server handling connections on a fixed size thread pool'''
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads=8, fd=None):
+        # werkzeug calls server_close while adopting fd, so the pool comes after
+        self.executor = None
+        super().__init__(host, port, app, handler=KeepAliveHandler, fd=fd)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        # let in-flight requests finish before the socket goes away
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        super().server_close()
+
+
+class PreforkServer:
+
+    '''Serve a wsgi app from several forked worker processes
+
+    The parent binds the listening socket, runs setup once (loading the
+    fixture index, opening the archive) and then forks the workers, which
+    inherit both. The parent only supervises: workers that die are
+    replaced, SIGHUP or a change to one of the watched files runs reload
+    and swaps in a new generation of workers while the old ones finish
+    their in-flight requests, and SIGTERM/SIGINT stops everything.
+    '''
+
+    # seconds retiring workers get to finish before they are killed
+    graceful_timeout = 30
+
+    def __init__(self, app, host='0.0.0.0', port=5000, processes=4, threads=8,
+                 reload=None, after_fork=None, watch=None, watch_interval=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.processes = processes
+        self.threads = threads
+        self.reload = reload
+        self.after_fork = after_fork
+        # callable returning the files whose change triggers a reload
+        self.watch = watch
+        self.watch_interval = watch_interval
+        self.sock = None
+        self.workers = set()
+        self.retiring = {}
+        self.generation = 0
+        self._stopping = False
+        self._reload_requested = False
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(128)
+        sock.set_inheritable(True)
+        self.sock = sock
+        self.port = sock.getsockname()[1]
+        return sock
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return pid
+        code = 0
+        try:
+            self.serve_worker()
+        except BaseException:
+            logger.exception('worker %s failed' % os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def serve_worker(self):
+        for signum in [signal.SIGINT, signal.SIGHUP]:
+            signal.signal(signum, signal.SIG_IGN)
+        if self.after_fork is not None:
+            self.after_fork()
+        server = PooledWSGIServer(
+            self.host, self.port, self.app, threads=self.threads, fd=self.sock.fileno()
+        )
+
+        def stop(signum, frame):
+            # shutdown() blocks until serve_forever returns, so not from here
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        logger.info('worker %s serving on %s:%s' % (os.getpid(), self.host, self.port))
+        # closes the server, waiting on in-flight requests, once stopped
+        server.serve_forever()
+
+    def spawn_generation(self):
+        self.generation += 1
+        for _ in range(self.processes):
+            self.spawn()
+        logger.info('generation %s: workers %s' % (self.generation, sorted(self.workers)))
+
+    def watched_signature(self):
+        if self.watch is None:
+            return None
+        return tuple(file_signature(x) for x in self.watch())
+
+    def do_reload(self):
+        '''Run reload in the parent and replace the workers with fresh ones'''
+        self._reload_requested = False
+        logger.info('reloading')
+        if self.reload is not None:
+            self.reload()
+        gc.freeze()
+        old = self.workers
+        self.workers = set()
+        self.spawn_generation()
+        deadline = time.time() + self.graceful_timeout
+        for pid in old:
+            self.retiring[pid] = deadline
+            self.kill(pid, signal.SIGTERM)
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        '''Collect exited workers, replacing current ones that died'''
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                break
+            if pid in self.retiring:
+                del self.retiring[pid]
+            elif pid in self.workers:
+                self.workers.discard(pid)
+                if not self._stopping:
+                    logger.warning('worker %s exited with %s, replacing it' % (pid, status))
+                    self.spawn()
+        now = time.time()
+        for pid, deadline in list(self.retiring.items()):
+            if now > deadline:
+                logger.warning('worker %s did not finish in time, killing it' % pid)
+                self.kill(pid, signal.SIGKILL)
+                self.retiring[pid] = now + self.graceful_timeout
+
+    def request_stop(self, signum, frame):
+        self._stopping = True
+
+    def request_reload(self, signum, frame):
+        self._reload_requested = True
+
+    def stop(self):
+        pids = list(self.workers) + list(self.retiring.keys())
+        for pid in pids:
+            self.kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        for pid in pids:
+            while True:
+                try:
+                    done, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if done:
+                    break
+                if time.time() > deadline:
+                    self.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                    break
+                time.sleep(0.05)
+        self.workers = set()
+        self.retiring = {}
+        self.sock.close()
+
+    def run(self):
+        if self.sock is None:
+            self.bind()
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        logger.info('listening on %s:%s with %s processes x %s threads' % (
+            self.host, self.port, self.processes, self.threads))
+
+        # everything loaded so far is shared copy-on-write, keep the
+        # collector from touching (and so copying) those pages
+        gc.freeze()
+        self.spawn_generation()
+        signature = self.watched_signature()
+        checked = time.time()
+        try:
+            while not self._stopping:
+                if self.watch_interval and time.time() - checked >= self.watch_interval:
+                    checked = time.time()
+                    current = self.watched_signature()
+                    if current != signature:
+                        self._reload_requested = True
+                if self._reload_requested:
+                    self.do_reload()
+                    signature = self.watched_signature()
+                self.reap()
+                time.sleep(0.1)
+        finally:
+            self.stop()
+        logger.info('stopped')
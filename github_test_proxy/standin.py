@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+
+class StandinServer:
+
+    '''Tiny local stand-in for the github api
+
+    Serves canned (headers, data) responses from a dict keyed on the
+    request path including the query string. Used to exercise proxy and
+    warm modes without talking to github.
+    '''
+
+    def __init__(self, routes=None, host='127.0.0.1', port=0):
+        self.routes = routes or {}
+        self.requests = []
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                standin.requests.append(('GET', self.path))
+                self.reply(standin.routes.get(self.path))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self.rfile.read(length)
+                standin.requests.append(('POST', self.path))
+                self.reply(standin.routes.get(self.path))
+
+            def reply(self, route):
+                status = 200
+                if route is None:
+                    status = 404
+                    route = ({}, {'message': 'Not Found'})
+                elif len(route) == 3:
+                    status = route[2]
+                headers, data = route[:2]
+                if callable(data):
+                    data = data(self)
+                body = b''
+                if data is not None:
+                    body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+
+import random
+import threading
+import time
+
+from urllib.parse import urlparse
+
+import requests
+from logzero import logger
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectTimeout
+from requests.exceptions import Timeout
+from urllib3.exceptions import NewConnectionError
+
+
+# statuses that are worth another try after a pause
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# methods safe to send twice, the others are only retried if the first
+# attempt never reached the server unless the caller says the request
+# is idempotent, as a graphql query is
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+
+
+def never_sent(exc):
+    '''Did the request fail before a connection was made'''
+    if isinstance(exc, ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class UpstreamClient:
+
+    '''Pooled keep-alive sessions to the upstream apis
+
+    One requests.Session per host so connections (and their TLS handshakes)
+    are reused across fetches, with a per-host pool size. Failed requests,
+    5xx responses and secondary rate limits are retried with jittered
+    exponential backoff. POST and PATCH are only retried when the
+    connection could not be made, unless the caller marks the request
+    idempotent, so a graphql mutation never runs twice.
+    '''
+
+    # (connect, read) seconds
+    timeout = (10, 60)
+    retries = 3
+    backoff = 1.0
+    max_backoff = 60.0
+
+    # connection pool size per upstream host
+    pool_sizes = {
+        'api.github.com': 20,
+        'api.shippable.com': 4,
+    }
+    default_pool_size = 10
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, host):
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                size = self.pool_sizes.get(host, self.default_pool_size)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[host] = session
+            return session
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+    def backoff_delay(self, attempt, rr=None):
+        '''Seconds to wait before the next attempt'''
+        if rr is not None and rr.headers.get('Retry-After', '').isdigit():
+            return min(self.max_backoff, int(rr.headers['Retry-After']))
+        ceiling = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return random.uniform(ceiling / 2, ceiling)
+
+    def should_retry(self, rr):
+        if rr.status_code in RETRY_STATUSES:
+            return True
+        if rr.status_code == 403:
+            if 'Retry-After' in rr.headers:
+                return True
+            try:
+                return 'secondary rate limit' in rr.text
+            except Exception:
+                return False
+        return False
+
+    def request(self, method, url, data=None, headers=None, idempotent=None):
+        session = self.session(urlparse(url).netloc)
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            try:
+                rr = session.request(
+                    method, url, data=data, headers=headers, timeout=self.timeout
+                )
+            except (ConnectionError, Timeout) as e:
+                if attempt >= self.retries or not (idempotent or never_sent(e)):
+                    raise
+                delay = self.backoff_delay(attempt)
+                logger.warning('%s %s failed (%s), retrying in %.1fs' % (method, url, e, delay))
+            else:
+                if attempt >= self.retries or not idempotent or not self.should_retry(rr):
+                    return rr
+                delay = self.backoff_delay(attempt, rr=rr)
+                logger.warning('%s %s returned %s, retrying in %.1fs' % (method, url, rr.status_code, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, headers=None):
+        return self.request('GET', url, headers=headers)
+
+    def post(self, url, data=None, headers=None, idempotent=None):
+        return self.request('POST', url, data=data, headers=headers, idempotent=idempotent)
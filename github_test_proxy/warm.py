@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+
+import json
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from logzero import logger
+
+from github_test_proxy.cacher import RequestNotCachedException
+from github_test_proxy.cacher import UpstreamError
+from github_test_proxy.locking import atomic_write
+
+
+def parse_ranges(spec):
+    '''"1-3,7" -> [1, 2, 3, 7]'''
+    numbers = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            numbers.extend(range(int(start), int(end) + 1))
+        else:
+            numbers.append(int(part))
+    return numbers
+
+
+class FixtureWarmer:
+
+    '''Crawl a repo upstream and record everything the bots read as fixtures
+
+    Issues and pulls are crawled by a pool of workers. Every fetched url is
+    recorded in a checkpoint file so an interrupted crawl picks up where it
+    stopped. All workers pause when the upstream rate limit runs low.
+    '''
+
+    # urls per issue, relative to repos/<org>/<repo>/issues/<number>
+    issue_paths = ['', '/comments', '/events', '/labels']
+    # urls per pull, relative to repos/<org>/<repo>/pulls/<number>
+    pull_paths = ['', '/files', '/commits']
+
+    def __init__(self, cacher, org, repo, numbers=None, workers=4,
+                 checkpoint=None, min_remaining=100, save_every=50):
+        self.cacher = cacher
+        self.org = org
+        self.repo = repo
+        self.numbers = numbers
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.min_remaining = min_remaining
+        self.save_every = save_every
+        self.done = set()
+        self.fetched = 0
+        self._lock = threading.Lock()
+        self._resume_at = 0
+
+    @property
+    def repo_url(self):
+        return 'https://api.github.com/repos/%s/%s' % (self.org, self.repo)
+
+    def load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint, 'r') as f:
+            state = json.loads(f.read())
+        self.done = set(state.get('done', []))
+        if self.numbers is None and state.get('numbers') is not None:
+            self.numbers = state['numbers']
+        logger.info('resuming from %s with %s urls done' % (self.checkpoint, len(self.done)))
+
+    def save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        with self._lock:
+            state = {
+                'org': self.org,
+                'repo': self.repo,
+                'numbers': self.numbers,
+                'done': sorted(self.done),
+            }
+        atomic_write(self.checkpoint, json.dumps(state).encode('utf-8'))
+
+    def throttle(self, headers):
+        '''Pause every worker until reset when the rate limit runs low'''
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining and reset and remaining.isdigit() and reset.isdigit():
+            if int(remaining) < self.min_remaining:
+                with self._lock:
+                    self._resume_at = max(self._resume_at, int(reset) + 1)
+        delay = self._resume_at - time.time()
+        if delay > 0:
+            logger.warning('rate limit low, sleeping %ss' % int(delay))
+            time.sleep(delay)
+
+    def warm_url(self, url):
+        '''Fetch every page of url and write it as fixtures, once
+
+        Urls upstream answers with an error are left out of the checkpoint
+        so the next run tries them again.
+        '''
+        if url in self.done:
+            return None
+        try:
+            headers, data = self.cacher.tokenized_request(url, cache_pages=True)
+        except UpstreamError as e:
+            logger.warning('not recording %s' % e)
+            self.throttle(e.headers)
+            return None
+        with self._lock:
+            self.done.add(url)
+            self.fetched += 1
+            save = self.fetched % self.save_every == 0
+        if save:
+            self.save_checkpoint()
+        self.throttle(headers)
+        return data
+
+    def list_numbers(self):
+        url = '%s/issues?state=all&per_page=100' % self.repo_url
+        issues = self.warm_url(url) or []
+        return sorted(x['number'] for x in issues)
+
+    def warm_issue(self, number):
+        iurl = '%s/issues/%s' % (self.repo_url, number)
+        issue = None
+        for path in self.issue_paths:
+            data = self.warm_url(iurl + path)
+            if path == '':
+                issue = data
+        if issue is None:
+            # already crawled before a resume, the fixture says what it was
+            try:
+                issue = self.cacher.read_fixture(*self.cacher.fixture_location(iurl))[1]
+            except RequestNotCachedException:
+                issue = {}
+        if isinstance(issue, dict) and 'pull_request' in issue:
+            purl = '%s/pulls/%s' % (self.repo_url, number)
+            for path in self.pull_paths:
+                self.warm_url(purl + path)
+
+    def run(self):
+        self.load_checkpoint()
+        self.warm_url('%s/labels?per_page=100' % self.repo_url)
+        if self.numbers is None:
+            self.numbers = self.list_numbers()
+            self.save_checkpoint()
+        logger.info('warming %s issues in %s/%s' % (len(self.numbers), self.org, self.repo))
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for _ in executor.map(self.warm_issue, self.numbers):
+                    pass
+        finally:
+            self.save_checkpoint()
+        logger.info('warmed %s urls' % self.fetched)
+        return self.fetched
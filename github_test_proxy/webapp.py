@@ -10,24 +10,187 @@ import json
 import os
 import pickle
 import random
+import re
 import requests
+import signal
 import six
 import subprocess
+import sys
 import time
 
 from logzero import logger
 from pprint import pprint
 from flask import Flask
+from flask import Response
 from flask import jsonify
 from flask import request
 
+from github_test_proxy.archive import pack_fixtures
+from github_test_proxy.archive import unpack_fixtures
+from github_test_proxy.blobs import dedup_fixtures
 from github_test_proxy.cacher import ProxyCacher
+from github_test_proxy.cacher import filter_response_headers
+from github_test_proxy.cassette import CassettePlayer
+from github_test_proxy.cassette import CassetteRecorder
+from github_test_proxy.codec import Codec
+from github_test_proxy.codec import COMPRESSIONS
+from github_test_proxy.codec import JSON_BACKENDS
+from github_test_proxy.codec import benchmark_codecs
+from github_test_proxy.index import FixtureIndex
+from github_test_proxy.metrics import render_counters
+from github_test_proxy.metrics import route_pattern
+from github_test_proxy.server import PreforkServer
+from github_test_proxy.warm import FixtureWarmer
+from github_test_proxy.warm import parse_ranges
 
 
 GM = ProxyCacher()
 #app = Flask(__name__)
 app = Flask('test')
 
+# set by the record and replay actions
+RECORDER = None
+PLAYER = None
+
+# requests without a session header get one derived from their token
+SESSION_BY_TOKEN = False
+SESSION_HEADER = 'X-Test-Session'
+SESSION_RE = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+
+########################################################
+#   HELPERS
+########################################################
+
+
+def get_context(path):
+    '''The upstream api a request path belongs to'''
+    if path.lstrip('/').split('/')[0] in ['jobs', 'runs']:
+        return 'api.shippable.com'
+    return 'api.github.com'
+
+
+def request_path():
+    '''Path and query string of the current request'''
+    if request.query_string:
+        return '%s?%s' % (request.path, request.query_string.decode('utf-8'))
+    return request.path
+
+
+def valid_session(name):
+    # dot names are reserved for sessions being discarded
+    return bool(SESSION_RE.match(name)) and not name.startswith('.')
+
+
+def request_session():
+    '''The delta namespace of the current request, None for the shared one
+
+    Raises ValueError for a session name that is not safe as a directory.
+    '''
+    session = request.headers.get(SESSION_HEADER)
+    if session is None and SESSION_BY_TOKEN:
+        auth = request.headers.get('Authorization')
+        if auth:
+            token = auth.split()[-1]
+            session = 'token-' + hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+    if session is None:
+        return None
+    if not valid_session(session):
+        raise ValueError('invalid session name %r' % session)
+    return session
+
+
+def is_not_modified(etag, last_modified):
+    '''Does the client already have this version of the resource'''
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return int(last_modified) <= request.if_modified_since.timestamp()
+    return False
+
+
+def json_response(data):
+    '''jsonify through the configured json backend'''
+    return Response(GM.codec.dumps(data) + b'\n', mimetype='application/json')
+
+
+def set_validators(resp, validators):
+    '''Replace the upstream ETag with the one for what is served'''
+    if validators is None:
+        return
+    etag, last_modified = validators
+    resp.set_etag(etag)
+    resp.last_modified = datetime.datetime.fromtimestamp(
+        int(last_modified), tz=datetime.timezone.utc
+    )
+
+
+########################################################
+#   TIMING
+########################################################
+
+
+@app.before_request
+def start_timing():
+    if request.endpoint == 'abstract_path':
+        GM.metrics.begin(route_pattern(request.path, get_context(request.path)))
+
+
+@app.after_request
+def finish_timing(resp):
+    timings = GM.metrics.finish()
+    if timings is not None and GM.server_timing:
+        resp.headers.set('Server-Timing', timings.server_timing())
+    return resp
+
+
+@app.teardown_request
+def discard_timing(exc):
+    # requests that raised never reached finish_timing
+    GM.metrics.discard()
+
+
+########################################################
+#   CASSETTES
+########################################################
+
+
+@app.before_request
+def replay_cassette():
+    if PLAYER is None or request.endpoint != 'abstract_path':
+        return None
+    played = PLAYER.play(request.method, request_path(), request.get_data())
+    if played is None:
+        logger.error('%s %s is not in the cassette' % (request.method, request_path()))
+        resp = json_response({'message': 'Not Found in cassette'})
+        resp.status_code = 404
+        return resp
+    status, headers, body = played
+    resp = Response(body, status=status, headers=headers)
+    return resp.make_conditional(request.environ)
+
+
+@app.after_request
+def record_cassette(resp):
+    if RECORDER is not None and request.endpoint == 'abstract_path':
+        RECORDER.record(
+            request.method,
+            request_path(),
+            request.get_data(),
+            resp.status_code,
+            list(resp.headers.items()),
+            resp.get_data()
+        )
+    return resp
+
+
+@app.route('/_proxy/cassette', methods=['POST'])
+def save_cassette():
+    if RECORDER is None:
+        return jsonify({'message': 'not recording'}), 400
+    RECORDER.save()
+    return jsonify({'interactions': len(RECORDER), 'path': RECORDER.path})
+
 
 ########################################################
 #   ROUTES
@@ -54,6 +217,46 @@ def rate_limit():
     return jsonify(rl)
 
 
+@app.route('/_proxy/stats')
+def proxy_stats():
+    return jsonify(GM.cache_stats())
+
+
+@app.route('/metrics')
+def metrics():
+    stats = GM.cache_stats()
+    cache_events = {}
+    for cache in ['fixtures', 'responses', 'graphql']:
+        for event in ['hits', 'misses', 'evictions', 'invalidations']:
+            cache_events[(('cache', cache), ('event', event))] = stats[cache][event]
+    upstream = dict(
+        ((('result', k),), v) for k, v in stats['revalidations'].items()
+    )
+    body = GM.metrics.render() + render_counters(
+        'cache_events_total',
+        'In-memory fixture and response cache events',
+        cache_events
+    ) + render_counters(
+        'revalidations_total',
+        'Smart mode revalidations by upstream answer',
+        upstream
+    )
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/_proxy/sessions')
+def list_sessions():
+    return jsonify({'sessions': GM.list_sessions()})
+
+
+@app.route('/_proxy/sessions/<name>', methods=['DELETE'])
+def discard_session(name):
+    if not valid_session(name):
+        return jsonify({'message': 'invalid session name'}), 400
+    if not GM.discard_session(name):
+        return jsonify({'message': 'Not Found'}), 404
+    return jsonify({'session': name, 'discarded': True})
+
 
 @app.route('/<path:path>', methods=['GET', 'POST', 'DELETE', 'UPDATE'])
 def abstract_path(path):
@@ -67,40 +270,70 @@ def abstract_path(path):
     logger.info(request.path)
 
     # context defines the baseurl
-    thiscontext = None
-    if path_parts[0] in ['jobs', 'runs']:
-        thiscontext = 'api.shippable.com'
-    else:
-        thiscontext = 'api.github.com'
+    thiscontext = get_context(path)
 
     # tell the mocker what the real url should be
-    thisurl = request.url.replace(
-            'http://localhost:5000',
-            'https://%s' % thiscontext
-    )
-    thisurl = request.url.replace(
-            'http://localhost:6000',
-            'https://%s' % thiscontext
-    )
+    thisurl = 'https://%s/%s' % (thiscontext, request.url[len(request.host_url):])
     logger.debug('thisurl: %s' % thisurl)
+
+    try:
+        session = request_session()
+    except ValueError as e:
+        resp = json_response({'message': str(e)})
+        resp.status_code = 400
+        return resp
+
+    validators = None
+    if request.method.upper() == 'GET':
+        with GM.metrics.stage('validators'):
+            validators = GM.get_validators(thisurl, context=thiscontext, session=session)
+        # a recorded 304 would be wrong for replays from a cold client
+        if validators is not None and RECORDER is None and is_not_modified(*validators):
+            resp = Response(status=304)
+            set_validators(resp, validators)
+            return resp
+
+    # unchanged fixtures go out still compressed when the client allows it
+    if GM.gzip_passthrough and request.method.upper() == 'GET' and \
+            request.accept_encodings['gzip']:
+        cached = GM.cached_gzip_response(thisurl, context=thiscontext, session=session)
+        if cached is not None:
+            headers, body = cached
+            resp = Response(body, mimetype='application/json')
+            for k,v in headers.items():
+                resp.headers.set(k, v)
+            resp.headers.set('Content-Encoding', 'gzip')
+            resp.vary.add('Accept-Encoding')
+            set_validators(resp, validators)
+            return resp
+
+    # unchanged fixtures can be sent as-is without building the object
+    if GM.preserialize and request.method.upper() == 'GET':
+        cached = GM.cached_response(thisurl, context=thiscontext, session=session)
+        if cached is not None:
+            headers, body = cached
+            resp = Response(body, mimetype='application/json')
+            for k,v in headers.items():
+                resp.headers.set(k, v)
+            set_validators(resp, validators)
+            return resp
+
     headers, data = GM.cached_tokenized_request(
         thisurl,
         method=request.method.upper(),
         data=request.data,
-        context=thiscontext
+        context=thiscontext,
+        session=session
     )
     logger.info('finished cached_tokenized_request')
 
-    pprint(data)
-
-    resp = jsonify(data)
-    whitelist = ['ETag', 'Link']
-    for k,v in headers.items():
-        if not k.startswith('X-') and k not in whitelist:
-            continue
+    with GM.metrics.stage('serialize'):
+        resp = json_response(data)
+    for k,v in filter_response_headers(headers).items():
         resp.headers.set(k, v)
+    set_validators(resp, validators)
 
-    logger.debug('response data: %s' % data)
+    logger.debug('response data: %s', data)
 
     #pprint(dict(resp.headers))
     return resp
@@ -112,12 +345,26 @@ def main():
         'load',  # use fixtures but do not make requests
         'proxy', # make requests and cache results
         'smart', # use fixtures when possible
+        'pack',  # convert the fixturedir into a packed archive
+        'unpack', # expand a packed archive into the fixturedir
+        'compact', # fold the delta logs into snapshots
+        'warm', # crawl a repo upstream into the fixturedir
+        'codecbench', # compare json backends and compression on the fixtures
+        'record', # like smart, and save the session into a cassette
+        'replay', # serve a recorded cassette from memory
+        'dedup', # move the fixturedir into the content-addressed blob store
     ]
 
     parser = argparse.ArgumentParser()
     parser.add_argument('action', choices=action_choices,
         help="which mode to run the proxy in")
     parser.add_argument('--port', default=5000, type=int)
+    parser.add_argument('--processes', default=0, type=int,
+        help="serve from this many forked worker processes (0: dev server)")
+    parser.add_argument('--threads', default=8, type=int,
+        help="request threads per worker process")
+    parser.add_argument('--reload-interval', default=None, type=float,
+        help="seconds between checks of the index/archive for changes")
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--token', '--github_token', default=None)
     parser.add_argument('--shippable_token', default=None)
@@ -127,30 +374,207 @@ def main():
     parser.add_argument('--deltas', '--deltadir',
         default='/tmp/github/deltas',
         help="where to store changes from POST data")
+    parser.add_argument('--fixture-cache-size', default=1024, type=int,
+        help="max number of parsed fixtures to keep in memory (0 disables)")
+    parser.add_argument('--fixture-cache-mb', default=64, type=int,
+        help="max megabytes of parsed fixtures to keep in memory")
+    parser.add_argument('--graphql-cache-size', default=256, type=int,
+        help="max number of graphql query bodies to remember the fixture of (0 disables)")
+    parser.add_argument('--preserialize', action='store_true',
+        help="serve fixtures without deltas from cached response bytes")
+    parser.add_argument('--gzip-passthrough', action='store_true',
+        help="send fixtures without deltas gzipped as stored to gzip clients")
+    parser.add_argument('--json-backend', default='auto',
+        choices=['auto'] + JSON_BACKENDS,
+        help="json library for fixtures and responses (auto: fastest installed)")
+    parser.add_argument('--compression', default='gzip', choices=COMPRESSIONS,
+        help="how compressed fixtures are stored when recorded")
+    parser.add_argument('--compress-level', default=6, type=int,
+        help="gzip level for recorded fixtures")
+    parser.add_argument('--pack-level', default=9, type=int,
+        help="gzip level for fixtures packed into an archive by pack")
+    parser.add_argument('--served-compress-level', default=6, type=int,
+        help="gzip level for the variants sent by --gzip-passthrough")
+    parser.add_argument('--server-timing', action='store_true',
+        help="add a Server-Timing header breaking down each request's stages")
+    parser.add_argument('--session-by-token', action='store_true',
+        help="give each api token its own delta namespace when no %s header is sent" % SESSION_HEADER)
+    parser.add_argument('--cassette', default=None,
+        help="cassette file to record into or replay from")
+    parser.add_argument('--index', action='store_true',
+        help="load the fixture index at startup instead of probing the disk")
+    parser.add_argument('--synthesize-pages', action='store_true',
+        help="store list endpoints as full collections and cut pages out locally")
+    parser.add_argument('--local-queries', action='store_true',
+        help="load mode: evaluate issue and pull list filters over every recorded issue")
+    parser.add_argument('--dedup', action='store_true',
+        help="store new fixtures in the content-addressed blob store")
+    parser.add_argument('--dry-run', action='store_true',
+        help="dedup: only report what the migration would save")
+    parser.add_argument('--reindex', action='store_true',
+        help="rebuild the persisted fixture index (implies --index)")
+    parser.add_argument('--archive', default=None,
+        help="packed fixture archive to serve from, or to pack/unpack")
+    parser.add_argument('--pool-size', default=20, type=int,
+        help="keep-alive connections to api.github.com")
+    parser.add_argument('--shippable-pool-size', default=4, type=int,
+        help="keep-alive connections to api.shippable.com")
+    parser.add_argument('--timeout', default=60, type=float,
+        help="seconds to wait on an upstream response")
+    parser.add_argument('--retries', default=3, type=int,
+        help="retries for upstream 5xx and secondary rate limit responses")
+    parser.add_argument('--page-workers', default=8, type=int,
+        help="concurrent upstream fetches when paginating")
+    parser.add_argument('--ttl', default=None, type=int,
+        help="smart mode: seconds before a fixture is revalidated upstream")
+    parser.add_argument('--ttl-rule', default=[], action='append',
+        help="smart mode: REGEX=SECONDS ttl for matching urls, repeatable")
+    parser.add_argument('--github-url', default=None,
+        help="fetch api.github.com urls from this base url instead")
+    parser.add_argument('--org', default=None, help="org to warm")
+    parser.add_argument('--repo', default=None, help="repo to warm")
+    parser.add_argument('--issues', default=None,
+        help="issue numbers to warm, e.g. 1-100,205 (default: all)")
+    parser.add_argument('--workers', default=4, type=int,
+        help="concurrent issues to warm")
+    parser.add_argument('--checkpoint', default=None,
+        help="file to resume an interrupted warm from")
     args = parser.parse_args()
 
     GM.deltadir = os.path.expanduser(args.deltas)
     GM.fixturedir = os.path.expanduser(args.fixtures)
+    GM.set_codec(
+        Codec(args.json_backend, args.compression, args.compress_level),
+        served_codec=Codec(args.json_backend, 'gzip', args.served_compress_level)
+    )
+
+    if args.action == 'codecbench':
+        report = benchmark_codecs(GM.fixturedir)
+        print(json.dumps(report, indent=2))
+        return
+
+    if args.action == 'compact':
+        GM.deltas.compact_all(GM.deltadir)
+        return
+
+    if args.action == 'dedup':
+        report = dedup_fixtures(GM.fixturedir, codec=GM.codec, dry_run=args.dry_run)
+        # the persisted index still names the old files
+        if not args.dry_run and os.path.exists(os.path.join(GM.fixturedir, FixtureIndex.snapshot_name)):
+            GM.load_index(rebuild=True)
+        print(json.dumps(report, indent=2))
+        return
+
+    if args.action in ['pack', 'unpack']:
+        if not args.archive:
+            parser.error('%s requires --archive' % args.action)
+        archive = os.path.expanduser(args.archive)
+        if args.action == 'pack':
+            pack_fixtures(GM.fixturedir, archive, level=args.pack_level)
+        else:
+            unpack_fixtures(archive, GM.fixturedir)
+        return
+    GM.fixture_cache.max_entries = args.fixture_cache_size
+    GM.fixture_cache.max_bytes = args.fixture_cache_mb * 1024 * 1024
+    GM.graphql_cache.max_entries = args.graphql_cache_size
+    GM.preserialize = args.preserialize
+    GM.gzip_passthrough = args.gzip_passthrough
+    GM.server_timing = args.server_timing
+    GM.dedup = args.dedup
+    GM.synthesize_pages = args.synthesize_pages
+    GM.local_queries = args.local_queries
+    global SESSION_BY_TOKEN
+    SESSION_BY_TOKEN = args.session_by_token
+    GM.upstream.pool_sizes = {
+        'api.github.com': args.pool_size,
+        'api.shippable.com': args.shippable_pool_size,
+    }
+    GM.upstream.timeout = (10, args.timeout)
+    GM.upstream.retries = args.retries
+    GM.page_workers = args.page_workers
+    GM.fixture_ttl = args.ttl
+    GM.fixture_ttls = []
+    for rule in args.ttl_rule:
+        pattern, ttl = rule.rsplit('=', 1)
+        GM.fixture_ttls.append((re.compile(pattern), int(ttl)))
+    if args.github_url:
+        GM.UPSTREAMS = {'api.github.com': args.github_url}
+
+    if args.action == 'warm':
+        if not args.org or not args.repo:
+            parser.error('warm requires --org and --repo')
+        GM.TOKEN = args.token
+        numbers = None
+        if args.issues:
+            numbers = parse_ranges(args.issues)
+        warmer = FixtureWarmer(
+            GM,
+            args.org,
+            args.repo,
+            numbers=numbers,
+            workers=args.workers,
+            checkpoint=args.checkpoint
+        )
+        warmer.run()
+        return
+
+    global RECORDER
+    global PLAYER
+    GM.BASEURL = 'http://localhost:%s' % args.port
+    if args.action in ['record', 'replay'] and not args.cassette:
+        parser.error('%s requires --cassette' % args.action)
+    if args.action == 'record' and args.processes:
+        parser.error('record needs a single process, drop --processes')
+    if args.action == 'replay':
+        PLAYER = CassettePlayer(os.path.expanduser(args.cassette), GM.BASEURL, codec=GM.codec)
 
     if args.action == 'proxy':
         GM.proxy = True
         GM.usecache = False
         GM.TOKEN = args.token
         GM.SHIPPABLE_TOKEN = args.shippable_token
-    elif args.action == 'smart':
+    elif args.action in ['smart', 'record']:
         GM.proxy = True
         GM.usecache = True
         GM.TOKEN = args.token
         GM.SHIPPABLE_TOKEN = args.shippable_token
+        if args.action == 'record':
+            # cassettes hold plain bodies
+            GM.gzip_passthrough = False
+            RECORDER = CassetteRecorder(os.path.expanduser(args.cassette), GM.BASEURL, codec=GM.codec)
 
     else:
         GM.proxy = False
         GM.usecache = True
         GM.writedeltas = True
 
-    GM.BASEURL = 'http://localhost:%s' % args.port
-
-    app.run(debug=args.debug, host='0.0.0.0', port=args.port)
+    if args.index or args.reindex:
+        GM.load_index(rebuild=args.reindex)
+    if args.archive:
+        GM.open_archive(os.path.expanduser(args.archive))
+
+    if args.processes:
+        server = PreforkServer(
+            app,
+            host='0.0.0.0',
+            port=args.port,
+            processes=args.processes,
+            threads=args.threads,
+            reload=lambda: GM.reload(rebuild=args.reindex),
+            after_fork=GM.after_fork,
+            watch=GM.watched_files,
+            watch_interval=args.reload_interval
+        )
+        server.run()
+        return
+
+    if RECORDER is not None:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        app.run(debug=args.debug, host='0.0.0.0', port=args.port, threaded=True)
+    finally:
+        if RECORDER is not None:
+            RECORDER.save()
 
 
 if __name__ == "__main__":
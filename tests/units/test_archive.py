@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+
+from github_test_proxy.archive import FixtureArchive
+from github_test_proxy.archive import pack_fixtures
+from github_test_proxy.archive import unpack_fixtures
+from github_test_proxy.cacher import ProxyCacher
+
+
+def write_fixtures(fixturedir):
+    GM = ProxyCacher()
+    GM.fixturedir = fixturedir
+    fixdir = os.path.join(fixturedir, 'api.github.com', 'repos', 'ansible', 'ansible', 'issues')
+    url = 'https://api.github.com/repos/ansible/ansible/issues/1'
+    GM.write_fixture(fixdir, '1', {'number': 1, 'url': url}, {'ETag': 'x'}, compress=True)
+    GM.write_fixture(fixdir, 'labels', [{'name': 'bug'}], {}, compress=False)
+    return fixdir
+
+
+def test_pack_and_serve():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fixturedir = os.path.join(tmpdir, 'fixtures')
+        fixdir = write_fixtures(fixturedir)
+        path = os.path.join(tmpdir, 'fixtures.pack')
+        assert pack_fixtures(fixturedir, path) == 2
+
+        archive = FixtureArchive(path)
+        assert len(archive) == 2
+        assert ('api.github.com/repos/ansible/ansible/issues', '1') in archive
+        archive.close()
+
+        # serve from the archive alone
+        GM = ProxyCacher()
+        GM.fixturedir = os.path.join(tmpdir, 'empty')
+        GM.usecache = True
+        GM.open_archive(path)
+        fixdir = fixdir.replace(fixturedir, GM.fixturedir)
+        headers, data = GM.load_fixture(fixdir, '1')
+        assert headers == {'ETag': 'x'}
+        assert data['url'] == GM.BASEURL + '/repos/ansible/ansible/issues/1'
+        assert GM.read_fixture(fixdir, 'labels')[1] == [{'name': 'bug'}]
+
+
+def test_unpack_roundtrip():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fixturedir = os.path.join(tmpdir, 'fixtures')
+        fixdir = write_fixtures(fixturedir)
+        path = os.path.join(tmpdir, 'fixtures.pack')
+        pack_fixtures(fixturedir, path)
+
+        outdir = os.path.join(tmpdir, 'out')
+        assert unpack_fixtures(path, outdir) == 2
+        GM = ProxyCacher()
+        GM.fixturedir = outdir
+        headers, data = GM.read_fixture(fixdir.replace(fixturedir, outdir), 'labels')
+        assert data == [{'name': 'bug'}]
+
+
+def test_fixturedir_overrides_archive():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fixturedir = os.path.join(tmpdir, 'fixtures')
+        fixdir = write_fixtures(fixturedir)
+        path = os.path.join(tmpdir, 'fixtures.pack')
+        pack_fixtures(fixturedir, path)
+
+        GM = ProxyCacher()
+        GM.fixturedir = os.path.join(tmpdir, 'live')
+        GM.usecache = True
+        GM.open_archive(path)
+        fixdir = fixdir.replace(fixturedir, GM.fixturedir)
+        assert GM.load_fixture(fixdir, '1')[1]['number'] == 1
+
+        # rewritten by smart mode without an index loaded
+        GM.write_fixture(fixdir, '1', {'number': 1, 'state': 'closed'}, {}, compress=True)
+        assert GM.load_fixture(fixdir, '1')[1]['state'] == 'closed'
+        assert GM.fixture_hash(fixdir, '1')[0]
+        assert GM.read_fixture(fixdir, 'labels')[1] == [{'name': 'bug'}]
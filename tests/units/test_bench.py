@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import tempfile
+
+from benchmarks import proxybench
+from github_test_proxy import webapp
+
+
+def test_percentile():
+    ordered = list(range(1, 101))
+    assert proxybench.percentile(ordered, 50) == 50
+    assert proxybench.percentile(ordered, 99) == 99
+    assert proxybench.percentile([7], 95) == 7
+
+
+def test_bench_report():
+    previous = webapp.GM
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = os.path.join(tmpdir, 'bench.json')
+        report = proxybench.main([
+            '--issues', '5', '--requests', '40', '--concurrency', '2',
+            '--output', output
+        ])
+        assert webapp.GM is previous
+        with open(output, 'r') as f:
+            assert json.loads(f.read()) == report
+
+    results = dict(((x['scenario'], x['transport']), x) for x in report['results'])
+    assert len(results) == 6
+    for result in results.values():
+        assert result['requests'] == 40
+        assert result['errors'] == 0
+        assert result['p50_ms'] <= result['p95_ms'] <= result['p99_ms']
+    # every resource is fetched upstream at most once
+    assert results[('smart', 'client')]['upstream_requests'] <= 20
+    assert proxybench.compare(report, report)
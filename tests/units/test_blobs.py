@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+
+from github_test_proxy.archive import FixtureArchive
+from github_test_proxy.archive import pack_fixtures
+from github_test_proxy.blobs import BlobStore
+from github_test_proxy.blobs import dedup_fixtures
+from github_test_proxy.cacher import ProxyCacher
+
+
+def make_cacher(fixturedir, dedup=False):
+    GM = ProxyCacher()
+    GM.fixturedir = fixturedir
+    GM.usecache = True
+    GM.dedup = dedup
+    return GM
+
+
+def write_fixtures(GM):
+    '''Three issues whose comments are all empty, fetched at different times'''
+    base = os.path.join(GM.fixturedir, 'api.github.com', 'repos', 'ansible', 'ansible', 'issues')
+    for number in range(1, 4):
+        headers = {'ETag': 'empty', 'Date': 'day %s' % number, 'X-GitHub-Request-Id': str(number)}
+        GM.write_fixture(os.path.join(base, str(number)), 'comments', [], headers, compress=number != 2)
+        GM.write_fixture(base, str(number), {'number': number}, {'ETag': str(number)}, compress=True)
+    return base
+
+
+def test_dedup_writes():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        GM = make_cacher(os.path.join(tmpdir, 'fixtures'), dedup=True)
+        base = write_fixtures(GM)
+        assert sorted(os.listdir(os.path.join(base, '1'))) == ['comments.headers.json.ref', 'comments.json.ref']
+        # one empty list, one set of comment headers, three issues and their headers
+        assert len(list(GM.blobs.digests())) == 8
+
+        headers, data = GM.load_fixture(os.path.join(base, '2'), 'comments')
+        assert data == []
+        assert headers == {'ETag': 'empty'}
+
+        # rate limit headers are kept, bots throttle on what they say
+        GM.write_fixture(base, '4', {'number': 4}, {'ETag': '4', 'X-RateLimit-Remaining': '10'})
+        assert GM.load_fixture(base, '4')[0] == {'ETag': '4', 'X-RateLimit-Remaining': '10'}
+        assert GM.read_fixture(base, '3')[1] == {'number': 3}
+        assert GM.get_validators('https://api.github.com/repos/ansible/ansible/issues/3') is not None
+
+        # switching back to plain files leaves no ref behind to shadow them
+        GM.dedup = False
+        GM.write_fixture(base, '3', {'number': 3, 'state': 'open'}, {}, compress=True)
+        assert sorted(x for x in os.listdir(base) if x.startswith('3.')) == ['3.headers.json.gz', '3.json.gz']
+        assert GM.read_fixture(base, '3')[1]['state'] == 'open'
+
+
+def test_dedup_migration():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fixturedir = os.path.join(tmpdir, 'fixtures')
+        GM = make_cacher(fixturedir)
+        base = write_fixtures(GM)
+        GM.load_index()
+
+        report = dedup_fixtures(fixturedir, dry_run=True)
+        assert report['files'] == 12
+        assert report['blobs'] == 8
+        assert report['dedup_ratio'] == 1.5
+        assert not os.path.exists(BlobStore(fixturedir).root)
+
+        report = dedup_fixtures(fixturedir)
+        assert report['migrated'] == 12
+        assert report['blobs'] == 8
+        assert len(list(BlobStore(fixturedir).digests())) == 8
+        assert sorted(os.listdir(os.path.join(base, '2'))) == ['comments.headers.json.ref', 'comments.json.ref']
+
+        # already migrated fixtures stay as they are, orphaned blobs go
+        GM = make_cacher(fixturedir, dedup=True)
+        GM.write_fixture(base, '1', {'number': 1, 'state': 'closed'}, {'ETag': '1'})
+        report = dedup_fixtures(fixturedir)
+        assert report['migrated'] == 0
+        assert report['pruned'] == 1
+
+        GM = make_cacher(fixturedir)
+        GM.load_index(rebuild=True)
+        assert GM.load_fixture(os.path.join(base, '1'), 'comments')[1] == []
+        assert GM.load_fixture(base, '1')[1] == {'number': 1, 'state': 'closed'}
+
+        path = os.path.join(tmpdir, 'fixtures.pack')
+        assert pack_fixtures(fixturedir, path) == 6
+        archive = FixtureArchive(path)
+        try:
+            assert archive.read('api.github.com/repos/ansible/ansible/issues', '2')[1] == b'{"number":2}'
+        finally:
+            archive.close()
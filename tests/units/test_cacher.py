@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import copy
 import datetime
 import json
 import os
@@ -7,6 +8,8 @@ import tempfile
 from unittest.mock import patch
 
 from github_test_proxy.cacher import ProxyCacher
+from github_test_proxy.cacher import set_page_number
+from github_test_proxy.standin import StandinServer
 
 
 ###############################################################################
@@ -17,6 +20,12 @@ class RequestsMocker:
     _headers = {}
     _data = {}
     _get_calls = 0
+    def Session(self):
+        return self
+    def mount(self, prefix, adapter):
+        pass
+    def request(self, method, url, data=None, headers=None, timeout=None):
+        return self.get(url, headers=headers)
     def get(self, url, headers=None):
         self._get_calls += 1
         return MockRequestsResponse(
@@ -28,11 +37,12 @@ class RequestsMocker:
 class MockRequestsResponse:
     _headers = None
     _json = None
+    status_code = 200
     def __init__(self, inheaders, injson):
         self._headers = inheaders
         self._json = injson
     def json(self):
-        return self._json
+        return copy.deepcopy(self._json)
     @property
     def headers(self):
         return self._headers
@@ -47,7 +57,7 @@ def test_init():
 
 def test_cached_tokenized_request_get():
     with tempfile.TemporaryDirectory() as tmpdir:
-        with patch('github_test_proxy.cacher.requests', RequestsMocker()) as mock_requests:
+        with patch('github_test_proxy.upstream.requests', RequestsMocker()) as mock_requests:
             GM = ProxyCacher()
             GM.proxy = True
             GM.fixturedir = os.path.join(tmpdir, 'fixtures')
@@ -96,7 +106,7 @@ def test_cached_tokenized_request_get():
 
 def test_cached_tokenized_request_post():
     with tempfile.TemporaryDirectory() as tmpdir:
-        with patch('github_test_proxy.cacher.requests', RequestsMocker()) as mock_requests:
+        with patch('github_test_proxy.upstream.requests', RequestsMocker()) as mock_requests:
             GM = ProxyCacher()
             GM.proxy = True
             GM.fixturedir = os.path.join(tmpdir, 'fixtures')
@@ -141,5 +151,291 @@ def test_cached_tokenized_request_post():
             assert rdata2['comments'] == 1
 
 
+def test_load_fixture_uses_cache():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        GM = ProxyCacher()
+        GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+        fixdir = os.path.join(GM.fixturedir, 'api.github.com', 'repos', 'ansible', 'ansible', 'issues')
+        url = 'https://api.github.com/repos/ansible/ansible/issues/1'
+        GM.write_fixture(fixdir, '1', {'number': 1, 'url': url}, {}, compress=True)
+
+        headers, data = GM.load_fixture(fixdir, '1')
+        assert data['url'] == GM.BASEURL + '/repos/ansible/ansible/issues/1'
+        headers, data = GM.load_fixture(fixdir, '1')
+        stats = GM.cache_stats()['fixtures']
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+
+        # rewriting the fixture must not serve the stale copy
+        GM.write_fixture(fixdir, '1', {'number': 2, 'url': url}, {}, compress=True)
+        headers, data = GM.load_fixture(fixdir, '1')
+        assert data['number'] == 2
+
+
+def test_load_fixture_concurrent_write():
+    from github_test_proxy import cacher
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        GM = ProxyCacher()
+        GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+        fixdir = os.path.join(GM.fixturedir, 'api.github.com', 'repos', 'ansible', 'ansible', 'issues')
+        GM.write_fixture(fixdir, '1', {'number': 1}, {}, compress=True)
+
+        # a writer lands after the old bytes were read
+        decompress_file = cacher.decompress_file
+        writes = []
+        def racing_decompress(path, raw):
+            if path.endswith('/1.json.gz') and not writes:
+                writes.append(path)
+                GM.write_fixture(fixdir, '1', {'number': 1, 'title': 'changed'}, {}, compress=True)
+            return decompress_file(path, raw)
+
+        with patch('github_test_proxy.cacher.decompress_file', racing_decompress):
+            assert GM.load_fixture(fixdir, '1')[1] == {'number': 1}
+        assert GM.load_fixture(fixdir, '1')[1]['title'] == 'changed'
+
+
 def test_replace_data_urls():
-    pass
+    GM = ProxyCacher()
+    GM.BASEURL = 'http://localhost:5001'
+    data = {
+        'a': 'https://api.github.com/repos/x/y',
+        'b': 'https://github.com/x/y',
+        'c': ['https://api.shippable.com/runs', 'https://app.shippable.com/r'],
+    }
+    assert GM.replace_data_urls(data) == {
+        'a': 'http://localhost:5001/repos/x/y',
+        'b': 'http://localhost:5001/x/y',
+        'c': ['http://localhost:5001/runs', 'http://localhost:5001/r'],
+    }
+    raw = b'{"url": "https://api.github.com/users/ansibot"}'
+    assert GM.rewriter.rewrite_bytes(raw) == \
+        b'{"url": "http://localhost:5001/users/ansibot"}'
+
+
+def test_get_changes_materialized_labels():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        GM = ProxyCacher()
+        GM.usecache = True
+        GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+        GM.deltadir = os.path.join(tmpdir, 'deltas')
+
+        url = 'https://api.github.com/repos/ansible/ansible/issues/1'
+        fixdir = os.path.join(GM.fixturedir, 'api.github.com', 'repos', 'ansible', 'ansible', 'issues')
+        issue = {'number': 1, 'comments': 0, 'labels': [{'name': 'bug'}, {'name': 'old'}]}
+        GM.write_fixture(fixdir, '1', issue, {}, compress=True)
+        GM.write_fixture(os.path.join(fixdir, '1'), 'comments', [], {}, compress=True)
+        GM.write_fixture(os.path.join(fixdir, '1'), 'events', [], {}, compress=True)
+
+        GM.cached_tokenized_request(url + '/labels', data=json.dumps(['new', 'tmp']), method='POST')
+        GM.cached_tokenized_request(url + '/labels/old', data=b'', method='DELETE')
+        GM.cached_tokenized_request(url + '/labels/tmp', data=b'', method='DELETE')
+        GM.cached_tokenized_request(url + '/comments', data=json.dumps({'body': 'hi'}), method='POST')
+
+        rheaders, rdata = GM.cached_tokenized_request(url)
+        assert [x['name'] for x in rdata['labels']] == ['bug', 'new']
+        assert rdata['comments'] == 1
+        rheaders, rdata = GM.cached_tokenized_request(url + '/comments')
+        assert [x['body'] for x in rdata] == ['hi']
+        assert rdata[0]['user']['url'] == GM.BASEURL + '/users/ansibot'
+        rheaders, rdata = GM.cached_tokenized_request(url + '/events')
+        assert len(rdata) == 5
+
+        # the cached fixture itself is untouched
+        assert GM.load_fixture(fixdir, '1')[1]['labels'] == issue['labels']
+
+
+def test_concurrent_misses_are_coalesced():
+    import threading
+    import time
+
+    class SlowRequestsMocker(RequestsMocker):
+        def get(self, url, headers=None):
+            time.sleep(0.2)
+            return RequestsMocker.get(self, url, headers=headers)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mocker = SlowRequestsMocker()
+        mocker._get_calls = 0
+        with patch('github_test_proxy.upstream.requests', mocker) as mock_requests:
+            GM = ProxyCacher()
+            GM.proxy = True
+            GM.usecache = True
+            GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+            GM.deltadir = os.path.join(tmpdir, 'deltas')
+
+            url = 'https://api.github.com/repos/ansible/ansible/issues/2'
+            mock_requests._headers[url] = {}
+            mock_requests._data[url] = {'number': 2, 'url': url}
+
+            results = []
+            threads = [
+                threading.Thread(target=lambda: results.append(GM.cached_tokenized_request(url)))
+                for x in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert mock_requests._get_calls == 1
+            assert len(results) == 5
+            assert all(x[1]['number'] == 2 for x in results)
+            stats = GM.cache_stats()['upstream']
+            assert stats['upstream_calls'] == 1
+            assert stats['saved_calls'] == 4
+
+
+def test_tokenized_request_concurrent_pages():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mocker = RequestsMocker()
+        mocker._get_calls = 0
+        with patch('github_test_proxy.upstream.requests', mocker) as mock_requests:
+            GM = ProxyCacher()
+            GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+
+            url = 'https://api.github.com/repos/ansible/ansible/issues'
+            last = url + '?per_page=2&page=4'
+            for page in range(1, 5):
+                purl = url if page == 1 else url + '?per_page=2&page=%s' % page
+                links = ['<%s?per_page=2&page=%s>; rel="next"' % (url, page + 1)] if page < 4 else []
+                links.append('<%s>; rel="last"' % last)
+                mock_requests._headers[purl] = {'Link': ', '.join(links)}
+                mock_requests._data[purl] = [{'number': page * 2 - 1}, {'number': page * 2}]
+
+            rheaders, rdata = GM.tokenized_request(url, cache_pages=True)
+            assert [x['number'] for x in rdata] == list(range(1, 9))
+            assert mock_requests._get_calls == 4
+
+            fixdir = os.path.join(GM.fixturedir, 'api.github.com', 'repos', 'ansible', 'ansible')
+            assert GM.read_fixture(fixdir, 'issues')[1][0]['number'] == 1
+            assert GM.read_fixture(fixdir, 'issues?per_page=2&page=3')[1][0]['number'] == 5
+
+            rheaders, rdata = GM.tokenized_request(url, pages=2)
+            assert [x['number'] for x in rdata] == [1, 2, 3, 4]
+
+
+def test_set_page_number():
+    url = 'https://api.github.com/search/issues?q=repo%3Aansible%2Fansible+is%3Aopen&page=2&per_page=50'
+    assert set_page_number(url, 3) == url.replace('page=2', 'page=3')
+    assert set_page_number('https://api.github.com/x?q=a b', 2) == 'https://api.github.com/x?q=a b&page=2'
+    assert set_page_number('https://api.github.com/x', 2) == 'https://api.github.com/x?page=2'
+
+
+def test_synthesized_pages():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mocker = RequestsMocker()
+        mocker._get_calls = 0
+        with patch('github_test_proxy.upstream.requests', mocker) as mock_requests:
+            GM = ProxyCacher()
+            GM.proxy = True
+            GM.usecache = True
+            GM.synthesize_pages = True
+            GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+            GM.deltadir = os.path.join(tmpdir, 'deltas')
+            GM.BASEURL = 'http://localhost:6000'
+
+            url = 'https://api.github.com/repos/ansible/ansible/issues/1/comments'
+            first = url + '?per_page=100'
+            mock_requests._headers[first] = {'Link': '<%s&page=2>; rel="next", <%s&page=2>; rel="last"' % (first, first)}
+            mock_requests._data[first] = [{'id': x} for x in range(1, 101)]
+            mock_requests._headers[first + '&page=2'] = {}
+            mock_requests._data[first + '&page=2'] = [{'id': x} for x in range(101, 106)]
+
+            rheaders, rdata = GM.cached_tokenized_request(url)
+            assert [x['id'] for x in rdata] == list(range(1, 31))
+            assert rheaders['Link'] == ', '.join([
+                '<http://localhost:6000/repos/ansible/ansible/issues/1/comments?per_page=30&page=2>; rel="next"',
+                '<http://localhost:6000/repos/ansible/ansible/issues/1/comments?per_page=30&page=4>; rel="last"',
+            ])
+            assert mock_requests._get_calls == 2
+
+            # any other page size is cut from the same collection
+            rheaders, rdata = GM.cached_tokenized_request(url + '?page=2&per_page=50')
+            assert [x['id'] for x in rdata] == list(range(51, 101))
+            assert 'rel="prev"' in rheaders['Link'] and 'page=3>; rel="last"' in rheaders['Link']
+            rheaders, rdata = GM.cached_tokenized_request(url + '?per_page=500&page=2')
+            assert [x['id'] for x in rdata] == list(range(101, 106))
+            assert 'rel="next"' not in rheaders['Link']
+            assert GM.cached_tokenized_request(url + '?page=9')[1] == []
+            assert mock_requests._get_calls == 2
+
+            # local comments are appended before the page is cut
+            GM.cached_tokenized_request(url, data=json.dumps({'body': 'hi'}), method='POST')
+            rheaders, rdata = GM.cached_tokenized_request(url + '?per_page=50&page=3')
+            assert [x.get('body') for x in rdata] == [None] * 5 + ['hi']
+
+            etag = GM.get_validators(url + '?per_page=50&page=3')[0]
+            assert etag != GM.get_validators(url + '?per_page=50&page=2')[0]
+
+            # load mode pages through the stored collection too
+            GM.proxy = False
+            assert len(GM.cached_tokenized_request(url + '?per_page=100')[1]) == 100
+            assert mock_requests._get_calls == 2
+
+            # page fixtures recorded without a collection still answer
+            other = 'https://api.github.com/repos/ansible/ansible/issues/2/comments'
+            GM.store_fixture(other + '?page=2', {}, [{'id': 1}])
+            assert GM.cached_tokenized_request(other + '?page=2')[1] == [{'id': 1}]
+
+            # only repo lists are collections, and only when they are lists
+            search = 'https://api.github.com/search/issues?q=is%3Aopen&page=2'
+            assert not GM.is_collection(search)
+            GM.store_fixture(search, {}, {'total_count': 1, 'items': [{'id': 1}]})
+            assert GM.cached_tokenized_request(search)[1]['total_count'] == 1
+            events = 'https://api.github.com/repos/ansible/ansible/issues/3/events'
+            fixdir, dtype = GM.collection_location(events)
+            GM.write_fixture(fixdir, dtype, {'message': 'Moved'}, {}, compress=True)
+            GM.store_fixture(events, {}, [{'id': 2}])
+            assert GM.cached_tokenized_request(events)[1] == [{'id': 2}]
+
+
+def test_collection_with_failing_page():
+    with tempfile.TemporaryDirectory() as tmpdir, StandinServer() as standin:
+        path = '/repos/ansible/ansible/issues/1/comments'
+        first = path + '?per_page=100'
+        links = '<%s%s&page=2>; rel="next", <%s%s&page=3>; rel="last"' % (
+            standin.url, first, standin.url, first)
+        standin.routes.update({
+            first: ({'Link': links}, [{'id': x} for x in range(1, 101)]),
+            first + '&page=3': ({}, [{'id': x} for x in range(201, 251)]),
+            path + '?page=2': ({}, [{'id': 31}]),
+        })
+        GM = ProxyCacher()
+        GM.proxy = True
+        GM.usecache = True
+        GM.synthesize_pages = True
+        GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+        GM.deltadir = os.path.join(tmpdir, 'deltas')
+        GM.UPSTREAMS = {'api.github.com': standin.url}
+
+        # page 2 is a 404, no partial collection is stored and the page
+        # is fetched on its own
+        url = 'https://api.github.com' + path
+        assert GM.cached_tokenized_request(url + '?page=2')[1] == [{'id': 31}]
+        fixdir, dtype = GM.collection_location(url)
+        assert not [x for x in os.listdir(fixdir) if x.startswith(dtype)]
+
+        # a page that is not a list is refused the same way
+        standin.routes[first + '&page=2'] = ({}, {'message': 'odd'})
+        GM.fetch_collection(url)
+        assert not [x for x in os.listdir(fixdir) if x.startswith(dtype)]
+
+
+def test_etag_after_discarded_session():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        GM = ProxyCacher()
+        GM.usecache = True
+        GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+        GM.deltadir = os.path.join(tmpdir, 'deltas')
+        url = 'https://api.github.com/repos/ansible/ansible/issues/1'
+        GM.store_fixture(url, {}, {'number': 1, 'url': url, 'labels': []})
+
+        GM.cached_tokenized_request(url + '/labels', data=json.dumps(['foo']), method='POST', session='s1')
+        etag = GM.get_validators(url, session='s1')[0]
+        assert GM.discard_session('s1')
+        # the same number of events, different ones
+        GM.cached_tokenized_request(url + '/labels', data=json.dumps(['bar']), method='POST', session='s1')
+        assert GM.get_validators(url, session='s1')[0] != etag
+        labels = GM.cached_tokenized_request(url, session='s1')[1]['labels']
+        assert [x['name'] for x in labels] == ['bar']
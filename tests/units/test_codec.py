@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import tempfile
+
+import pytest
+
+from github_test_proxy.cacher import ProxyCacher
+from github_test_proxy.codec import Codec
+from github_test_proxy.codec import JSON_BACKENDS
+from github_test_proxy.codec import JsonBackend
+from github_test_proxy.codec import available
+from github_test_proxy.codec import benchmark_codecs
+
+
+DATA = {
+    'url': 'https://api.github.com/repos/ansible/ansible/issues/1',
+    'title': 'café',
+    'number': 1,
+    'labels': [{'name': 'bug'}],
+    'id': 2 ** 70,
+}
+
+
+@pytest.mark.parametrize('name', [x for x in JSON_BACKENDS if available(x)])
+def test_json_backends(name):
+    backend = JsonBackend(name)
+    assert backend.loads(backend.dumps(DATA)) == DATA
+    assert backend.loads(backend.dumps_pretty(DATA)) == DATA
+    # the url rewriter works on the raw bytes
+    assert b'https://api.github.com/repos' in backend.dumps(DATA)
+    small = dict(DATA, id=1)
+    assert json.loads(backend.dumps_pretty(small)) == small
+    assert backend.dumps_pretty(small).startswith(b'{\n  "id": 1,')
+
+
+def test_codec_compression():
+    raw = json.dumps(DATA).encode('utf-8')
+    gz = Codec('json', 'gzip', 1)
+    assert gz.decompress(gz.compress(raw)) == raw
+    assert gz.compress(raw) == gz.compress(raw)
+    plain = Codec('json', 'none')
+    assert plain.compress(raw) == raw
+    assert plain.suffix == ''
+    with pytest.raises(ValueError):
+        Codec('nosuchjson')
+    with pytest.raises(ValueError):
+        Codec(compression='lzma')
+
+
+def test_uncompressed_store_and_benchmark():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        GM = ProxyCacher()
+        GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+        GM.set_codec(Codec('json', 'none'))
+        fixdir = os.path.join(GM.fixturedir, 'repos', 'ansible', 'ansible', '1')
+        GM.write_fixture(fixdir, 'issue', DATA, {'ETag': 'x'}, compress=True)
+        assert sorted(os.listdir(fixdir)) == ['issue.headers.json', 'issue.json']
+        assert GM.read_fixture(fixdir, 'issue') == ({'ETag': 'x'}, DATA)
+
+        GM.set_codec(Codec('json', 'gzip', 1))
+        GM.write_fixture(fixdir, 'comments', [DATA], {}, compress=True)
+        assert GM.read_fixture(fixdir, 'comments')[1] == [DATA]
+
+        report = benchmark_codecs(GM.fixturedir, rounds=1)
+        assert report['fixtures'] == 2
+        assert [x['backend'] for x in report['json']] == \
+            [x for x in JSON_BACKENDS if available(x)]
+        sizes = dict((x['level'], x['bytes']) for x in report['compression'])
+        assert sizes[0] == report['bytes']
+        assert sizes[9] <= sizes[1] < sizes[0]
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+
+from unittest.mock import patch
+
+from github_test_proxy.deltas import DeltaStore
+from github_test_proxy.locking import file_lock
+
+
+def test_append_and_tail_read():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = DeltaStore()
+        assert not store.exists(tmpdir)
+        assert store.read(tmpdir) == []
+
+        store.append(tmpdir, [{'id': 1}, {'id': 2}])
+        assert store.read(tmpdir) == [{'id': 1}, {'id': 2}]
+
+        # a second reader only parses what was appended after its offset
+        store.append(tmpdir, [{'id': 3}])
+        with open(os.path.join(tmpdir, 'events.jsonl'), 'a') as f:
+            f.write('{"id": 4')
+        assert store.read(tmpdir) == [{'id': 1}, {'id': 2}, {'id': 3}]
+        with open(os.path.join(tmpdir, 'events.jsonl'), 'a') as f:
+            f.write('}\n')
+        assert [x['id'] for x in store.read(tmpdir)] == [1, 2, 3, 4]
+        assert store.version(tmpdir) == 4
+
+
+def test_compact_keeps_events():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # events.json written by older versions is the snapshot
+        with open(os.path.join(tmpdir, 'events.json'), 'w') as f:
+            f.write(json.dumps([{'id': 0}]))
+        store = DeltaStore()
+        store.append(tmpdir, [{'id': 1}])
+        reader = DeltaStore()
+        assert reader.read(tmpdir) == [{'id': 0}, {'id': 1}]
+
+        assert store.compact_all(tmpdir) == 1
+        assert not os.path.exists(os.path.join(tmpdir, 'events.jsonl'))
+        store.append(tmpdir, [{'id': 2}])
+        assert [x['id'] for x in reader.read(tmpdir)] == [0, 1, 2]
+
+
+def test_removed_resources_are_forgotten():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ddir = os.path.join(tmpdir, 'sessions', 'alice', 'issues', '1')
+        writer = DeltaStore()
+        writer.append(ddir, [{'id': 1}])
+        # another worker that read the resource before it was discarded
+        reader = DeltaStore()
+        assert reader.read(ddir) == [{'id': 1}]
+
+        shutil.rmtree(os.path.join(tmpdir, 'sessions', 'alice'))
+        writer.forget(os.path.join(tmpdir, 'sessions', 'alice'))
+        assert reader.read(ddir) == []
+        assert not writer._logs and not reader._logs
+
+
+def test_file_lock_on_removed_directory():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ddir = os.path.join(tmpdir, 'gone')
+        real_open = os.open
+        raced = []
+
+        def racing_open(path, *args, **kwargs):
+            # the directory goes away between the caller's checks and the open
+            if path.endswith('.lock') and not raced:
+                raced.append(path)
+                shutil.rmtree(ddir)
+            return real_open(path, *args, **kwargs)
+
+        for shared in [True, False]:
+            os.makedirs(ddir, exist_ok=True)
+            raced[:] = []
+            with patch('os.open', side_effect=racing_open):
+                with file_lock(ddir, shared=shared):
+                    assert raced
+            assert os.path.exists(ddir) != shared
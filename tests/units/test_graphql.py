@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import tempfile
+
+from github_test_proxy.cacher import ProxyCacher
+from github_test_proxy.graphql import canonical_query
+from github_test_proxy.graphql import is_mutation
+from github_test_proxy.graphql import legacy_key
+from github_test_proxy.graphql import operations
+from github_test_proxy.graphql import query_key
+from github_test_proxy.standin import StandinServer
+
+
+QUERY = '''
+# pull request lookup
+query PR($owner: String!, $repo: String!) {
+  repository(owner: $owner, name: $repo) {
+    pullRequest(number: 1) { title  body ...F }
+  }
+}
+fragment F on PullRequest { id }
+'''
+
+
+def body(query, variables, **kwargs):
+    kwargs.update({'query': query, 'variables': variables})
+    return json.dumps(kwargs).encode('utf-8')
+
+
+def test_canonical_query():
+    assert canonical_query(QUERY) == (
+        'query PR($owner:String!$repo:String!){repository(owner:$owner name:$repo)'
+        '{pullRequest(number:1){title body...F}}}fragment F on PullRequest{id}'
+    )
+    # string literals are left alone
+    assert canonical_query('{ a(s: "x,  y # z") }') == '{a(s:"x,  y # z")}'
+    assert operations(QUERY) == [('query', 'PR')]
+    assert operations('query A { a } mutation B($x: I = {a: 1}) { b }') == \
+        [('query', 'A'), ('mutation', 'B')]
+    assert operations('{ viewer { login } }') == [('query', None)]
+
+
+def test_query_key():
+    variables = {'owner': 'ansible', 'repo': 'ansible'}
+    key = query_key(body(QUERY, variables))
+    assert key == query_key(body(canonical_query(QUERY), dict(reversed(list(variables.items())))))
+    # operationName only matters when there is more than one to pick from
+    assert key == query_key(body(QUERY, variables, operationName='PR'))
+    assert key == query_key(body(QUERY, json.dumps(variables)))
+    assert key != query_key(body(QUERY, {'owner': 'ansible', 'repo': 'other'}))
+    assert query_key(b'not json') == legacy_key(b'not json')
+    assert is_mutation({'query': 'mutation { addComment { id } }'})
+    assert not is_mutation({'query': QUERY})
+
+
+def test_graphql_result_cache():
+    with tempfile.TemporaryDirectory() as tmpdir, StandinServer() as standin:
+        standin.routes['/graphql'] = ({}, {'data': {'repository': {'url': 'https://github.com/ansible/ansible'}}})
+        GM = ProxyCacher()
+        GM.proxy = True
+        GM.usecache = True
+        GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+        GM.deltadir = os.path.join(tmpdir, 'deltas')
+        GM.BASEURL = 'http://localhost:6000'
+        GM.UPSTREAMS = {'api.github.com': standin.url}
+        url = 'https://api.github.com/graphql'
+
+        variables = {'owner': 'ansible', 'repo': 'ansible'}
+        first = GM.cached_tokenized_request(url, data=body(QUERY, variables), method='POST')[1]
+        assert first['data']['repository']['url'] == 'http://localhost:6000/ansible/ansible'
+        reformatted = body(canonical_query(QUERY), {'repo': 'ansible', 'owner': 'ansible'}, operationName='PR')
+        assert GM.cached_tokenized_request(url, data=reformatted, method='POST')[1] == first
+        assert GM.cached_tokenized_request(url, data=reformatted, method='POST')[1] == first
+        assert len(standin.requests) == 1
+        # the repeated body maps straight to the fixture, whose result
+        # is only held by the fixture cache
+        assert GM.graphql_cache.stats()['hits'] == 1
+        assert len(GM.graphql_cache) == 2
+        assert GM.fixture_cache.stats()['hits'] == 1
+
+        # mutations are never remembered
+        mutation = body('mutation { addComment(input: {}) { id } }', {})
+        for _ in range(2):
+            GM.cached_tokenized_request(url, data=mutation, method='POST')
+        assert mutation not in GM.graphql_cache
+
+        # fixtures keyed on the raw body before canonicalization still load
+        GM.proxy = False
+        legacy = body('{ viewer { login } }', {})
+        fixdir, dtype = GM.fixture_location(url, data=legacy)
+        assert dtype != legacy_key(legacy)
+        GM.write_fixture(fixdir, legacy_key(legacy), {'data': {'viewer': 'bot'}}, {}, compress=True)
+        assert GM.cached_tokenized_request(url, data=legacy, method='POST')[1] == {'data': {'viewer': 'bot'}}
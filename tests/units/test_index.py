@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+from unittest.mock import patch
+
+import pytest
+
+from github_test_proxy.cacher import ProxyCacher
+from github_test_proxy.cacher import RequestNotCachedException
+from github_test_proxy.index import FixtureIndex
+
+
+def make_cacher(tmpdir):
+    GM = ProxyCacher()
+    GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+    GM.deltadir = os.path.join(tmpdir, 'deltas')
+    GM.usecache = True
+    return GM
+
+
+def test_index_build_and_reload():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        GM = make_cacher(tmpdir)
+        fixdir = os.path.join(GM.fixturedir, 'api.github.com', 'repos', 'ansible', 'ansible', 'issues')
+        GM.write_fixture(fixdir, '1', {'number': 1}, {}, compress=True)
+        GM.write_fixture(fixdir, '2', {'number': 2}, {}, compress=False)
+        # half written fixtures are not indexed
+        with open(os.path.join(fixdir, '3.json.gz'), 'wb') as f:
+            f.write(b'')
+
+        index = GM.load_index()
+        assert len(index) == 2
+        assert index.find(fixdir, '1')[1].endswith('1.json.gz')
+        assert index.find(fixdir, '2')[1].endswith('2.json')
+        assert index.find(fixdir, '3') is None
+        assert index.list(fixdir) == ['1', '2']
+
+        # new fixtures are journaled and survive a reload
+        GM.write_fixture(fixdir, '4', {'number': 4}, {}, compress=True)
+        reloaded = FixtureIndex(GM.fixturedir)
+        assert reloaded.load()
+        assert len(reloaded) == 3
+        assert reloaded.find(fixdir, '4') == GM.index.find(fixdir, '4')
+
+
+def test_index_miss_does_not_touch_disk():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        GM = make_cacher(tmpdir)
+        fixdir = os.path.join(GM.fixturedir, 'api.github.com', 'repos', 'ansible', 'ansible', 'issues')
+        GM.write_fixture(fixdir, '1', {'number': 1}, {}, compress=True)
+        GM.load_index()
+
+        with patch('os.path.exists', side_effect=AssertionError('stat')):
+            with pytest.raises(RequestNotCachedException):
+                GM.read_fixture(fixdir, '2')
+        assert GM.read_fixture(fixdir, '1')[1] == {'number': 1}
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+
+from github_test_proxy.cacher import ProxyCacher
+from github_test_proxy.locking import KeyedLocks
+from github_test_proxy.locking import UMASK
+
+
+def post_comments(tmpdir, count):
+    GM = ProxyCacher()
+    GM.deltadir = os.path.join(tmpdir, 'deltas')
+    url = 'https://api.github.com/repos/ansible/ansible/issues/1/comments'
+    for idx in range(count):
+        GM.cached_tokenized_request(url, data=json.dumps({'body': str(idx)}), method='POST')
+
+
+def test_concurrent_delta_writers():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        threads = [threading.Thread(target=post_comments, args=(tmpdir, 20)) for x in range(4)]
+        procs = [multiprocessing.Process(target=post_comments, args=(tmpdir, 20)) for x in range(2)]
+        # fork before starting threads so no child inherits a held lock
+        for worker in procs + threads:
+            worker.start()
+        for worker in procs + threads:
+            worker.join()
+
+        GM = ProxyCacher()
+        GM.deltadir = os.path.join(tmpdir, 'deltas')
+        ddir = GM.get_delta_dir('api.github.com', 'https://api.github.com/repos/ansible/ansible/issues/1')
+        assert len(GM.deltas.read(ddir)) == 120
+        assert GM.deltas.compact(ddir) == 120
+        assert len(GM.deltas.read(ddir)) == 120
+
+
+def test_concurrent_fixture_writers():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        GM = ProxyCacher()
+        GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+        fixdir = os.path.join(GM.fixturedir, 'api.github.com', 'repos', 'ansible', 'ansible', 'issues')
+
+        def writer(idx):
+            for x in range(20):
+                GM.write_fixture(fixdir, '1', {'number': idx, 'x': x}, {}, compress=True)
+                GM.read_fixture(fixdir, '1')
+
+        threads = [threading.Thread(target=writer, args=(x,)) for x in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert GM.read_fixture(fixdir, '1')[1]['x'] == 19
+        assert sorted(os.listdir(fixdir)) == ['1.headers.json.gz', '1.json.gz']
+
+
+def test_keyed_locks_evicted():
+    locks = KeyedLocks()
+    with locks('a'):
+        with locks('a'):
+            assert len(locks) == 1
+        assert len(locks) == 1
+    assert len(locks) == 0
+
+    entered = threading.Event()
+    release = threading.Event()
+
+    def holder():
+        with locks('b'):
+            entered.set()
+            release.wait()
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    entered.wait()
+    assert len(locks) == 1
+    release.set()
+    thread.join()
+    assert len(locks) == 0
+
+
+def test_atomic_write_mode():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        GM = ProxyCacher()
+        GM.fixturedir = tmpdir
+        GM.write_fixture(tmpdir, '1', {'number': 1}, {}, compress=True)
+        for fn in os.listdir(tmpdir):
+            assert os.stat(os.path.join(tmpdir, fn)).st_mode & 0o777 == 0o666 & ~UMASK
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+
+from github_test_proxy.lru import LRUCache
+from github_test_proxy.lru import file_signature
+
+
+def test_lru_evicts_oldest_by_count():
+    cache = LRUCache(max_entries=2, max_bytes=1000)
+    cache.put('a', 1, size=1)
+    cache.put('b', 2, size=1)
+    assert cache.get('a') == 1
+    cache.put('c', 3, size=1)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['hits'] == 3
+    assert stats['misses'] == 1
+
+
+def test_lru_evicts_by_bytes():
+    cache = LRUCache(max_entries=10, max_bytes=10)
+    cache.put('a', 1, size=6)
+    cache.put('b', 2, size=6)
+    assert 'a' not in cache
+    assert cache.stats()['bytes'] == 6
+    # too large to ever fit
+    cache.put('c', 3, size=11)
+    assert 'c' not in cache
+
+
+def test_lru_validator_invalidates():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = os.path.join(tmpdir, 'x')
+        with open(fn, 'w') as f:
+            f.write('1')
+        cache = LRUCache()
+        cache.put('x', file_signature(fn), size=1)
+        assert cache.get('x', validator=lambda s: s == file_signature(fn))
+        with open(fn, 'w') as f:
+            f.write('22')
+        assert cache.get('x', validator=lambda s: s == file_signature(fn)) is None
+        assert cache.stats()['invalidations'] == 1
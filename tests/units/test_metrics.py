@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+from github_test_proxy.metrics import Histogram
+from github_test_proxy.metrics import Metrics
+from github_test_proxy.metrics import route_pattern
+
+
+def test_route_pattern():
+    base = 'https://api.github.com/repos/ansible/ansible'
+    assert route_pattern(base + '/issues/1') == 'issue'
+    assert route_pattern(base + '/pulls/1') == 'pull'
+    assert route_pattern(base + '/issues/1/labels') == 'labels'
+    assert route_pattern(base + '/issues/1/labels/bug') == 'labels'
+    assert route_pattern(base + '/issues/1/events?page=2') == 'events'
+    assert route_pattern(base + '/issues/1/comments') == 'comments'
+    assert route_pattern('https://api.github.com/graphql') == 'graphql'
+    assert route_pattern('https://api.shippable.com/runs/1', 'api.shippable.com') == 'shippable'
+    assert route_pattern(base) == 'other'
+
+
+def test_histogram_and_stages():
+    histogram = Histogram(buckets=(0.1, 1.0))
+    for seconds in [0.05, 0.5, 0.5, 5.0]:
+        histogram.observe(seconds)
+    assert list(histogram.cumulative()) == [(0.1, 1), (1.0, 3), ('+Inf', 4)]
+
+    metrics = Metrics()
+    # outside a request stages are not recorded
+    with metrics.stage('read'):
+        pass
+    assert metrics.finish() is None
+
+    metrics.begin('issue')
+    for _ in range(2):
+        with metrics.stage('read'):
+            pass
+    timings = metrics.finish()
+    assert list(timings.stages.keys()) == ['read']
+    assert timings.server_timing().startswith('read;dur=')
+    assert timings.server_timing().split(', ')[-1].startswith('total;dur=')
+    assert metrics.stages[('issue', 'read')].count == 1
+    assert metrics.requests[('issue',)].count == 1
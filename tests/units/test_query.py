@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import tempfile
+
+from github_test_proxy.cacher import ProxyCacher
+from github_test_proxy.query import ListIndex
+from github_test_proxy.query import ListQuery
+
+
+REPO = 'https://api.github.com/repos/ansible/ansible'
+
+
+def issue(number, state='open', labels=(), updated='2019-01-0%sT00:00:00Z', comments=0):
+    return {
+        'number': number,
+        'state': state,
+        'labels': [{'name': x} for x in labels],
+        'created_at': '2018-12-%02dT00:00:00Z' % number,
+        'updated_at': updated % number if '%' in updated else updated,
+        'comments': comments,
+        'url': '%s/issues/%s' % (REPO, number),
+    }
+
+
+def make_cacher(tmpdir):
+    GM = ProxyCacher()
+    GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+    GM.deltadir = os.path.join(tmpdir, 'deltas')
+    GM.usecache = True
+    GM.local_queries = True
+    GM.BASEURL = 'http://localhost:6000'
+    issues = [
+        issue(1, labels=['bug']),
+        issue(2, labels=['feature']),
+        issue(3, state='closed', labels=['bug'], comments=5),
+        issue(4, labels=['bug', 'needs_info'], comments=2),
+    ]
+    for data in issues:
+        GM.store_fixture(data['url'], {}, data)
+    # issue 5 was only ever seen in a list, issue 1 there is outdated
+    GM.store_fixture(REPO + '/issues?state=all&page=3', {}, [
+        issue(5, labels=['Bug']),
+        issue(1, state='closed', updated='2018-12-31T00:00:00Z'),
+    ])
+    GM.store_fixture(REPO + '/pulls/4', {}, issue(4))
+    GM.store_fixture(REPO + '/pulls/6', {}, issue(6))
+    return GM
+
+
+def numbers(GM, query):
+    return [x['number'] for x in GM.cached_tokenized_request(REPO + query)[1]]
+
+
+def test_list_query():
+    index = ListIndex('issues')
+    for number in range(1, 5):
+        index.add(issue(number, labels=['bug'] if number % 2 else []))
+    index.finish()
+    assert [x['number'] for x in index.evaluate(ListQuery('issues', labels=['bug']))] == [3, 1]
+    query = ListQuery.parse('pulls', [('sort', 'updated')])
+    assert query.direction == 'asc'
+    assert ListQuery.parse('issues', [('milestone', '1')]) is None
+    assert ListQuery.parse('pulls', [('labels', 'bug')]) is None
+
+
+def test_local_queries():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        GM = make_cacher(tmpdir)
+
+        assert numbers(GM, '/issues') == [5, 4, 2, 1]
+        # index builds are not upstream calls
+        assert GM.cache_stats()['upstream']['upstream_calls'] == 0
+        assert numbers(GM, '/issues?state=open&labels=bug') == [5, 4, 1]
+        assert numbers(GM, '/issues?labels=bug,needs_info&state=all') == [4]
+        assert numbers(GM, '/issues?state=all&since=2019-01-03') == [5, 4, 3]
+        assert numbers(GM, '/issues?state=all&sort=comments') == [3, 4, 5, 2, 1]
+        assert numbers(GM, '/issues?sort=updated&direction=asc') == [1, 2, 4, 5]
+        assert numbers(GM, '/pulls?state=all') == [6, 4]
+
+        rheaders, rdata = GM.cached_tokenized_request(REPO + '/issues?state=all&per_page=2&page=2')
+        assert [x['number'] for x in rdata] == [3, 2]
+        assert rheaders['Link'].startswith('<http://localhost:6000/repos/ansible/ansible/issues?state=all')
+        assert rdata[0]['url'] == 'http://localhost:6000/repos/ansible/ansible/issues/3'
+
+        # local changes count for the filters
+        GM.cached_tokenized_request(
+            REPO + '/issues/2/labels', data=json.dumps(['bug']), method='POST'
+        )
+        assert numbers(GM, '/issues?labels=bug') == [5, 4, 2, 1]
+        assert numbers(GM, '/issues?sort=updated')[0] == 2
+
+        # and new fixtures are picked up
+        GM.store_fixture(REPO + '/issues/7', {}, issue(7))
+        assert numbers(GM, '/issues')[0] == 7
+
+        # a recorded list is served as it was recorded
+        GM.store_fixture(REPO + '/issues?state=closed', {}, [issue(9, state='closed')])
+        assert numbers(GM, '/issues?state=closed') == [9]
+        assert GM.cached_response(REPO + '/issues?state=closed') is not None
+        assert GM.cached_response(REPO + '/issues?state=all') is None
+
+        # filters that can not be evaluated locally need a recording
+        assert GM.local_query(REPO + '/issues?milestone=1') is None
+        assert GM.local_query(REPO + '/issues/1/comments') is None
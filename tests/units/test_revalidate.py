@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import tempfile
+import time
+
+from github_test_proxy.cacher import ProxyCacher
+from github_test_proxy.standin import StandinServer
+
+
+def make_cacher(tmpdir, standin):
+    GM = ProxyCacher()
+    GM.proxy = True
+    GM.usecache = True
+    GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+    GM.deltadir = os.path.join(tmpdir, 'deltas')
+    GM.UPSTREAMS = {'api.github.com': standin.url}
+    return GM
+
+
+def age_fixture(GM, url, seconds):
+    fixdir, dtype = GM.fixture_location(url)
+    hfn = GM.find_fixture(fixdir, dtype)[0]
+    then = time.time() - seconds
+    os.utime(hfn, (then, then))
+
+
+def test_revalidate_not_modified():
+    with tempfile.TemporaryDirectory() as tmpdir, StandinServer() as standin:
+        path = '/repos/ansible/ansible/issues/1'
+        url = 'https://api.github.com' + path
+        standin.routes[path] = ({'ETag': '"abc"'}, {'number': 1})
+        GM = make_cacher(tmpdir, standin)
+        GM.fixture_ttl = 60
+
+        assert GM.cached_tokenized_request(url)[1]['number'] == 1
+        assert GM.cached_tokenized_request(url)[1]['number'] == 1
+        assert len(standin.requests) == 1
+
+        # stale fixture, upstream says it is unchanged
+        age_fixture(GM, url, 120)
+        standin.routes[path] = ({'ETag': '"abc"'}, None, 304)
+        assert GM.cached_tokenized_request(url)[1]['number'] == 1
+        assert len(standin.requests) == 2
+        assert GM.revalidations == {'not_modified': 1, 'modified': 0}
+
+        # and fresh again afterwards
+        GM.cached_tokenized_request(url)
+        assert len(standin.requests) == 2
+
+
+def test_revalidate_modified_with_rule():
+    with tempfile.TemporaryDirectory() as tmpdir, StandinServer() as standin:
+        path = '/repos/ansible/ansible/issues/1'
+        url = 'https://api.github.com' + path
+        standin.routes[path] = ({'ETag': '"abc"'}, {'number': 1, 'title': 'old'})
+        GM = make_cacher(tmpdir, standin)
+        GM.fixture_ttls = [(re.compile(r'/issues/\d+$'), 60)]
+
+        GM.cached_tokenized_request(url)
+        age_fixture(GM, url, 120)
+        standin.routes[path] = ({'ETag': '"def"'}, {'number': 1, 'title': 'new'})
+        assert GM.cached_tokenized_request(url)[1]['title'] == 'new'
+        assert GM.revalidations == {'not_modified': 0, 'modified': 1}
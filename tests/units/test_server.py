@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from github_test_proxy.cacher import ProxyCacher
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(url, timeout=20):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return requests.get(url, timeout=5)
+        except requests.ConnectionError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def test_prefork_serving_and_reload():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fixturedir = os.path.join(tmpdir, 'fixtures')
+        deltadir = os.path.join(tmpdir, 'deltas')
+        GM = ProxyCacher()
+        GM.fixturedir = fixturedir
+        path = '/repos/ansible/ansible/issues/1'
+        fixdir, dtype = GM.fixture_location('https://api.github.com' + path)
+        GM.write_fixture(fixdir, dtype, {'number': 1, 'comments': 0, 'labels': []}, {}, compress=True)
+
+        port = free_port()
+        proc = subprocess.Popen([
+            sys.executable, '-m', 'github_test_proxy.webapp', 'load',
+            '--port', str(port), '--fixtures', fixturedir, '--deltas', deltadir,
+            '--processes', '2', '--threads', '4', '--index'
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            base = 'http://127.0.0.1:%s' % port
+            assert wait_for(base + path).json()['number'] == 1
+
+            # comments land in the shared delta store whichever worker takes them
+            for _ in range(6):
+                requests.post(base + path + '/comments', data=json.dumps({'body': 'x'}), timeout=10)
+            for _ in range(4):
+                assert requests.get(base + path, timeout=10).json()['comments'] == 6
+
+            # fixtures added behind the index show up after a reload
+            fixdir, dtype = GM.fixture_location('https://api.github.com/repos/ansible/ansible/issues/2')
+            GM.write_fixture(fixdir, dtype, {'number': 2}, {}, compress=True)
+            GM.load_index(rebuild=True)
+            proc.send_signal(signal.SIGHUP)
+            deadline = time.time() + 20
+            while True:
+                rr = requests.get(base + '/repos/ansible/ansible/issues/2', timeout=10)
+                if rr.status_code == 200:
+                    break
+                assert time.time() < deadline
+                time.sleep(0.2)
+            assert rr.json()['number'] == 2
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            assert proc.wait(timeout=30) == 0
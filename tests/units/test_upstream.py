@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import json
+
+from unittest.mock import patch
+
+from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectTimeout
+
+from github_test_proxy.cacher import ProxyCacher
+from github_test_proxy.upstream import UpstreamClient
+
+
+class MockResponse:
+    def __init__(self, status_code, headers=None, text=''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = text
+    def json(self):
+        return json.loads(self.text or 'null')
+
+
+class MockSession:
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+    def mount(self, prefix, adapter):
+        pass
+    def request(self, method, url, data=None, headers=None, timeout=None):
+        self.calls.append((method, url))
+        rr = self.responses.pop(0)
+        if isinstance(rr, Exception):
+            raise rr
+        return rr
+
+
+class MockRequests:
+    def __init__(self, session):
+        self.session = session
+        self.sessions = 0
+    def Session(self):
+        self.sessions += 1
+        return self.session
+
+
+def make_client(responses):
+    client = UpstreamClient()
+    client.backoff = 0
+    session = MockSession(responses)
+    return client, session, MockRequests(session)
+
+
+def test_session_is_reused():
+    client, session, mock_requests = make_client([MockResponse(200), MockResponse(200)])
+    with patch('github_test_proxy.upstream.requests', mock_requests):
+        client.get('https://api.github.com/a')
+        client.get('https://api.github.com/b')
+    assert mock_requests.sessions == 1
+    assert len(session.calls) == 2
+
+
+def test_retries_server_errors_and_secondary_limits():
+    client, session, mock_requests = make_client([
+        ConnectionError('reset'),
+        MockResponse(502),
+        MockResponse(403, text='You have exceeded a secondary rate limit'),
+        MockResponse(200),
+    ])
+    with patch('github_test_proxy.upstream.requests', mock_requests):
+        rr = client.get('https://api.github.com/a')
+    assert rr.status_code == 200
+    assert len(session.calls) == 4
+
+
+def test_gives_up_after_retries():
+    client, session, mock_requests = make_client([MockResponse(500)] * 5)
+    client.retries = 2
+    with patch('github_test_proxy.upstream.requests', mock_requests):
+        rr = client.get('https://api.github.com/a')
+    assert rr.status_code == 500
+    assert len(session.calls) == 3
+    # plain 404s and 403s are final
+    client, session, mock_requests = make_client([MockResponse(404)])
+    with patch('github_test_proxy.upstream.requests', mock_requests):
+        assert client.get('https://api.github.com/a').status_code == 404
+
+
+def test_posts_are_not_resent():
+    client, session, mock_requests = make_client([ConnectionError('reset'), MockResponse(200)])
+    with patch('github_test_proxy.upstream.requests', mock_requests):
+        try:
+            client.post('https://api.github.com/a', data='{}')
+        except ConnectionError:
+            pass
+        else:
+            assert False, 'a reset POST was retried'
+    assert len(session.calls) == 1
+
+    client, session, mock_requests = make_client([MockResponse(502), MockResponse(200)])
+    with patch('github_test_proxy.upstream.requests', mock_requests):
+        assert client.post('https://api.github.com/a', data='{}').status_code == 502
+
+    # nothing reached the server yet, so another try is safe
+    client, session, mock_requests = make_client([ConnectTimeout('connect'), MockResponse(201)])
+    with patch('github_test_proxy.upstream.requests', mock_requests):
+        assert client.post('https://api.github.com/a', data='{}').status_code == 201
+    assert len(session.calls) == 2
+
+
+def test_graphql_queries_are_retried():
+    query = json.dumps({'query': '{ viewer { login } }'})
+    mutation = json.dumps({'query': 'mutation { addComment(input: {}) { id } }'})
+    for data, calls in [(query, 2), (mutation, 1)]:
+        client, session, mock_requests = make_client([MockResponse(502), MockResponse(200, text='{}')])
+        GM = ProxyCacher()
+        GM.upstream = client
+        with patch('github_test_proxy.upstream.requests', mock_requests):
+            GM.tokenized_request('https://api.github.com/graphql', data=data, method='POST', paginate=False)
+        assert len(session.calls) == calls
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+
+from github_test_proxy.cacher import ProxyCacher
+from github_test_proxy.standin import StandinServer
+from github_test_proxy.warm import FixtureWarmer
+from github_test_proxy.warm import parse_ranges
+
+
+def make_routes(standin):
+    repo = '/repos/ansible/ansible'
+    listing = repo + '/issues?state=all&per_page=100'
+    standin.routes.update({
+        repo + '/labels?per_page=100': ({}, [{'name': 'bug'}]),
+        listing: (
+            {'Link': '<%s%s&page=2>; rel="next", <%s%s&page=2>; rel="last"' % (
+                standin.url, listing, standin.url, listing)},
+            [{'number': 1}]
+        ),
+        listing + '&page=2': ({}, [{'number': 2}]),
+        repo + '/issues/1': ({'X-RateLimit-Remaining': '4000'}, {'number': 1}),
+        repo + '/issues/2': ({}, {'number': 2, 'pull_request': {}}),
+        repo + '/pulls/2': ({}, {'number': 2}),
+        repo + '/pulls/2/files': ({}, [{'filename': 'setup.py'}]),
+        repo + '/pulls/2/commits': ({}, []),
+    })
+    for number in [1, 2]:
+        for path in ['comments', 'events', 'labels']:
+            standin.routes['%s/issues/%s/%s' % (repo, number, path)] = ({}, [])
+
+
+def test_parse_ranges():
+    assert parse_ranges('1-3,7, 9-9') == [1, 2, 3, 7, 9]
+
+
+def test_warm_and_resume():
+    with tempfile.TemporaryDirectory() as tmpdir, StandinServer() as standin:
+        make_routes(standin)
+        GM = ProxyCacher()
+        GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+        GM.UPSTREAMS = {'api.github.com': standin.url}
+        checkpoint = os.path.join(tmpdir, 'checkpoint.json')
+
+        warmer = FixtureWarmer(GM, 'ansible', 'ansible', checkpoint=checkpoint)
+        assert warmer.run() == 13
+        assert ('GET', '/repos/ansible/ansible/pulls/2/files') in standin.requests
+        assert ('GET', '/repos/ansible/ansible/pulls/1') not in standin.requests
+
+        fixdir = os.path.join(GM.fixturedir, 'api.github.com', 'repos', 'ansible', 'ansible')
+        assert GM.read_fixture(os.path.join(fixdir, 'pulls', '2'), 'files')[1] == [{'filename': 'setup.py'}]
+        assert GM.read_fixture(fixdir, 'issues?state=all&per_page=100&page=2')[1] == [{'number': 2}]
+
+        # pretend the crawl died before the pull urls were fetched
+        requests = len(standin.requests)
+        warmer = FixtureWarmer(GM, 'ansible', 'ansible', checkpoint=checkpoint)
+        warmer.load_checkpoint()
+        warmer.done = set(x for x in warmer.done if '/pulls/' not in x)
+        warmer.save_checkpoint()
+
+        warmer = FixtureWarmer(GM, 'ansible', 'ansible', checkpoint=checkpoint)
+        assert warmer.run() == 3
+        assert len(standin.requests) == requests + 3
+
+
+def test_errors_are_not_recorded():
+    with tempfile.TemporaryDirectory() as tmpdir, StandinServer() as standin:
+        make_routes(standin)
+        events = '/repos/ansible/ansible/issues/1/events'
+        standin.routes[events] = ({}, {'message': 'Forbidden'}, 403)
+        GM = ProxyCacher()
+        GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+        GM.UPSTREAMS = {'api.github.com': standin.url}
+        checkpoint = os.path.join(tmpdir, 'checkpoint.json')
+
+        warmer = FixtureWarmer(GM, 'ansible', 'ansible', checkpoint=checkpoint)
+        assert warmer.run() == 12
+        url = 'https://api.github.com' + events
+        assert url not in warmer.done
+        fixdir = os.path.join(GM.fixturedir, 'api.github.com', 'repos', 'ansible', 'ansible', 'issues', '1')
+        assert not [x for x in os.listdir(fixdir) if x.startswith('events')]
+
+        # the next run picks the url up again
+        standin.routes[events] = ({}, [])
+        warmer = FixtureWarmer(GM, 'ansible', 'ansible', checkpoint=checkpoint)
+        assert warmer.run() == 1
+        assert GM.read_fixture(fixdir, 'events')[1] == []
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import tempfile
+
+from unittest.mock import patch
+
+from github_test_proxy import webapp
+from github_test_proxy.metrics import Metrics
+
+
+###############################################################################
+#   HELPERS
+###############################################################################
+
+BASEURL = 'http://localhost:6000'
+
+
+def make_client(tmpdir, preserialize=True):
+    GM = webapp.GM
+    GM.fixturedir = os.path.join(tmpdir, 'fixtures')
+    GM.deltadir = os.path.join(tmpdir, 'deltas')
+    GM.proxy = False
+    GM.usecache = True
+    GM.preserialize = preserialize
+    GM.BASEURL = BASEURL
+    GM.fixture_cache.clear()
+    GM.response_cache.clear()
+
+    fixdir = os.path.join(GM.fixturedir, 'api.github.com', 'repos', 'ansible', 'ansible', 'issues')
+    url = 'https://api.github.com/repos/ansible/ansible/issues/1'
+    GM.write_fixture(
+        fixdir,
+        '1',
+        {'number': 1, 'url': url, 'comments': 0, 'labels': []},
+        {'ETag': 'abc', 'Date': 'today', 'X-GitHub-Media-Type': 'github.v3'},
+        compress=True
+    )
+    return webapp.app.test_client()
+
+
+###############################################################################
+#   TESTS
+###############################################################################
+
+def test_preserialized_response():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        client = make_client(tmpdir)
+        for _ in range(2):
+            resp = client.get('/repos/ansible/ansible/issues/1', base_url=BASEURL)
+            assert resp.status_code == 200
+            assert resp.get_json()['url'] == BASEURL + '/repos/ansible/ansible/issues/1'
+            assert resp.headers['ETag']
+            assert resp.headers['X-GitHub-Media-Type'] == 'github.v3'
+            assert 'Date' not in resp.headers or resp.headers['Date'] != 'today'
+        assert webapp.GM.cache_stats()['responses']['hits'] == 1
+
+
+def test_preserialized_falls_back_with_deltas():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        client = make_client(tmpdir)
+        client.post(
+            '/repos/ansible/ansible/issues/1/comments',
+            base_url=BASEURL,
+            data=json.dumps({'body': 'hello'})
+        )
+        resp = client.get('/repos/ansible/ansible/issues/1', base_url=BASEURL)
+        assert resp.get_json()['comments'] == 1
+
+
+def test_conditional_get():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for preserialize in [True, False]:
+            client = make_client(os.path.join(tmpdir, str(preserialize)), preserialize=preserialize)
+            path = '/repos/ansible/ansible/issues/1'
+            resp = client.get(path, base_url=BASEURL)
+            etag = resp.headers['ETag']
+            assert etag != 'abc'
+            last_modified = resp.headers['Last-Modified']
+
+            resp = client.get(path, base_url=BASEURL, headers={'If-None-Match': etag})
+            assert resp.status_code == 304
+            assert resp.data == b''
+            resp = client.get(
+                path,
+                base_url=BASEURL,
+                headers={'If-Modified-Since': last_modified}
+            )
+            assert resp.status_code == 304
+
+            # a local change invalidates the client's copy
+            client.post(path + '/comments', base_url=BASEURL, data=json.dumps({'body': 'x'}))
+            resp = client.get(path, base_url=BASEURL, headers={'If-None-Match': etag})
+            assert resp.status_code == 200
+            assert resp.get_json()['comments'] == 1
+            newtag = resp.headers['ETag']
+            assert newtag != etag
+            resp = client.get(path, base_url=BASEURL, headers={'If-None-Match': newtag})
+            assert resp.status_code == 304
+
+
+def test_gzip_passthrough():
+    import gzip
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        client = make_client(tmpdir)
+        webapp.GM.gzip_passthrough = True
+        try:
+            path = '/repos/ansible/ansible/issues/1'
+            for _ in range(2):
+                resp = client.get(path, base_url=BASEURL, headers={'Accept-Encoding': 'gzip'})
+                assert resp.headers['Content-Encoding'] == 'gzip'
+                data = json.loads(gzip.decompress(resp.data))
+                assert data['url'] == BASEURL + path
+                assert resp.headers['X-GitHub-Media-Type'] == 'github.v3'
+
+            # a fixturedir that can not be written to is served from memory
+            fixdir, dtype = webapp.GM.fixture_location('https://api.github.com/repos/ansible/ansible/issues/3')
+            webapp.GM.gzip_passthrough = False
+            webapp.GM.write_fixture(fixdir, dtype, {'number': 3}, {}, compress=True)
+            webapp.GM.gzip_passthrough = True
+            with patch('github_test_proxy.cacher.atomic_write', side_effect=PermissionError('read-only')):
+                resp = client.get(
+                    '/repos/ansible/ansible/issues/3', base_url=BASEURL, headers={'Accept-Encoding': 'gzip'}
+                )
+            assert resp.headers['Content-Encoding'] == 'gzip'
+            assert json.loads(gzip.decompress(resp.data)) == {'number': 3}
+            assert not os.path.exists(webapp.GM.served_path(fixdir, dtype))
+
+            # fixtures recorded with passthrough on are compressed right away
+            fixdir, dtype = webapp.GM.fixture_location('https://api.github.com/repos/ansible/ansible/issues/2')
+            webapp.GM.write_fixture(fixdir, dtype, {'number': 2}, {}, compress=True)
+            assert os.path.exists(webapp.GM.served_path(fixdir, dtype))
+
+            # plain clients and resources with deltas use the normal path
+            resp = client.get(path, base_url=BASEURL)
+            assert 'Content-Encoding' not in resp.headers
+            client.post(path + '/comments', base_url=BASEURL, data=json.dumps({'body': 'x'}))
+            resp = client.get(path, base_url=BASEURL, headers={'Accept-Encoding': 'gzip'})
+            assert 'Content-Encoding' not in resp.headers
+            assert resp.get_json()['comments'] == 1
+        finally:
+            webapp.GM.gzip_passthrough = False
+
+
+def test_metrics_and_server_timing():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        client = make_client(tmpdir, preserialize=False)
+        webapp.GM.metrics = Metrics()
+        webapp.GM.server_timing = True
+        try:
+            path = '/repos/ansible/ansible/issues/1'
+            resp = client.get(path, base_url=BASEURL)
+            stages = [x.split(';')[0] for x in resp.headers['Server-Timing'].split(', ')]
+            for stage in ['validators', 'lookup', 'read', 'gunzip', 'rewrite', 'parse', 'deltas', 'serialize', 'total']:
+                assert stage in stages
+            client.post(path + '/comments', base_url=BASEURL, data=json.dumps({'body': 'x'}))
+        finally:
+            webapp.GM.server_timing = False
+
+        resp = client.get('/metrics', base_url=BASEURL)
+        assert 'Server-Timing' not in resp.headers
+        text = resp.get_data(as_text=True)
+        assert '# TYPE github_test_proxy_request_seconds histogram' in text
+        assert 'github_test_proxy_request_seconds_count{route="issue"} 1' in text
+        assert 'github_test_proxy_request_seconds_count{route="comments"} 1' in text
+        assert 'github_test_proxy_stage_seconds_bucket{route="issue",stage="parse",le="+Inf"} 1' in text
+        assert 'github_test_proxy_stage_seconds_count{route="comments",stage="deltas"} 1' in text
+        assert 'github_test_proxy_cache_events_total{cache="fixtures",event="misses"}' in text
+
+
+def test_record_and_replay_cassette():
+    from github_test_proxy.cassette import CassettePlayer
+    from github_test_proxy.cassette import CassetteRecorder
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        client = make_client(tmpdir)
+        path = '/repos/ansible/ansible/issues/1'
+        cassette = os.path.join(tmpdir, 'session.cassette')
+        webapp.RECORDER = CassetteRecorder(cassette, BASEURL)
+        try:
+            etag = client.get(path, base_url=BASEURL).headers['ETag']
+            # conditional requests are recorded as full responses
+            assert client.get(path, base_url=BASEURL, headers={'If-None-Match': etag}).status_code == 200
+            client.post(path + '/comments', base_url=BASEURL, data=json.dumps({'body': 'x'}))
+            assert client.get(path, base_url=BASEURL).get_json()['comments'] == 1
+            assert client.post('/_proxy/cassette', base_url=BASEURL).get_json()['interactions'] == 4
+        finally:
+            webapp.RECORDER = None
+
+        # replayed on another port, without the fixtures
+        other = 'http://localhost:7000'
+        webapp.GM.fixturedir = os.path.join(tmpdir, 'missing')
+        webapp.PLAYER = CassettePlayer(cassette, other)
+        try:
+            resp = client.get(path, base_url=other)
+            assert resp.get_json() == {'number': 1, 'url': other + path, 'comments': 0, 'labels': []}
+            assert resp.headers['X-GitHub-Media-Type'] == 'github.v3'
+            assert client.get(path, base_url=other).get_json()['comments'] == 0
+            assert client.post(path + '/comments', base_url=other, data=json.dumps({'body': 'x'})).status_code == 200
+            for _ in range(2):
+                resp = client.get(path, base_url=other)
+                assert resp.get_json()['comments'] == 1
+            assert client.get(path, base_url=other, headers={'If-None-Match': resp.headers['ETag']}).status_code == 304
+            assert client.get('/repos/ansible/ansible/issues/2', base_url=other).status_code == 404
+            assert webapp.PLAYER.misses == 1
+        finally:
+            webapp.PLAYER = None
+
+
+def test_session_namespaces():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        client = make_client(tmpdir)
+        path = '/repos/ansible/ansible/issues/1'
+        alice = {'X-Test-Session': 'alice'}
+        bob = {'X-Test-Session': 'bob'}
+        base_etag = client.get(path, base_url=BASEURL).headers['ETag']
+
+        client.post(path + '/comments', base_url=BASEURL, headers=alice, data=json.dumps({'body': 'x'}))
+        client.post(path + '/labels', base_url=BASEURL, headers=bob, data=json.dumps(['bug']))
+
+        resp = client.get(path, base_url=BASEURL, headers=alice)
+        assert resp.get_json()['comments'] == 1
+        assert resp.get_json()['labels'] == []
+        alice_etag = resp.headers['ETag']
+        resp = client.get(path, base_url=BASEURL, headers=bob)
+        assert resp.get_json()['comments'] == 0
+        assert [x['name'] for x in resp.get_json()['labels']] == ['bug']
+        assert resp.headers['ETag'] not in [alice_etag, base_etag]
+
+        # nothing leaks into the shared view
+        resp = client.get(path, base_url=BASEURL)
+        assert resp.get_json()['comments'] == 0
+        assert resp.headers['ETag'] == base_etag
+
+        assert client.get('/_proxy/sessions', base_url=BASEURL).get_json()['sessions'] == ['alice', 'bob']
+        assert client.delete('/_proxy/sessions/alice', base_url=BASEURL).status_code == 200
+        assert client.delete('/_proxy/sessions/alice', base_url=BASEURL).status_code == 404
+        assert client.get(path, base_url=BASEURL, headers=alice).get_json()['comments'] == 0
+        assert client.get(path, base_url=BASEURL, headers=bob).get_json()['labels'] != []
+
+        resp = client.get(path, base_url=BASEURL, headers={'X-Test-Session': '../etc'})
+        assert resp.status_code == 400
+
+
+def test_session_by_token():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        client = make_client(tmpdir)
+        path = '/repos/ansible/ansible/issues/1'
+        webapp.SESSION_BY_TOKEN = True
+        try:
+            one = {'Authorization': 'token one'}
+            two = {'Authorization': 'token two'}
+            client.post(path + '/comments', base_url=BASEURL, headers=one, data=json.dumps({'body': 'x'}))
+            assert client.get(path, base_url=BASEURL, headers=one).get_json()['comments'] == 1
+            assert client.get(path, base_url=BASEURL, headers=two).get_json()['comments'] == 0
+            # an explicit session wins over the token
+            both = dict(one, **{'X-Test-Session': 'mine'})
+            assert client.get(path, base_url=BASEURL, headers=both).get_json()['comments'] == 0
+        finally:
+            webapp.SESSION_BY_TOKEN = False